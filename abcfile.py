@@ -0,0 +1,1203 @@
+#!/bin/env python3
+"""
+In-process reader/writer for the ActionScript bytecode (ABC) of a swf's DoABC tag.
+Method bodies are patched with the same patches (patcher.py) and generated asasm (rabcdasm syntax) as the asasm
+files, without the abcexport/rabcdasm/rabcasm/abcreplace round trip.
+"""
+import argparse
+import re
+import struct
+import zlib
+from patcher import PatchMatcher
+
+# opcode -> (name, operand formats):
+# m multiname, s string, i int, U uint, d double, n namespace (pool indices), u u30, b signed byte, B byte,
+# h short, j branch, L lookupswitch, D debug, M method, C class, x exception
+_OPCODES = {
+    0x01: ("bkpt", ""), 0x02: ("nop", ""), 0x03: ("throw", ""), 0x04: ("getsuper", "m"), 0x05: ("setsuper", "m"),
+    0x06: ("dxns", "s"), 0x07: ("dxnslate", ""), 0x08: ("kill", "u"), 0x09: ("label", ""),
+    0x0c: ("ifnlt", "j"), 0x0d: ("ifnle", "j"), 0x0e: ("ifngt", "j"), 0x0f: ("ifnge", "j"), 0x10: ("jump", "j"),
+    0x11: ("iftrue", "j"), 0x12: ("iffalse", "j"), 0x13: ("ifeq", "j"), 0x14: ("ifne", "j"), 0x15: ("iflt", "j"),
+    0x16: ("ifle", "j"), 0x17: ("ifgt", "j"), 0x18: ("ifge", "j"), 0x19: ("ifstricteq", "j"),
+    0x1a: ("ifstrictne", "j"), 0x1b: ("lookupswitch", "L"), 0x1c: ("pushwith", ""), 0x1d: ("popscope", ""),
+    0x1e: ("nextname", ""), 0x1f: ("hasnext", ""), 0x20: ("pushnull", ""), 0x21: ("pushundefined", ""),
+    0x23: ("nextvalue", ""), 0x24: ("pushbyte", "b"), 0x25: ("pushshort", "h"), 0x26: ("pushtrue", ""),
+    0x27: ("pushfalse", ""), 0x28: ("pushnan", ""), 0x29: ("pop", ""), 0x2a: ("dup", ""), 0x2b: ("swap", ""),
+    0x2c: ("pushstring", "s"), 0x2d: ("pushint", "i"), 0x2e: ("pushuint", "U"), 0x2f: ("pushdouble", "d"),
+    0x30: ("pushscope", ""), 0x31: ("pushnamespace", "n"), 0x32: ("hasnext2", "uu"),
+    0x35: ("li8", ""), 0x36: ("li16", ""), 0x37: ("li32", ""), 0x38: ("lf32", ""), 0x39: ("lf64", ""),
+    0x3a: ("si8", ""), 0x3b: ("si16", ""), 0x3c: ("si32", ""), 0x3d: ("sf32", ""), 0x3e: ("sf64", ""),
+    0x40: ("newfunction", "M"), 0x41: ("call", "u"), 0x42: ("construct", "u"), 0x43: ("callmethod", "uu"),
+    0x44: ("callstatic", "Mu"), 0x45: ("callsuper", "mu"), 0x46: ("callproperty", "mu"), 0x47: ("returnvoid", ""),
+    0x48: ("returnvalue", ""), 0x49: ("constructsuper", "u"), 0x4a: ("constructprop", "mu"),
+    0x4c: ("callproplex", "mu"), 0x4e: ("callsupervoid", "mu"), 0x4f: ("callpropvoid", "mu"),
+    0x50: ("sxi1", ""), 0x51: ("sxi8", ""), 0x52: ("sxi16", ""), 0x53: ("applytype", "u"),
+    0x55: ("newobject", "u"), 0x56: ("newarray", "u"), 0x57: ("newactivation", ""), 0x58: ("newclass", "C"),
+    0x59: ("getdescendants", "m"), 0x5a: ("newcatch", "x"), 0x5d: ("findpropstrict", "m"),
+    0x5e: ("findproperty", "m"), 0x5f: ("finddef", "m"), 0x60: ("getlex", "m"), 0x61: ("setproperty", "m"),
+    0x62: ("getlocal", "u"), 0x63: ("setlocal", "u"), 0x64: ("getglobalscope", ""), 0x65: ("getscopeobject", "B"),
+    0x66: ("getproperty", "m"), 0x67: ("getouterscope", "u"), 0x68: ("initproperty", "m"),
+    0x6a: ("deleteproperty", "m"), 0x6c: ("getslot", "u"), 0x6d: ("setslot", "u"), 0x6e: ("getglobalslot", "u"),
+    0x6f: ("setglobalslot", "u"), 0x70: ("convert_s", ""), 0x71: ("esc_xelem", ""), 0x72: ("esc_xattr", ""),
+    0x73: ("convert_i", ""), 0x74: ("convert_u", ""), 0x75: ("convert_d", ""), 0x76: ("convert_b", ""),
+    0x77: ("convert_o", ""), 0x78: ("checkfilter", ""), 0x80: ("coerce", "m"), 0x81: ("coerce_b", ""),
+    0x82: ("coerce_a", ""), 0x83: ("coerce_i", ""), 0x84: ("coerce_d", ""), 0x85: ("coerce_s", ""),
+    0x86: ("astype", "m"), 0x87: ("astypelate", ""), 0x88: ("coerce_u", ""), 0x89: ("coerce_o", ""),
+    0x90: ("negate", ""), 0x91: ("increment", ""), 0x92: ("inclocal", "u"), 0x93: ("decrement", ""),
+    0x94: ("declocal", "u"), 0x95: ("typeof", ""), 0x96: ("not", ""), 0x97: ("bitnot", ""), 0xa0: ("add", ""),
+    0xa1: ("subtract", ""), 0xa2: ("multiply", ""), 0xa3: ("divide", ""), 0xa4: ("modulo", ""),
+    0xa5: ("lshift", ""), 0xa6: ("rshift", ""), 0xa7: ("urshift", ""), 0xa8: ("bitand", ""), 0xa9: ("bitor", ""),
+    0xaa: ("bitxor", ""), 0xab: ("equals", ""), 0xac: ("strictequals", ""), 0xad: ("lessthan", ""),
+    0xae: ("lessequals", ""), 0xaf: ("greaterthan", ""), 0xb0: ("greaterequals", ""), 0xb1: ("instanceof", ""),
+    0xb2: ("istype", "m"), 0xb3: ("istypelate", ""), 0xb4: ("in", ""), 0xc0: ("increment_i", ""),
+    0xc1: ("decrement_i", ""), 0xc2: ("inclocal_i", "u"), 0xc3: ("declocal_i", "u"), 0xc4: ("negate_i", ""),
+    0xc5: ("add_i", ""), 0xc6: ("subtract_i", ""), 0xc7: ("multiply_i", ""), 0xd0: ("getlocal0", ""),
+    0xd1: ("getlocal1", ""), 0xd2: ("getlocal2", ""), 0xd3: ("getlocal3", ""), 0xd4: ("setlocal0", ""),
+    0xd5: ("setlocal1", ""), 0xd6: ("setlocal2", ""), 0xd7: ("setlocal3", ""), 0xef: ("debug", "D"),
+    0xf0: ("debugline", "u"), 0xf1: ("debugfile", "s"), 0xf2: ("bkptline", "u"), 0xf3: ("timestamp", ""),
+}
+_OPCODES_BY_NAME = {name: (opcode, formats) for opcode, (name, formats) in _OPCODES.items()}
+
+# stack (pops, pushes) of the instructions with a fixed effect, used to size max_stack for patched code
+_STACK_EFFECTS = {}
+for _names, _effect in [
+    (["bkpt", "nop", "label", "kill", "jump", "returnvoid", "popscope", "swap", "inclocal", "declocal",
+      "inclocal_i", "declocal_i", "debug", "debugline", "debugfile", "bkptline", "timestamp", "dxns"], (0, 0)),
+    (["pushnull", "pushundefined", "pushbyte", "pushshort", "pushtrue", "pushfalse", "pushnan", "pushstring",
+      "pushint", "pushuint", "pushdouble", "pushnamespace", "getlocal", "getlocal0", "getlocal1", "getlocal2",
+      "getlocal3", "getglobalscope", "getscopeobject", "getouterscope", "newactivation", "newfunction",
+      "newcatch", "getglobalslot", "hasnext2", "finddef"], (0, 1)),
+    (["dup"], (1, 2)),
+    (["pop", "pushscope", "pushwith", "setlocal", "setlocal0", "setlocal1", "setlocal2", "setlocal3", "iftrue",
+      "iffalse", "lookupswitch", "returnvalue", "throw", "dxnslate", "setglobalslot"], (1, 0)),
+    (["ifnlt", "ifnle", "ifngt", "ifnge", "ifeq", "ifne", "iflt", "ifle", "ifgt", "ifge", "ifstricteq",
+      "ifstrictne", "setslot"], (2, 0)),
+    (["convert_s", "convert_i", "convert_u", "convert_d", "convert_b", "convert_o", "coerce", "coerce_b",
+      "coerce_a", "coerce_i", "coerce_d", "coerce_s", "coerce_u", "coerce_o", "astype", "istype", "negate",
+      "increment", "decrement", "typeof", "not", "bitnot", "increment_i", "decrement_i", "negate_i", "getslot",
+      "esc_xelem", "esc_xattr", "checkfilter", "newclass", "sxi1", "sxi8", "sxi16", "li8", "li16", "li32",
+      "lf32", "lf64"], (1, 1)),
+    (["add", "subtract", "multiply", "divide", "modulo", "lshift", "rshift", "urshift", "bitand", "bitor",
+      "bitxor", "equals", "strictequals", "lessthan", "lessequals", "greaterthan", "greaterequals", "instanceof",
+      "istypelate", "astypelate", "in", "add_i", "subtract_i", "multiply_i", "nextname", "nextvalue",
+      "hasnext"], (2, 1)),
+    (["si8", "si16", "si32", "sf32", "sf64"], (2, 0)),
+]:
+    for _name in _names:
+        _STACK_EFFECTS[_name] = _effect
+
+_NAMESPACE_KINDS = {
+    0x08: "Namespace", 0x16: "PackageNamespace", 0x17: "PackageInternalNs", 0x18: "ProtectedNamespace",
+    0x19: "ExplicitNamespace", 0x1a: "StaticProtectedNs", 0x05: "PrivateNamespace",
+}
+_NAMESPACE_KINDS_BY_NAME = {name: kind for kind, name in _NAMESPACE_KINDS.items()}
+_MULTINAME_KINDS = {
+    0x07: "QName", 0x0d: "QNameA", 0x0f: "RTQName", 0x10: "RTQNameA", 0x11: "RTQNameL", 0x12: "RTQNameLA",
+    0x09: "Multiname", 0x0e: "MultinameA", 0x1b: "MultinameL", 0x1c: "MultinameLA", 0x1d: "TypeName",
+}
+_MULTINAME_KINDS_BY_NAME = {name: kind for kind, name in _MULTINAME_KINDS.items()}
+_TRAIT_KINDS = {"slot": 0, "method": 1, "getter": 2, "setter": 3, "class": 4, "function": 5, "const": 6}
+
+_TOKEN = re.compile(r'\s*(?:("(?:[^"\\]|\\.)*")|([-+]?(?:\d[\w.+-]*|Infinity|NaN))|([A-Za-z_$][\w$]*)|(\S))')
+_STRING_ESCAPES = {"\\": "\\\\", '"': '\\"', "\n": "\\n", "\r": "\\r", "\t": "\\t"}
+_STRING_UNESCAPE = re.compile(r'\\(x[0-9a-fA-F]{2}|u[0-9a-fA-F]{4}|.)')
+
+
+def _u30(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _s24(value):
+    return (value & 0xffffff).to_bytes(3, "little")
+
+
+def _quote(string):
+    if string is None:
+        return "null"
+    if string.isprintable() and '"' not in string and "\\" not in string:
+        return '"' + string + '"'
+    return '"' + "".join(_STRING_ESCAPES.get(c, c if c >= " " else "\\x{:02X}".format(ord(c)))
+                         for c in string) + '"'
+
+
+def _unquote(literal):
+    def unescape(match):
+        escape = match.group(1)
+        if escape[0] in "xu" and len(escape) > 1:
+            return chr(int(escape[1:], 16))
+        return {"n": "\n", "r": "\r", "t": "\t"}.get(escape, escape)
+    return _STRING_UNESCAPE.sub(unescape, literal[1:-1])
+
+
+def _format_double(value):
+    if value != value:
+        return "NaN"
+    if value in (float("inf"), float("-inf")):
+        return "Infinity" if value > 0 else "-Infinity"
+    text = repr(value)
+    return text[:-2] if text.endswith(".0") else text
+
+
+def iter_lines(text):
+    """
+    Split a string, or an iterable of string chunks, into its lines
+    """
+    if isinstance(text, str):
+        yield from text.splitlines()
+        return
+    rest = ""
+    for chunk in text:
+        lines = (rest + chunk).split("\n")
+        rest = lines.pop()
+        yield from lines
+    if rest:
+        yield rest
+
+
+class _Reader:
+    def __init__(self, data, pos=0):
+        self.data = data
+        self.pos = pos
+
+    def u8(self):
+        self.pos += 1
+        return self.data[self.pos - 1]
+
+    def u16(self):
+        self.pos += 2
+        return self.data[self.pos - 2] | self.data[self.pos - 1] << 8
+
+    def u30(self):
+        result = 0
+        for shift in range(0, 35, 7):
+            byte = self.data[self.pos]
+            self.pos += 1
+            result |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                break
+        return result
+
+    def s32(self):
+        result = self.u30() & 0xffffffff
+        return result - (1 << 32) if result & 0x80000000 else result
+
+    def s24(self):
+        self.pos += 3
+        value = int.from_bytes(self.data[self.pos - 3:self.pos], "little")
+        return value - (1 << 24) if value & 0x800000 else value
+
+    def d64(self):
+        self.pos += 8
+        return struct.unpack_from("<d", self.data, self.pos - 8)[0]
+
+    def raw(self, size):
+        self.pos += size
+        return self.data[self.pos - size:self.pos]
+
+
+class _Label:
+    """
+    Branch target within a method body's code (a position between instructions). Compilers leave some dead jumps
+    past the end of the code, those are delta bytes after the end
+    """
+    __slots__ = ("delta",)
+
+    def __init__(self, delta=0):
+        self.delta = delta
+
+
+class _Pool:
+    """
+    One constant pool table: its values (index 0 is the implicit default) and their encoding, kept as read so that
+    an unmodified pool is written back byte for byte
+    """
+
+    def __init__(self, count_field):
+        self.values = [None]
+        self.raw = bytearray()
+        self._count_field = count_field  # 0 and 1 both mean an empty pool
+        self._indices = None
+
+    def index(self, key):
+        if self._indices is None:
+            self._indices = {}
+            for i in range(len(self.values) - 1, 0, -1):
+                self._indices[self.values[i]] = i
+        return self._indices.get(key)
+
+    def add(self, value, encoded):
+        self.index(value)
+        self.values.append(value)
+        self.raw += encoded
+        self._indices.setdefault(value, len(self.values) - 1)
+        return len(self.values) - 1
+
+    def tobytes(self):
+        count = len(self.values) if len(self.values) > 1 else self._count_field
+        return _u30(count) + self.raw
+
+
+class _Trait:
+    def __init__(self, raw, name, kind, method=None):
+        self.raw = raw
+        self.name = name
+        self.kind = kind
+        self.method = method  # method index of method/getter/setter traits
+
+
+class _Instance:
+    def __init__(self, head, name, iinit, traits):
+        self.head = head  # everything up to the traits, as read
+        self.name = name
+        self.iinit = iinit
+        self.traits = traits
+
+
+class _Class:
+    def __init__(self, cinit, traits):
+        self.cinit = cinit
+        self.traits = traits
+
+
+class _MethodBody:
+    def __init__(self, method, max_stack, local_count, init_scope_depth, max_scope_depth, code, exceptions,
+                 traits):
+        self.method = method
+        self.max_stack = max_stack
+        self.local_count = local_count
+        self.init_scope_depth = init_scope_depth
+        self.max_scope_depth = max_scope_depth
+        self.code = code
+        self.exceptions = exceptions  # (from, to, target, exc_type, var_name)
+        self.traits = traits  # raw, with the count
+
+    def tobytes(self):
+        out = bytearray()
+        for value in (self.method, self.max_stack, self.local_count, self.init_scope_depth, self.max_scope_depth,
+                      len(self.code)):
+            out += _u30(value)
+        out += self.code
+        out += _u30(len(self.exceptions))
+        for exception in self.exceptions:
+            for value in exception:
+                out += _u30(value)
+        out += self.traits
+        return bytes(out)
+
+
+class SwfFile:
+    """
+    Tags of an uncompressed (FWS) or zlib compressed (CWS) swf, with access to its ABC
+    """
+    __TAG_DO_ABC = 82
+    __TAG_DO_ABC1 = 72
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        signature = data[:3]
+        if signature == b"FWS":
+            body = data[8:]
+        elif signature == b"CWS":
+            body = zlib.decompress(data[8:])
+        else:
+            raise ValueError("Unsupported swf signature: " + repr(signature))
+        self.compressed = signature == b"CWS"
+        self.version = data[3]
+
+        header_size = (5 + 4 * (body[0] >> 3) + 7) // 8 + 4  # frame rect, frame rate and count
+        self._header = body[:header_size]
+        self.tags = []  # [code, data, long header]
+        pos = header_size
+        while pos < len(body):
+            code_and_length, = struct.unpack_from("<H", body, pos)
+            pos += 2
+            code, length = code_and_length >> 6, code_and_length & 0x3f
+            long_header = length == 0x3f
+            if long_header:
+                length, = struct.unpack_from("<I", body, pos)
+                pos += 4
+            self.tags.append([code, body[pos:pos + length], long_header])
+            pos += length
+
+        self._abc_tag = next((tag for tag in self.tags if tag[0] in (self.__TAG_DO_ABC, self.__TAG_DO_ABC1)), None)
+        if self._abc_tag is None:
+            raise ValueError("No DoABC tag in " + path)
+
+    def _abc_offset(self):
+        if self._abc_tag[0] == self.__TAG_DO_ABC1:
+            return 0
+        return self._abc_tag[1].index(b"\0", 4) + 1  # after the flags and the name
+
+    @property
+    def abc(self):
+        return self._abc_tag[1][self._abc_offset():]
+
+    @abc.setter
+    def abc(self, abc):
+        self._abc_tag[1] = self._abc_tag[1][:self._abc_offset()] + abc
+        self._abc_tag[2] = True
+
+    def body(self):
+        out = bytearray(self._header)
+        for code, data, long_header in self.tags:
+            if long_header or len(data) >= 0x3f:
+                out += struct.pack("<HI", code << 6 | 0x3f, len(data))
+            else:
+                out += struct.pack("<H", code << 6 | len(data))
+            out += data
+        return bytes(out)
+
+    def save(self, path):
+        body = self.body()
+        header = (b"CWS" if self.compressed else b"FWS") + struct.pack("<BI", self.version, 8 + len(body))
+        with open(path, "wb") as f:
+            f.write(header)
+            f.write(zlib.compress(body) if self.compressed else body)
+
+
+class AbcFile:
+    """
+    Parsed ABC. Constant pools, method signatures, instances, classes and method bodies can be appended to and
+    patched; everything else is carried over as read
+    """
+
+    def __init__(self, data):
+        r = _Reader(data)
+        self.minor_version = r.u16()
+        self.major_version = r.u16()
+
+        self.ints = self._read_pool(r, lambda: r.s32())
+        self.uints = self._read_pool(r, lambda: r.u30())
+        self.doubles = self._read_pool(r, lambda: r.raw(8))  # kept as their bytes, so -0.0 and NaN stay distinct
+        self.strings = self._read_pool(r, lambda: r.raw(r.u30()).decode("utf-8", "surrogateescape"))
+        self.namespaces = self._read_pool(r, lambda: (r.u8(), r.u30()))
+        self.ns_sets = self._read_pool(r, lambda: tuple(r.u30() for _ in range(r.u30())))
+        self.multinames = self._read_pool(r, lambda: self._read_multiname(r))
+        # private namespaces are distinct even if they look alike
+        for i, (kind, _) in enumerate(self.namespaces.values[1:], 1):
+            if kind == 0x05:
+                self.namespaces.values[i] = (kind, "#" + str(i))
+        self.namespaces._indices = None
+
+        self.method_count = r.u30()
+        start = r.pos
+        for _ in range(self.method_count):
+            param_count = r.u30()
+            for _ in range(param_count + 1):
+                r.u30()  # return and param types
+            r.u30()  # name
+            flags = r.u8()
+            if flags & 0x08:  # HAS_OPTIONAL
+                for _ in range(r.u30()):
+                    r.u30()
+                    r.u8()
+            if flags & 0x80:  # HAS_PARAM_NAMES
+                for _ in range(param_count):
+                    r.u30()
+        self._methods = bytearray(data[start:r.pos])
+
+        start = r.pos
+        for _ in range(r.u30()):
+            r.u30()
+            for _ in range(2 * r.u30()):
+                r.u30()
+        self._metadata = data[start:r.pos]
+
+        class_count = r.u30()
+        self.instances = []
+        for _ in range(class_count):
+            start = r.pos
+            name = r.u30()
+            r.u30()  # super name
+            if r.u8() & 0x08:  # CONSTANT_ClassProtectedNs
+                r.u30()
+            for _ in range(r.u30()):
+                r.u30()
+            iinit = r.u30()
+            head = data[start:r.pos]
+            self.instances.append(_Instance(head, name, iinit, self._read_traits(r)))
+        self.classes = [_Class(r.u30(), self._read_traits(r)) for _ in range(class_count)]
+
+        start = r.pos
+        for _ in range(r.u30()):
+            r.u30()
+            self._read_traits(r)
+        self._scripts = data[start:r.pos]
+
+        self.method_bodies = []
+        for _ in range(r.u30()):
+            header = [r.u30() for _ in range(5)]
+            code = r.raw(r.u30())
+            exceptions = [tuple(r.u30() for _ in range(5)) for _ in range(r.u30())]
+            start = r.pos
+            self._read_traits(r)
+            self.method_bodies.append(_MethodBody(*header, code, exceptions, data[start:r.pos]))
+        self._bodies_by_method = {body.method: body for body in self.method_bodies}
+        self._formatted = {}  # instruction -> rabcdasm syntax, pool indices never change meaning
+
+        if r.pos != len(data):
+            raise ValueError("Trailing data after the method bodies")
+
+    @staticmethod
+    def _read_pool(r, read_value):
+        count = r.u30()
+        pool = _Pool(count)
+        start = r.pos
+        for _ in range(max(count - 1, 0)):
+            pool.values.append(read_value())
+        pool.raw = bytearray(r.data[start:r.pos])
+        return pool
+
+    @staticmethod
+    def _read_multiname(r):
+        kind = r.u8()
+        if kind in (0x07, 0x0d, 0x09, 0x0e):  # QName(A): ns, name; Multiname(A): name, ns set
+            return kind, r.u30(), r.u30()
+        if kind in (0x0f, 0x10, 0x1b, 0x1c):  # RTQName(A): name; MultinameL(A): ns set
+            return kind, r.u30()
+        if kind in (0x11, 0x12):
+            return kind,
+        if kind == 0x1d:
+            return kind, r.u30(), tuple(r.u30() for _ in range(r.u30()))
+        raise ValueError("Unknown multiname kind: " + hex(kind))
+
+    @staticmethod
+    def _read_traits(r):
+        traits = []
+        for _ in range(r.u30()):
+            start = r.pos
+            name = r.u30()
+            kind = r.u8()
+            method = None
+            if kind & 0x0f in (0, 6):  # slot, const
+                r.u30()
+                r.u30()
+                if r.u30():
+                    r.u8()
+            elif kind & 0x0f in (1, 2, 3):  # method, getter, setter
+                r.u30()
+                method = r.u30()
+            elif kind & 0x0f in (4, 5):  # class, function
+                r.u30()
+                r.u30()
+            else:
+                raise ValueError("Unknown trait kind: " + hex(kind))
+            if kind & 0x40:  # ATTR_Metadata
+                for _ in range(r.u30()):
+                    r.u30()
+            traits.append(_Trait(r.data[start:r.pos], name, kind & 0x0f, method))
+        return traits
+
+    @staticmethod
+    def _traits_bytes(traits):
+        return _u30(len(traits)) + b"".join(trait.raw for trait in traits)
+
+    def tobytes(self):
+        out = bytearray(struct.pack("<HH", self.minor_version, self.major_version))
+        for pool in (self.ints, self.uints, self.doubles, self.strings, self.namespaces, self.ns_sets,
+                     self.multinames):
+            out += pool.tobytes()
+        out += _u30(self.method_count) + self._methods
+        out += self._metadata
+        out += _u30(len(self.instances))
+        for instance in self.instances:
+            out += instance.head + self._traits_bytes(instance.traits)
+        for cls in self.classes:
+            out += _u30(cls.cinit) + self._traits_bytes(cls.traits)
+        out += self._scripts
+        out += _u30(len(self.method_bodies))
+        for body in self.method_bodies:
+            out += body.tobytes()
+        return bytes(out)
+
+    # constant pool lookups, adding the constant if it is missing
+
+    def string_index(self, string):
+        if string is None:
+            return 0
+        index = self.strings.index(string)
+        if index is None:
+            encoded = string.encode("utf-8", "surrogateescape")
+            index = self.strings.add(string, _u30(len(encoded)) + encoded)
+        return index
+
+    def namespace_index(self, kind, name, private_id=None):
+        if kind == 0x05 and private_id is not None and private_id.startswith("#"):
+            return int(private_id[1:])
+        key = (kind, self.string_index(name))
+        index = self.namespaces.index(key) if kind != 0x05 else None
+        if index is None:
+            index = self.namespaces.add(key, bytes((kind,)) + _u30(key[1]))
+        return index
+
+    def ns_set_index(self, namespaces):
+        key = tuple(namespaces)
+        index = self.ns_sets.index(key)
+        if index is None:
+            index = self.ns_sets.add(key, _u30(len(key)) + b"".join(_u30(x) for x in key))
+        return index
+
+    def multiname_index(self, multiname):
+        index = self.multinames.index(multiname)
+        if index is None:
+            encoded = bytes((multiname[0],))
+            for value in multiname[1:]:
+                encoded += _u30(len(value)) + b"".join(_u30(x) for x in value) if isinstance(value, tuple) \
+                    else _u30(value)
+            index = self.multinames.add(multiname, encoded)
+        return index
+
+    def int_index(self, value):
+        index = self.ints.index(value)
+        return index if index is not None else self.ints.add(value, _u30(value & 0xffffffff))
+
+    def uint_index(self, value):
+        index = self.uints.index(value)
+        return index if index is not None else self.uints.add(value, _u30(value))
+
+    def double_index(self, value):
+        key = struct.pack("<d", value)
+        index = self.doubles.index(key)
+        return index if index is not None else self.doubles.add(key, key)
+
+    # rabcdasm style rendering
+
+    def format_namespace(self, index):
+        if index == 0:
+            return "*"
+        kind, name = self.namespaces.values[index]
+        if kind == 0x05:
+            return 'PrivateNamespace(null, "' + name + '")'
+        return _NAMESPACE_KINDS.get(kind, "Namespace") + "(" + _quote(self.strings.values[name]) + ")"
+
+    def format_multiname(self, index):
+        if index == 0:
+            return "null"
+        multiname = self.multinames.values[index]
+        kind = multiname[0]
+        if kind in (0x07, 0x0d):
+            args = self.format_namespace(multiname[1]) + ", " + _quote(self.strings.values[multiname[2]])
+        elif kind in (0x09, 0x0e):
+            args = _quote(self.strings.values[multiname[1]]) + ", " + self._format_ns_set(multiname[2])
+        elif kind in (0x0f, 0x10):
+            args = _quote(self.strings.values[multiname[1]])
+        elif kind in (0x1b, 0x1c):
+            args = self._format_ns_set(multiname[1])
+        elif kind == 0x1d:
+            return "TypeName(" + self.format_multiname(multiname[1]) + "<" + \
+                   ", ".join(self.format_multiname(x) for x in multiname[2]) + ">)"
+        else:
+            args = ""
+        return _MULTINAME_KINDS[kind] + "(" + args + ")"
+
+    def _format_ns_set(self, index):
+        return "[" + ", ".join(self.format_namespace(x) for x in self.ns_sets.values[index]) + "]"
+
+    def _runtime_name_count(self, index):
+        kind = self.multinames.values[index][0] if index else 0x07
+        return {0x0f: 1, 0x10: 1, 0x11: 2, 0x12: 2, 0x1b: 1, 0x1c: 1}.get(kind, 0)
+
+    # code
+
+    def decode_code(self, body):
+        """
+        Decode a method body's code into a list of (opcode, operands) instructions and the _Labels they branch to,
+        plus its exceptions with their offsets as _Labels
+        """
+        code = body.code
+        r = _Reader(code)
+        decoded = []
+        targets = {offset for exception in body.exceptions for offset in exception[:3]}
+        while r.pos < len(code):
+            offset = r.pos
+            opcode = r.u8()
+            if opcode not in _OPCODES:
+                raise ValueError("Unknown opcode {} at {} in method {}".format(hex(opcode), offset, body.method))
+            operands = []
+            for f in _OPCODES[opcode][1]:
+                if f == "j":
+                    target = r.s24() + r.pos
+                    operands.append(target)
+                    targets.add(target)
+                elif f == "L":
+                    default = offset + r.s24()
+                    cases = tuple(offset + r.s24() for _ in range(r.u30() + 1))
+                    operands.extend((default, cases))
+                    targets.add(default)
+                    targets.update(cases)
+                elif f == "D":
+                    operands.extend((r.u8(), r.u30(), r.u8(), r.u30()))
+                elif f in "bB":
+                    operands.append(r.u8())
+                else:
+                    operands.append(r.u30())
+            decoded.append((offset, opcode, operands))
+
+        if not targets <= {offset for offset, _, _ in decoded} | set(range(len(code), max(targets, default=0) + 1)):
+            raise ValueError("Branch into the middle of an instruction in method " + str(body.method))
+        labels = {offset: _Label(max(offset - len(code), 0)) for offset in sorted(targets)}
+        items = []
+        for offset, opcode, operands in decoded:
+            if offset in labels:
+                items.append(labels[offset])
+            if _OPCODES[opcode][1] in ("j", "L"):
+                operands = [labels[x] if isinstance(x, int) else tuple(labels[y] for y in x) for x in operands]
+            items.append((opcode, tuple(operands)))
+        items += [labels[offset] for offset in sorted(labels) if offset >= len(code)]
+
+        exceptions = [tuple(labels[x] for x in exception[:3]) + exception[3:] for exception in body.exceptions]
+        return items, exceptions
+
+    @staticmethod
+    def _encode_instruction(opcode, operands, offset=None, label_offsets=None):
+        out = bytearray((opcode,))
+        formats = _OPCODES[opcode][1]
+        if formats == "j":
+            out += _s24(label_offsets[operands[0]] - offset - 4 if label_offsets else 0)
+        elif formats == "L":
+            default, cases = operands
+            out += _s24(label_offsets[default] - offset if label_offsets else 0)
+            out += _u30(len(cases) - 1)
+            for case in cases:
+                out += _s24(label_offsets[case] - offset if label_offsets else 0)
+        else:
+            for f, operand in zip(formats.replace("D", "BuBu"), operands):
+                out += bytes((operand & 0xff,)) if f in "bB" else _u30(operand)
+        return bytes(out)
+
+    def encode_code(self, body, items, exceptions):
+        """
+        Inverse of decode_code, resolving the labels to offsets
+        """
+        encoded = {}  # instructions repeat a lot in generated code
+
+        def encode(item):
+            data = encoded.get(item)
+            if data is None:
+                data = encoded[item] = self._encode_instruction(*item)
+            return data
+
+        label_offsets = {}
+        offset = 0
+        for item in items:
+            if isinstance(item, _Label):
+                label_offsets[item] = offset + item.delta
+            else:
+                offset += len(encode(item)) if _OPCODES[item[0]][1] not in ("j", "L") else \
+                    len(self._encode_instruction(*item))
+
+        out = bytearray()
+        for item in items:
+            if isinstance(item, _Label):
+                continue
+            if _OPCODES[item[0]][1] in ("j", "L"):
+                out += self._encode_instruction(*item, len(out), label_offsets)
+            else:
+                out += encode(item)
+        body.code = bytes(out)
+        body.exceptions = [tuple(label_offsets[x] for x in exception[:3]) + exception[3:]
+                           for exception in exceptions]
+
+    def format_instruction(self, item, label_names):
+        """
+        An instruction (or label) in rabcdasm syntax
+        """
+        if isinstance(item, _Label):
+            return label_names[item] + ":"
+        text = self._formatted.get(item)
+        if text is not None:
+            return text
+        opcode, operands = item
+        name, formats = _OPCODES[opcode]
+        if formats == "j":
+            return name + " " + label_names[operands[0]]
+        if formats == "L":
+            return name + " " + label_names[operands[0]] + ", [" + \
+                   ", ".join(label_names[x] for x in operands[1]) + "]"
+        if formats == "D":
+            return name + " " + ", ".join((str(operands[0]), _quote(self.strings.values[operands[1]]),
+                                           str(operands[2]), str(operands[3])))
+        args = []
+        for f, operand in zip(formats, operands):
+            if f == "m":
+                args.append(self.format_multiname(operand))
+            elif f == "s":
+                args.append(_quote(self.strings.values[operand]))
+            elif f == "n":
+                args.append(self.format_namespace(operand))
+            elif f == "i":
+                args.append(str(self.ints.values[operand]))
+            elif f == "U":
+                args.append(str(self.uints.values[operand]))
+            elif f == "d":
+                args.append(_format_double(struct.unpack("<d", self.doubles.values[operand])[0]))
+            elif f == "b":
+                args.append(str(operand - 256 if operand & 0x80 else operand))
+            elif f == "h":
+                operand &= 0xffff
+                args.append(str(operand - 0x10000 if operand & 0x8000 else operand))
+            else:
+                args.append(str(operand))
+        text = self._formatted[item] = name + (" " + ", ".join(args) if args else "")
+        return text
+
+    def format_code(self, items):
+        label_names = {}
+        for item in items:
+            if isinstance(item, _Label):
+                label_names[item] = "L" + str(len(label_names))
+        for item in items:
+            if not isinstance(item, _Label):
+                for operand in item[1]:
+                    for label in (operand if isinstance(operand, tuple) else (operand,)):
+                        if isinstance(label, _Label) and label not in label_names:
+                            label_names[label] = "L" + str(len(label_names))
+        return [self.format_instruction(item, label_names) for item in items]
+
+    def assemble(self, lines):
+        """
+        Assemble rabcdasm syntax instructions and labels (one per line) into instructions and _Labels
+        """
+        items = []
+        labels = {}
+        parsed = {}  # instructions repeat a lot in generated code
+
+        def label(name):
+            if name not in labels:
+                labels[name] = _Label()
+            return labels[name]
+
+        for line in lines:
+            line = line.split(";", 1)[0].strip() if ";" in line and '"' not in line else line.strip()
+            if not line:
+                continue
+            if line.endswith(":") and " " not in line:
+                items.append(label(line[:-1]))
+                continue
+
+            item = parsed.get(line)
+            if item is None:
+                name, _, args = line.partition(" ")
+                if name not in _OPCODES_BY_NAME:
+                    raise ValueError("Unknown instruction: " + line)
+                opcode, formats = _OPCODES_BY_NAME[name]
+                p = _AsmParser(self, args)
+                operands = []
+                for i, f in enumerate(formats):
+                    if i > 0:
+                        p.expect(",")
+                    if f == "j":
+                        operands.append(label(p.identifier()))
+                    elif f == "L":
+                        operands.append(label(p.identifier()))
+                        p.expect(",")
+                        operands.append(tuple(label(x) for x in p.list(p.identifier)))
+                    elif f == "D":
+                        operands.append(p.integer())
+                        p.expect(",")
+                        operands.append(self.string_index(p.string()))
+                        p.expect(",")
+                        operands.append(p.integer())
+                        p.expect(",")
+                        operands.append(p.integer())
+                    elif f == "m":
+                        operands.append(p.multiname())
+                    elif f == "s":
+                        operands.append(self.string_index(p.string()))
+                    elif f == "n":
+                        operands.append(p.namespace())
+                    elif f == "i":
+                        operands.append(self.int_index(p.integer()))
+                    elif f == "U":
+                        operands.append(self.uint_index(p.integer()))
+                    elif f == "d":
+                        operands.append(self.double_index(p.number()))
+                    elif f in "bB":
+                        operands.append(p.integer() & 0xff)
+                    elif f == "h":
+                        operands.append(p.integer() & 0xffff)
+                    else:
+                        operands.append(p.integer())
+                p.end()
+                item = (opcode, tuple(operands))
+                if formats not in ("j", "L"):
+                    parsed[line] = item
+            items.append(item)
+        return items
+
+    def stack_effect(self, item):
+        """
+        (pops, pushes) of an instruction
+        """
+        opcode, operands = item
+        name, formats = _OPCODES[opcode]
+        if name in _STACK_EFFECTS:
+            return _STACK_EFFECTS[name]
+        runtime = self._runtime_name_count(operands[0]) if formats.startswith("m") else 0
+        if name in ("getproperty", "getdescendants", "getsuper"):
+            return 1 + runtime, 1
+        if name in ("setproperty", "initproperty", "setsuper"):
+            return 2 + runtime, 0
+        if name == "deleteproperty":
+            return 1 + runtime, 1
+        if name in ("findpropstrict", "findproperty", "getlex"):
+            return runtime, 1
+        if name in ("callproperty", "callproplex", "callsuper", "constructprop"):
+            return operands[1] + 1 + runtime, 1
+        if name in ("callpropvoid", "callsupervoid"):
+            return operands[1] + 1 + runtime, 0
+        if name in ("callmethod", "callstatic", "construct"):
+            return operands[-1] + 1, 1
+        if name == "call":
+            return operands[0] + 2, 1
+        if name == "constructsuper":
+            return operands[0] + 1, 0
+        if name == "newarray":
+            return operands[0], 1
+        if name == "newobject":
+            return 2 * operands[0], 1
+        if name == "applytype":
+            return operands[0] + 1, 1
+        raise ValueError("Unknown stack effect of " + name)
+
+    def max_stack_of(self, items):
+        """
+        Peak stack depth reached by straight-line code, relative to the depth it starts at
+        """
+        depth = 0
+        peak = 0
+        for item in items:
+            if not isinstance(item, _Label):
+                pops, pushes = self.stack_effect(item)
+                depth += pushes - pops
+                peak = max(peak, depth)
+        return peak
+
+    @staticmethod
+    def max_local_of(items):
+        registers = [-1]
+        for item in items:
+            if not isinstance(item, _Label):
+                name = _OPCODES[item[0]][0]
+                if name[-1].isdigit() and name[:-1] in ("getlocal", "setlocal"):
+                    registers.append(int(name[-1]))
+                elif name in ("getlocal", "setlocal", "kill", "inclocal", "declocal", "inclocal_i", "declocal_i"):
+                    registers.append(item[1][0])
+        return max(registers)
+
+    # classes
+
+    def find_class(self, class_name):
+        """
+        Index of the class with the given (unqualified) name
+        """
+        for i, instance in enumerate(self.instances):
+            multiname = self.multinames.values[instance.name]
+            if multiname[0] in (0x07, 0x0d) and self.strings.values[multiname[2]] == class_name:
+                return i
+        raise KeyError("No class named " + class_name)
+
+    def class_methods(self, class_name):
+        """
+        Method indices of a class, in the order rabcdasm lays them out in the class's asasm file
+        """
+        i = self.find_class(class_name)
+        methods = [self.instances[i].iinit]
+        methods += [trait.method for trait in self.instances[i].traits if trait.method is not None]
+        methods.append(self.classes[i].cinit)
+        methods += [trait.method for trait in self.classes[i].traits if trait.method is not None]
+        return methods
+
+    def method_body(self, method):
+        return self._bodies_by_method.get(method)
+
+    def apply_patches(self, class_name, patches):
+        """
+        Apply patches (see patcher.Patch) to the code of a class in one pass over its methods, in the order rabcdasm
+        lays them out. A patch cannot span methods. Returns the patches that could not be applied, as
+        (class name, patch, reason); the class is left untouched if there are any
+        """
+        matcher = PatchMatcher(patches)
+        edits = []
+        for method in self.class_methods(class_name):
+            body = self.method_body(method)
+            if matcher.done:
+                break
+            if body is None:
+                continue
+
+            items, exceptions = self.decode_code(body)
+            new_items = []
+            removed = set()
+            inserted = []
+            for item, line in zip(items, self.format_code(items)):
+                keep, patch = matcher.feed(line)
+                if keep:
+                    new_items.append(item)
+                elif isinstance(item, _Label):
+                    removed.add(item)
+                if patch is not None:
+                    inserted.append(self.assemble(iter_lines(patch.replacement)))
+                    new_items += inserted[-1]
+            matcher.reset()
+
+            if removed:
+                used = set(label for exception in exceptions for label in exception[:3])
+                for item in new_items:
+                    if not isinstance(item, _Label):
+                        for operand in item[1]:
+                            used.update(operand if isinstance(operand, tuple) else (operand,))
+                if removed & used:
+                    raise ValueError("Patch removes a branch target of method " + str(method))
+            if inserted or len(new_items) != len(items):
+                edits.append((body, new_items, exceptions, inserted))
+
+        missing = matcher.missing(class_name)
+        if missing:
+            return missing
+        for body, new_items, exceptions, inserted in edits:
+            self.encode_code(body, new_items, exceptions)
+            # the stack depth at each insertion point is at most the old max_stack
+            body.max_stack += sum(self.max_stack_of(x) for x in inserted)
+            body.local_count = max([body.local_count] + [self.max_local_of(x) + 1 for x in inserted])
+        return []
+
+    def add_method(self, param_types, return_type=0, name=0):
+        """
+        Append a method signature (multiname indices), returning its method index
+        """
+        self._methods += _u30(len(param_types)) + _u30(return_type) + \
+            b"".join(_u30(x) for x in param_types) + _u30(name) + b"\0"
+        self.method_count += 1
+        return self.method_count - 1
+
+    def add_method_body(self, method, max_stack, local_count, init_scope_depth, max_scope_depth, items):
+        body = _MethodBody(method, max_stack, local_count, init_scope_depth, max_scope_depth, b"", [], _u30(0))
+        self.encode_code(body, items, [])
+        self.method_bodies.append(body)
+        self._bodies_by_method[method] = body
+        return body
+
+    def add_instance_traits(self, class_name, asasm):
+        """
+        Add the method, getter and setter traits declared in asasm (rabcdasm syntax, a string or an iterable of
+        string chunks) to the instances of a class
+        """
+        instance = self.instances[self.find_class(class_name)]
+        lines = iter_lines(asasm)
+        for line in lines:
+            words = line.split(None, 2)
+            if not words:
+                continue
+            if words[0] != "trait" or len(words) < 3 or words[1] not in ("method", "getter", "setter"):
+                raise ValueError("Unsupported trait: " + line)
+            name = _AsmParser(self, words[2]).multiname()
+            method, body_fields, items = self._parse_method(lines)
+            self.add_method_body(method, *body_fields, items)
+            # disp_id 0, the method
+            raw = _u30(name) + bytes((_TRAIT_KINDS[words[1]],)) + _u30(0) + _u30(method)
+            instance.traits.append(_Trait(raw, name, _TRAIT_KINDS[words[1]], method))
+            if next(lines).strip() != "end ; trait":
+                raise ValueError("Expected the end of the trait")
+
+    def _parse_method(self, lines):
+        if next(lines).strip() != "method":
+            raise ValueError("Expected a method")
+        param_types = []
+        return_type = 0
+        name = 0
+        body_fields = {}
+        items = None
+        for line in lines:
+            key, _, value = line.strip().partition(" ")
+            if key == "param":
+                param_types.append(_AsmParser(self, value).multiname())
+            elif key == "returns":
+                return_type = _AsmParser(self, value).multiname()
+            elif key == "name":
+                name = self.string_index(_AsmParser(self, value).string())
+            elif key == "refid":
+                pass
+            elif key == "body":
+                for body_line in lines:
+                    key, _, value = body_line.strip().partition(" ")
+                    if key in ("maxstack", "localcount", "initscopedepth", "maxscopedepth"):
+                        body_fields[key] = int(value)
+                    elif key == "code":
+                        items = self.assemble(iter(lambda: next(lines).strip(), "end ; code"))
+                    elif body_line.strip() == "end ; body":
+                        break
+                    elif key:
+                        raise ValueError("Unsupported method body line: " + body_line)
+            elif line.strip() == "end ; method":
+                break
+            elif key:
+                raise ValueError("Unsupported method line: " + line)
+
+        if items is None:
+            raise ValueError("Method without code")
+        method = self.add_method(param_types, return_type, name)
+        return method, (body_fields.get("maxstack", self.max_stack_of(items)),
+                        body_fields.get("localcount", len(param_types) + 1),
+                        body_fields.get("initscopedepth", 0),
+                        body_fields.get("maxscopedepth", 1)), items
+
+
+class _AsmParser:
+    """
+    Parser of instruction operands in rabcdasm syntax, adding the constants they name to an AbcFile
+    """
+
+    def __init__(self, abc, text):
+        self.abc = abc
+        self.tokens = []
+        for match in _TOKEN.finditer(text):
+            self.tokens.append(next(x for x in match.groups() if x is not None))
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def next(self):
+        token = self.peek()
+        if token is None:
+            raise ValueError("Unexpected end of operands")
+        self.pos += 1
+        return token
+
+    def expect(self, token):
+        if self.next() != token:
+            raise ValueError("Expected " + token + " in " + " ".join(self.tokens))
+
+    def end(self):
+        if self.peek() is not None:
+            raise ValueError("Unexpected " + self.peek() + " in " + " ".join(self.tokens))
+
+    def identifier(self):
+        return self.next()
+
+    def integer(self):
+        return int(self.next())
+
+    def number(self):
+        token = self.next()
+        return float(token.replace("Infinity", "inf").replace("NaN", "nan"))
+
+    def string(self):
+        token = self.next()
+        if token == "null":
+            return None
+        if not token.startswith('"'):
+            raise ValueError("Expected a string, got " + token)
+        return _unquote(token)
+
+    def list(self, parse_item):
+        self.expect("[")
+        values = []
+        while self.peek() != "]":
+            if values:
+                self.expect(",")
+            values.append(parse_item())
+        self.next()
+        return values
+
+    def namespace(self):
+        kind = self.next()
+        if kind not in _NAMESPACE_KINDS_BY_NAME:
+            raise ValueError("Unknown namespace kind: " + kind)
+        self.expect("(")
+        name = self.string()
+        private_id = None
+        if self.peek() == ",":
+            self.next()
+            private_id = self.string()
+        self.expect(")")
+        return self.abc.namespace_index(_NAMESPACE_KINDS_BY_NAME[kind], name, private_id)
+
+    def ns_set(self):
+        return self.abc.ns_set_index(self.list(self.namespace))
+
+    def multiname(self):
+        kind_name = self.next()
+        if kind_name == "null":
+            return 0
+        if kind_name not in _MULTINAME_KINDS_BY_NAME:
+            raise ValueError("Unknown multiname kind: " + kind_name)
+        kind = _MULTINAME_KINDS_BY_NAME[kind_name]
+        self.expect("(")
+        if kind in (0x07, 0x0d):
+            ns = self.namespace()
+            self.expect(",")
+            multiname = (kind, ns, self.abc.string_index(self.string()))
+        elif kind in (0x09, 0x0e):
+            name = self.abc.string_index(self.string())
+            self.expect(",")
+            multiname = (kind, name, self.ns_set())
+        elif kind in (0x0f, 0x10):
+            multiname = (kind, self.abc.string_index(self.string()))
+        elif kind in (0x1b, 0x1c):
+            multiname = (kind, self.ns_set())
+        elif kind == 0x1d:
+            name = self.multiname()
+            self.expect("<")
+            params = [self.multiname()]
+            while self.peek() == ",":
+                self.next()
+                params.append(self.multiname())
+            self.expect(">")
+            multiname = (kind, name, tuple(params))
+        else:
+            multiname = (kind,)
+        self.expect(")")
+        return self.abc.multiname_index(multiname)
+
+
+def check_round_trip(swf_path):
+    """
+    Whether a swf's tags and ABC are written back exactly as read
+    """
+    swf = SwfFile(swf_path)
+    with open(swf_path, "rb") as f:
+        data = f.read()
+    original_body = zlib.decompress(data[8:]) if swf.compressed else data[8:]
+    return AbcFile(swf.abc).tobytes() == swf.abc and swf.body() == original_body
+
+
+def dump_class(swf_path, class_name):
+    """
+    The code of a class's methods in rabcdasm syntax, as a list of lines
+    """
+    abc = AbcFile(SwfFile(swf_path).abc)
+    lines = []
+    for method in abc.class_methods(class_name):
+        body = abc.method_body(method)
+        if body is not None:
+            lines.append("; method {} maxstack {} localcount {}".format(method, body.max_stack, body.local_count))
+            lines += abc.format_code(abc.decode_code(body)[0])
+    return lines
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Inspect the ABC of swf files")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    round_trip_parser = subparsers.add_parser("roundtrip", help="check that swfs are written back unchanged")
+    round_trip_parser.add_argument("swf", nargs="+")
+    dump_parser = subparsers.add_parser("dump", help="print the code of a class")
+    dump_parser.add_argument("swf")
+    dump_parser.add_argument("class_name")
+    args = parser.parse_args()
+
+    if args.command == "roundtrip":
+        for swf_path in args.swf:
+            print(("ok    " if check_round_trip(swf_path) else "FAIL  ") + swf_path)
+    else:
+        print("\n".join(dump_class(args.swf, args.class_name)))
@@ -0,0 +1,302 @@
+#!/bin/env python3
+"""
+Benchmark of the TAS build stages (parse, bytecode generation and asasm patching) on synthetic runs.
+With the rabcdasm backend the disassembled swf is stood in for by minimal asasm files holding the patch anchors,
+the abc backend patches the real base swf in-process. Either way no flash tooling is needed.
+--suite measures the parser, emitter and patcher throughput at several run scales (up to a full run) and can save
+the results as JSON and compare them to a previous run's, to track regressions.
+"""
+import argparse
+import json
+import os
+import sys
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+from mod import SwfModder, TasLevelParser
+import tracing
+
+LEVEL_ASASM = """\
+    iinit
+      body
+        code
+          getlocal0
+          pushdouble 0.0384615384615385
+          convert_d
+          setproperty QName(PackageNamespace(""), "m_timeStep")
+          getlocal0
+          findpropstrict QName(PackageNamespace(""), "Array")
+          pushnull
+          constructprop QName(PackageNamespace(""), "Array"), 0
+          constructprop QName(PackageNamespace(""), "Array"), 2
+          setproperty QName(PackageInternalNs(""), "pzPuzzleInputs")
+""" + "".join("""\
+          getlocal1
+          pushstring "{0}"
+          ifne L{1}
+          getlocal0
+          getlocal0
+          getproperty QName(PackageInternalNs(""), "pz{2}Inputs")
+          getlocal2
+          getproperty MultinameL([PackageNamespace("")])
+          coerce QName(PackageNamespace(""), "Array")
+          setproperty QName(PackageInternalNs(""), "pzInputs")
+        L{1}:
+""".format(level_type, i, level_type.title()) for i, level_type in enumerate(["puzzle", "speed", "adventure"])) + """\
+          returnvoid
+        end ; code
+      end ; body
+    end ; method
+    trait method QName(PackageNamespace(""), "Update")
+      method
+        body
+          code
+            getlocal0
+            getproperty QName(PackageInternalNs(""), "pzInputs")
+            callproperty Multiname("pop", [PackageNamespace("")]), 0
+            coerce QName(PackageNamespace(""), "Array")
+            setlocal 17
+""" + "".join("""\
+            getlocal0
+            getlocal 17
+            pushbyte {0}
+            getproperty MultinameL([PackageNamespace("")])
+            pushbyte 1
+            equals
+            setproperty QName(PackageInternalNs(""), "{1}")
+""".format(i, key) for i, key in enumerate(["u_pressed", "r_pressed", "l_pressed",
+                                            "u_pressed2", "r_pressed2", "l_pressed2"])) + """\
+            returnvoid
+          end ; code
+        end ; body
+      end ; method
+    end ; trait
+"""
+
+GAME_ASASM = """\
+    iinit
+      refid "Game/instance/init"
+      body
+        maxstack 6
+        localcount 2
+        initscopedepth 0
+        maxscopedepth 1
+        code
+          getlocal0
+          pushscope
+          debug               1, "_loc1_", 0, 118
+          getlocal0
+          findpropstrict QName(PackageNamespace(""), "Array")
+          constructprop QName(PackageNamespace(""), "Array"), 2
+          constructprop QName(PackageNamespace(""), "Array"), 2
+          setproperty QName(PackageInternalNs(""), "pzLevels")
+          returnvoid
+        end ; code
+      end ; body
+    end ; method
+"""
+
+
+def make_tas_level(path, frames, rand):
+    with open(path, "w") as f:
+        for character in ["fireboy:", "watergirl:"]:
+            f.write(character + "\n")
+            cur_time = 0
+            while cur_time < frames:
+                duration = rand.randint(1, 40)
+                commands = rand.sample(["u", "r", "l", "s"], rand.randint(1, 2))
+                f.write(", ".join(command + " " + str(duration) for command in commands) + "\n")
+                cur_time += duration
+            f.write("\n")
+
+
+def make_tas_tree(path, levels, frames, seed=0):
+    rand = random.Random(seed)
+    os.makedirs(os.path.join(path, "adventure"), exist_ok=True)
+    with open(os.path.join(path, "levels.txt"), "w") as f:
+        f.write("\n".join("1," + str(i + 1) for i in range(levels)))
+    for i in range(levels):
+        make_tas_level(os.path.join(path, "adventure", "{:02d}.txt".format(i + 1)), frames, rand)
+
+
+def make_abc_tree(path):
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, "level.class.asasm"), "w") as f:
+        f.write(LEVEL_ASASM)
+    with open(os.path.join(path, "Game.class.asasm"), "w") as f:
+        f.write(GAME_ASASM)
+
+
+def build(tas_path, abc_path, cache_path, input_mode, lazy_inputs, backend=SwfModder.BACKEND_RABCDASM):
+    m = SwfModder(os.path.join("swf", "fbwg-base-dev.swf"), os.path.join(abc_path, "fbwg-tas.swf"),
+                  tas_path=tas_path, input_mode=input_mode, lazy_inputs=lazy_inputs, cache_path=cache_path,
+                  backend=backend)
+    if backend == SwfModder.BACKEND_ABC:
+        os.makedirs(abc_path, exist_ok=True)
+        m.build()
+        return
+    make_abc_tree(abc_path)
+    m._abc_path = abc_path
+    m.mod_all()
+
+
+def bench(levels, seconds, fps, input_mode, lazy_inputs=False, backend=SwfModder.BACKEND_RABCDASM):
+    tmp = tempfile.mkdtemp(prefix="fbwg-bench-")
+    try:
+        tas_path = os.path.join(tmp, "tas")
+        abc_path = os.path.join(tmp, "abc")
+        cache_path = os.path.join(tmp, "cache")
+        make_tas_tree(tas_path, levels, seconds * fps)
+
+        tracemalloc.start()
+        build(tas_path, abc_path, cache_path, input_mode, lazy_inputs, backend)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        shutil.rmtree(cache_path)
+
+        start = time.perf_counter()
+        build(tas_path, abc_path, cache_path, input_mode, lazy_inputs, backend)
+        build_time = time.perf_counter() - start
+
+        # tweak a single level, the others come from the level cache
+        with open(os.path.join(tas_path, "adventure", "01.txt"), "a") as f:
+            f.write("u 1\n")
+        start = time.perf_counter()
+        build(tas_path, abc_path, cache_path, input_mode, lazy_inputs, backend)
+        rebuild_time = time.perf_counter() - start
+
+        output = "fbwg-tas.swf" if backend == SwfModder.BACKEND_ABC else "level.class.asasm"
+        output_size = os.path.getsize(os.path.join(abc_path, output))
+        print("backend={} mode={}{} levels={} frames/level={} build={:.3f}s rebuild={:.3f}s peak={:.1f}MiB "
+              "{}={:.1f}MiB".format(backend, input_mode, " (lazy)" if lazy_inputs else "", levels, seconds * fps,
+                                    build_time, rebuild_time, peak / 2 ** 20, output, output_size / 2 ** 20))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_scale(levels, seconds, fps):
+    """
+    Throughput and stage timings of one run scale, as {metric: value}: metrics ending in _per_s are better higher,
+    the others (_s, _mib) lower
+    """
+    tmp = tempfile.mkdtemp(prefix="fbwg-bench-")
+    try:
+        tas_path = os.path.join(tmp, "tas")
+        make_tas_tree(tas_path, levels, seconds * fps)
+        paths = [os.path.join(tas_path, "adventure", x) for x in sorted(os.listdir(os.path.join(tas_path, "adventure")))]
+        results = {}
+
+        start = time.perf_counter()
+        tas_levels = []
+        for path in paths:
+            t = TasLevelParser(path)
+            t.parse()
+            tas_levels.append(t)
+        parse_time = time.perf_counter() - start
+        frames = sum(t.length for t in tas_levels)
+        results["frames"] = frames
+        results["parse_frames_per_s"] = frames / parse_time
+        results["parse_mib_per_s"] = sum(os.path.getsize(x) for x in paths) / 2 ** 20 / parse_time
+
+        for name, emit in (("array", TasLevelParser.iter_asm), ("packed", TasLevelParser.iter_packed_asm)):
+            start = time.perf_counter()
+            size = sum(len(chunk) for t in tas_levels for chunk in emit(t))
+            emit_time = time.perf_counter() - start
+            results["emit_" + name + "_frames_per_s"] = frames / emit_time
+            results["emit_" + name + "_mib_per_s"] = size / 2 ** 20 / emit_time
+
+        for input_mode in SwfModder.INPUT_MODES:
+            abc_path = os.path.join(tmp, "abc-" + input_mode)
+            cache_path = os.path.join(tmp, "cache-" + input_mode)
+
+            # stage timings of a cold build, then its peak memory in a second one (tracemalloc slows it down)
+            tracer = tracing.enable(memory=False)
+            start = time.perf_counter()
+            try:
+                build(tas_path, abc_path, cache_path, input_mode, False)
+            finally:
+                tracing.disable()
+            results["build_" + input_mode + "_s"] = time.perf_counter() - start
+            summary = tracer.summary()
+            for stage in ["parse", "codegen", "patch"]:
+                results["build_" + input_mode + "_" + stage + "_s"] = summary.get(stage, {"wall": 0.0})["wall"]
+            patched_size = os.path.getsize(os.path.join(abc_path, "level.class.asasm"))
+            results["patch_" + input_mode + "_mib_per_s"] = \
+                patched_size / 2 ** 20 / results["build_" + input_mode + "_patch_s"]
+
+            shutil.rmtree(cache_path)
+            tracemalloc.start()
+            build(tas_path, abc_path, cache_path, input_mode, False)
+            results["build_" + input_mode + "_peak_mib"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+        return results
+    finally:
+        shutil.rmtree(tmp)
+
+
+def suite(scales, fps, baseline=None, tolerance=0.15):
+    """
+    Run bench_scale for each (levels, seconds) scale, comparing with the results of a previous suite if given.
+    Returns the results ({"levels x seconds": {metric: value}}) and the regressions beyond tolerance
+    """
+    results = {}
+    regressions = []
+    for levels, seconds in scales:
+        name = "{}x{}".format(levels, seconds)
+        results[name] = bench_scale(levels, seconds, fps)
+        print("{} levels x {}s ({} frames):".format(levels, seconds, results[name]["frames"]))
+        for metric, value in results[name].items():
+            if metric == "frames":
+                continue
+            line = "  {:32} {:14.3f}".format(metric, value)
+            base = (baseline or {}).get(name, {}).get(metric)
+            if base:
+                change = value / base - 1
+                worse = -change if metric.endswith("_per_s") else change
+                line += " {:+7.1%}".format(change)
+                if worse > tolerance:
+                    line += " REGRESSION"
+                    regressions.append((name, metric, base, value))
+            print(line)
+    return results, regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--levels", type=int, default=32)
+    parser.add_argument("--seconds", type=int, default=70)
+    parser.add_argument("--fps", type=int, default=25)
+    parser.add_argument("--input-mode", choices=SwfModder.INPUT_MODES + ["all"], default="all")
+    parser.add_argument("--lazy-inputs", action="store_true")
+    parser.add_argument("--backend", choices=SwfModder.BACKENDS, default=SwfModder.BACKEND_RABCDASM)
+    parser.add_argument("--trace", metavar="PATH",
+                        help="trace the build stages into PATH (Chrome trace JSON, or folded stacks if *.folded)")
+    parser.add_argument("--suite", action="store_true",
+                        help="measure parser/emitter/patcher throughput at several scales instead")
+    parser.add_argument("--scale", action="append", metavar="LEVELSxSECONDS",
+                        help="suite run scale (repeatable), default 1x10, 8x35 and 32x70 (a full run)")
+    parser.add_argument("--json", metavar="PATH", help="save the suite results to PATH")
+    parser.add_argument("--baseline", metavar="PATH",
+                        help="compare the suite results to a previous --json output, failing on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.15,
+                        help="relative slowdown reported as a regression (default 0.15)")
+    args = parser.parse_args()
+
+    if args.suite:
+        scales = [tuple(int(x) for x in scale.split("x")) for scale in args.scale or ["1x10", "8x35", "32x70"]]
+        baseline = None
+        if args.baseline:
+            with open(args.baseline, "r") as f:
+                baseline = json.load(f)
+        results, regressions = suite(scales, args.fps, baseline, args.tolerance)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=2)
+        sys.exit(1 if regressions else 0)
+
+    if args.trace:
+        tracing.enable(args.trace)
+    for input_mode in (SwfModder.INPUT_MODES if args.input_mode == "all" else [args.input_mode]):
+        bench(args.levels, args.seconds, args.fps, input_mode, args.lazy_inputs, args.backend)
@@ -0,0 +1,265 @@
+import os
+import json
+import time
+import shutil
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+
+class DiskCache:
+    """
+    Directory of cache entry files, bounded in total size with least-recently-used eviction.
+    Entries are tracked in an index.json next to them, and all entries are dropped when the version changes.
+    An instance can be shared between threads, and several instances (e.g. in other processes) can use the same
+    directory: index.json is only written under a lock file, merged with the changes the others saved meanwhile
+    """
+    __INDEX_FILE = "index.json"
+    __LOCK_FILE = "index.lock"
+    __ORPHAN_GRACE = 3600  # seconds an unindexed file must be left untouched for before it is deleted
+
+    def __init__(self, path, max_size, version=0):
+        self.path = path
+        self.max_size = max_size
+        self.version = version
+        self._index_path = os.path.join(self.path, self.__INDEX_FILE)
+        self._dirty = False
+        self._lock = threading.RLock()
+        self._lock_file = None
+        self._lock_depth = 0
+        self._added = set()  # keys put and removed since the index was last saved, to merge it with the saved one
+        self._removed = set()
+        self._saved_stamp = None  # identity of index.json when last loaded or saved
+
+        os.makedirs(self.path, exist_ok=True)
+        with self._lock, self._locked():
+            self._saved_stamp = self._index_stamp()
+            index = self._load_index()
+            if index is not None and index.get("version") == self.version:
+                self._index = index
+                self._remove_orphans()
+            else:
+                # missing or stale index, nothing in the directory can be trusted
+                self.clear()
+
+    def entry_path(self, key):
+        """
+        Path of the entry for key. Files staged in the directory for a later put() must be named after it with a
+        suffix containing ".tmp" (e.g. entry_path(key) + ".tmp.mkv"), so that they never collide with an entry.
+        Files that are not in the index are deleted when the directory is opened, but only once they have not been
+        modified for __ORPHAN_GRACE seconds, so that the ones still being written by other instances are kept
+        """
+        return os.path.join(self.path, key)
+
+    def get(self, key):
+        """
+        Path of the entry for key (marking it as used), or None if it is not cached
+        """
+        with self._lock:
+            entry = self._index["entries"].get(key)
+            if entry is None and self._refresh():
+                entry = self._index["entries"].get(key)
+            if entry is None:
+                return None
+            if not os.path.exists(self.entry_path(key)):
+                self.remove(key)
+                return None
+
+            # the new usage time is only persisted with the next change or flush
+            entry["last_used"] = time.time()
+            self._dirty = True
+            return self.entry_path(key)
+
+    def meta(self, key):
+        """
+        Metadata stored with the entry for key, or None if it is not cached
+        """
+        with self._lock:
+            entry = self._index["entries"].get(key)
+            if entry is None and self._refresh():
+                entry = self._index["entries"].get(key)
+            return None if entry is None else entry["meta"]
+
+    def put(self, key, src_path, meta=None):
+        """
+        Move the file or directory at src_path into the cache as the entry for key
+        """
+        with self._lock, self._locked():
+            if key in self._index["entries"]:
+                self._drop(key)
+            os.replace(src_path, self.entry_path(key))
+            self._index["entries"][key] = {
+                "size": self._size_of(self.entry_path(key)),
+                "last_used": time.time(),
+                "meta": meta if meta is not None else {}
+            }
+            self._added.add(key)
+            self._removed.discard(key)
+            self._save(keep=key)
+
+    @contextmanager
+    def write(self, key, mode="w", meta=None):
+        """
+        Open a new entry for key for writing; it is only added to the cache if the block completes
+        """
+        # unique per writer, the same entry can be written concurrently
+        tmp_path = "{}.{}-{}.tmp".format(self.entry_path(key), os.getpid(), threading.get_ident())
+        try:
+            with open(tmp_path, mode) as f:
+                yield f
+        except BaseException:
+            self._remove_path(tmp_path)
+            raise
+        self.put(key, tmp_path, meta)
+
+    def remove(self, key):
+        with self._lock, self._locked():
+            self._drop(key)
+            self._save()
+
+    def clear(self):
+        with self._lock, self._locked():
+            for name in os.listdir(self.path):
+                if name != self.__LOCK_FILE:
+                    self._remove_path(os.path.join(self.path, name))
+            self._index = {"version": self.version, "entries": {}}
+            self._added.clear()
+            self._removed.clear()
+            self._save()
+
+    def flush(self):
+        with self._lock:
+            if self._dirty:
+                self._save()
+
+    def total_size(self):
+        with self._lock:
+            return sum(entry["size"] for entry in self._index["entries"].values())
+
+    def _drop(self, key):
+        self._index["entries"].pop(key, None)
+        self._remove_path(self.entry_path(key))
+        self._removed.add(key)
+        self._added.discard(key)
+
+    def _evict(self, keep=None):
+        total_size = self.total_size()
+        if total_size <= self.max_size:
+            return
+        for key, entry in sorted(self._index["entries"].items(), key=lambda item: item[1]["last_used"]):
+            if total_size <= self.max_size:
+                break
+            if key != keep:
+                total_size -= entry["size"]
+                self._drop(key)
+
+    @contextmanager
+    def _locked(self):
+        """
+        Hold the lock file of the directory (reentrant, under self._lock)
+        """
+        if self._lock_depth == 0:
+            self._lock_file = open(os.path.join(self.path, self.__LOCK_FILE), "a+")
+            if fcntl is not None:
+                fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+            else:
+                self._lock_file.seek(0)
+                msvcrt.locking(self._lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        self._lock_depth += 1
+        try:
+            yield
+        finally:
+            self._lock_depth -= 1
+            if self._lock_depth == 0:
+                # closing the file releases the lock
+                self._lock_file.close()
+                self._lock_file = None
+
+    def _load_index(self):
+        try:
+            with open(self._index_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _index_stamp(self):
+        try:
+            st = os.stat(self._index_path)
+        except OSError:
+            return None
+        return st.st_ino, st.st_mtime_ns  # saves replace the file, so the inode changes even within a clock tick
+
+    def _refresh(self):
+        """
+        Merge the saved index if another instance changed it since, returns whether it did
+        """
+        if self._index_stamp() == self._saved_stamp:
+            return False
+        with self._locked():
+            self._merge()
+        return True
+
+    def _merge(self):
+        """
+        Fold the entries other instances saved since the index was loaded into it: their new and more recently used
+        entries, and the removal of the ones they dropped
+        """
+        self._saved_stamp = self._index_stamp()
+        saved = self._load_index()
+        if saved is None or saved.get("version") != self.version:
+            return
+        entries = self._index["entries"]
+        for key in list(entries):
+            if key not in saved["entries"] and key not in self._added:
+                del entries[key]
+        for key, entry in saved["entries"].items():
+            if key in self._removed:
+                continue
+            if key not in entries or entry["last_used"] > entries[key]["last_used"]:
+                entries[key] = entry
+
+    def _remove_orphans(self):
+        # files that are not in the index (interrupted puts, staging files of dead writers), but not the ones that may
+        # still be being written by another instance
+        stale = time.time() - self.__ORPHAN_GRACE
+        for name in os.listdir(self.path):
+            if name in self._index["entries"] or name in (self.__INDEX_FILE, self.__LOCK_FILE):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                if os.path.getmtime(path) < stale:
+                    self._remove_path(path)
+            except FileNotFoundError:
+                pass  # put or removed meanwhile
+
+    def _save(self, keep=None):
+        with self._locked():
+            self._merge()
+            self._evict(keep)
+            tmp_path = "{}.{}.tmp".format(self._index_path, os.getpid())
+            with open(tmp_path, "w") as f:
+                f.write(json.dumps(self._index))
+            os.replace(tmp_path, self._index_path)
+            self._saved_stamp = self._index_stamp()
+            self._added.clear()
+            self._removed.clear()
+            self._dirty = False
+
+    @staticmethod
+    def _size_of(path):
+        if os.path.isdir(path):
+            return sum(os.path.getsize(os.path.join(root, name))
+                       for root, _, names in os.walk(path) for name in names)
+        return os.path.getsize(path)
+
+    @staticmethod
+    def _remove_path(path):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
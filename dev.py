@@ -2,51 +2,303 @@
 import shutil
 import os
 import subprocess
-import signal
-import time
 import hashlib
+import json
+import math
+import functools
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import cv2
+import numpy as np
 from mod import SwfModder, TasLevelParser
-from util import click_swf
-
-def hash_file(filename):
-    h = hashlib.sha256()
-    b = bytearray(128*1024)
-    mv = memoryview(b)
-    with open(filename, 'rb', buffering=0) as f:
-        for n in iter(lambda: f.readinto(mv), 0):
-            h.update(mv[:n])
-    return h.hexdigest()
-
-def combine(vid1, vid2, preview=False):
-    path_out = os.path.join("rec", "out.mkv")
-
-    preview_part = "-t 3" if preview else ""
-    subprocess.run(('ffmpeg -y -i {0} '+ preview_part +' -i {1} ' + preview_part + ' -filter_complex '
-                   '"[1:v]format=rgba,colorchannelmixer=aa=0.65[b];'
-                    + '[0:v][b]overlay,pad=ceil(iw/2)*2:ceil(ih/2)*2" -c:v libx265 {2}')
-                   .format(vid1, vid2, path_out),
-                   shell=True)
-
-def find_vid_start(path):
-    tmp_dir = "vid_tmp"
-    os.makedirs(tmp_dir, exist_ok=True)
+from util import launch_swf, hash_file, link_or_copy
+from cache import DiskCache
+from display import VirtualDisplay
+from recorder import Recorder
+import tracing
+
+_REC_CACHE_PATH = os.path.join("rec", "cache")
+_REC_CACHE_SIZE = 4 * 1024 ** 3  # recordings, their trimmed intermediates and combinations
+_REC_CACHE_VERSION = 1
+_REPORT_VERSION = 3  # part of the combination keys, so that reports of an older analyse are not reused
+START_ROI = (0.25, 0, 0.5, 0.25)  # where the level timer is shown: top centre of the window
+START_TEMPLATE = os.path.join("tools", "start.png")  # the level timer at 00:00
+# crop of the level complete screen (captured from a recording, as tools/start.png), used to find when levels end
+COMPLETE_TEMPLATE = os.path.join("tools", "complete.png")
+
+@tracing.traced("render")
+def prepare_branch(cache, key, length):
+    """
+    The recording cached as key + ".mkv", trimmed to length frames from the start of the level and normalized (even size,
+    constant frame rate, yuv420p). Cached too, so that unchanged branches are not re-processed
+    """
+    out_key = "{}-{}.mkv".format(key, length)
+    out_path = cache.get(out_key)
+    if out_path is not None:
+        return out_path
+
+    rec_key = key + ".mkv"
+    rec_video = cache.get(rec_key)
+    if rec_video is None:
+        raise FileNotFoundError("Recording " + rec_key + " is not cached")
+    start = cache.meta(rec_key)["start"]
+    tmp_path = cache.entry_path(out_key) + ".tmp.mkv"
+    try:
+        with tracing.span("ffmpeg", "subprocess"):
+            subprocess.run(["ffmpeg", "-y", "-loglevel", "error", "-i", rec_video, "-vf",
+                            "trim=start_frame={}:end_frame={},setpts=PTS-STARTPTS,pad=ceil(iw/2)*2:ceil(ih/2)*2,"
+                            "fps=25,format=yuv420p".format(start, start + length),
+                            "-c:v", "libx264", "-preset", "veryfast", "-crf", "12", tmp_path], check=True)
+        cache.put(out_key, tmp_path, {"recording": rec_key, "length": length})
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return cache.get(out_key)
+
+@tracing.traced("render")
+def combine(videos, preview=False, layout="overlay", alpha=0.65, path_out=os.path.join("rec", "out.mkv")):
+    """
+    Combine the prepared branch videos into path_out in one filter graph: either overlaid on top of each other
+    (layout="overlay", every upper layer at alpha opacity) or side by side in a grid (layout="grid").
+    preview trades quality for a fast encode
+    """
+
+    if len(videos) == 1:
+        graph = "[0:v]null[out]"
+    elif layout == "overlay":
+        graph = ""
+        below = "[0:v]"
+        for i in range(1, len(videos)):
+            graph += "[{0}:v]format=rgba,colorchannelmixer=aa={1}[l{0}];{2}[l{0}]overlay=shortest=1[o{0}];".format(
+                i, alpha, below)
+            below = "[o{}]".format(i)
+        graph += below + "format=yuv420p[out]"
+    elif layout == "grid":
+        columns = math.ceil(math.sqrt(len(videos)))
+        positions = "|".join("{}_{}".format("+".join(["w0"] * (i % columns)) or "0",
+                                              "+".join(["h0"] * (i // columns)) or "0")
+                             for i in range(len(videos)))
+        graph = "{}xstack=inputs={}:layout={}:shortest=1:fill=black[out]".format(
+            "".join("[{}:v]".format(i) for i in range(len(videos))), len(videos), positions)
+    else:
+        raise ValueError("Unknown layout: " + layout)
+
+    if preview:
+        encode = ["-c:v", "libx264", "-preset", "ultrafast", "-crf", "28"]
+    else:
+        encode = ["-c:v", "libx265"]
+    inputs = [x for video in videos for x in ("-i", video)]
+    with tracing.span("ffmpeg", "subprocess"):
+        subprocess.run(["ffmpeg", "-y", *inputs, "-filter_complex", graph, "-map", "[out]", *encode, path_out],
+                       check=True)
+
+@functools.lru_cache()
+def _template(path, scale):
+    im = cv2.imread(path)
+    if im is None:
+        raise FileNotFoundError("Could not read template " + path)
+    if scale != 1:
+        im = cv2.resize(im, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return im
+
+def _roi_pixels(roi, frame, template):
+    """
+    (x, y, width, height) fractions of the frame size as pixels of frame, or None for the whole frame (also if the
+    region is too small for template)
+    """
+    if roi is None:
+        return None
+    height, width = frame.shape[:2]
+    x, y = int(roi[0] * width), int(roi[1] * height)
+    roi = x, y, min(int(roi[2] * width), width - x), min(int(roi[3] * height), height - y)
+    template_height, template_width = template.shape[:2]
+    return roi if roi[2] >= template_width and roi[3] >= template_height else None
+
+def _find_template_frame(path, template_path, roi, scale, start=0, max_frames=None, threshold=0.05):
+    """
+    Index of the first frame of the video at path from frame start on (within max_frames frames, if not None) showing
+    the image at template_path, or None. Frames are decoded one by one into the same buffer, and only the region of
+    interest roi=(x, y, width, height), in fractions of the frame size (the whole frame if None), downscaled by scale,
+    is searched
+    """
+    im_template = _template(template_path, scale)
+    region_rect = None
+    small = None
+    for i, frame in enumerate(_iter_video_frames(path, start)):
+        if max_frames is not None and i >= max_frames:
+            break
+        if i == 0:
+            region_rect = _roi_pixels(roi, frame, _template(template_path, 1))
+        region = frame if region_rect is None else frame[region_rect[1]:region_rect[1] + region_rect[3],
+                                                         region_rect[0]:region_rect[0] + region_rect[2]]
+        if scale != 1:
+            small = cv2.resize(region, None if small is None else small.shape[1::-1], small,
+                               fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            region = small
+        result = cv2.matchTemplate(region, im_template, cv2.TM_SQDIFF_NORMED)
+        mn, _, _, _ = cv2.minMaxLoc(result)
+        if mn < threshold:
+            return start + i
+    return None
+
+def _video_fps(path):
+    capture = cv2.VideoCapture(path)
     try:
-        # export all images
-        subprocess.run("ffmpeg -i '{}' -t 5 '{}'".format(path, os.path.join(tmp_dir, "%05d.png")), shell=True)
-
-        im_start = cv2.imread(os.path.join("tools", "start.png"))
-        for i, file in enumerate(sorted(os.listdir(tmp_dir))):
-            file_path = os.path.join(tmp_dir, file)
-            large_image = cv2.imread(file_path)
-            result = cv2.matchTemplate(im_start, large_image, cv2.TM_SQDIFF_NORMED)
-            mn, _, _, _ = cv2.minMaxLoc(result)
-            if mn < 0.05:
-                return i
+        return capture.get(cv2.CAP_PROP_FPS) or 25
     finally:
-        shutil.rmtree(tmp_dir)
+        capture.release()
+
+def find_vid_start(path, roi=START_ROI, scale=1, max_duration=5):
+    """
+    Index of the first frame of the video at path showing tools/start.png, or None if it does not within
+    max_duration seconds. Only the region of interest roi (see _find_template_frame) downscaled by scale is searched.
+    The timer's thin digits only match reliably at full scale (downscaled, the match depends on the pixel phase of
+    the timer), the region is what keeps the search cheap
+    """
+    return _find_template_frame(path, START_TEMPLATE, roi, scale, max_frames=int(_video_fps(path) * max_duration))
+
+def find_vid_complete(path, start=0, roi=None, scale=0.25):
+    """
+    Index of the first frame of the video at path, from frame start on (the start of the level), showing the level
+    complete screen of COMPLETE_TEMPLATE, or None if the level is not completed in the video. Unlike the timer, the
+    screen is large enough to be matched downscaled, which matters as the whole recording may be searched
+    """
+    return _find_template_frame(path, COMPLETE_TEMPLATE, roi, scale, start)
+
+def find_vid_starts(paths, jobs=None, **kwargs):
+    """
+    find_vid_start for many videos at once (decoding and matching release the GIL)
+    """
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(lambda path: find_vid_start(path, **kwargs), paths))
+
+def find_vid_completes(paths, starts, jobs=None, **kwargs):
+    """
+    Level complete frame of each video, counted from its start frame (None if the level is not completed in it).
+    All None if there is no COMPLETE_TEMPLATE to find them with
+    """
+    if not os.path.isfile(COMPLETE_TEMPLATE):
+        print("No " + COMPLETE_TEMPLATE + ", level completion is not detected")
+        return [None] * len(paths)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        completes = pool.map(lambda x: find_vid_complete(*x, **kwargs), zip(paths, starts))
+        return [None if complete is None else complete - start for complete, start in zip(completes, starts)]
+
+def _iter_video_frames(path, start=0):
+    """
+    Decode the frames of the video at path from frame start on, into the same buffer every time
+    """
+    capture = cv2.VideoCapture(path)
+    try:
+        for _ in range(start):
+            if not capture.grab():
+                return
+        frame = None
+        while True:
+            ok, frame = capture.read(frame)
+            if not ok:
+                return
+            yield frame
+    finally:
+        capture.release()
+
+@tracing.traced("analyse")
+def analyse(videos, tas_files, starts=None, rois=None, threshold=0.02, completes=None):
+    """
+    Compare two branch recordings frame by frame, from their start frames (found with find_vid_start if None).
+    Differences are the mean absolute pixel difference (0 to 1) over the whole frame and over each
+    rois={name: (x, y, width, height)} region. completes are the level complete frames of the branches (counted from
+    their start), found in the videos with find_vid_completes if None. Returns a JSON-serializable report
+    """
+    if len(videos) != 2 or len(tas_files) != 2:
+        raise ValueError("analyse compares exactly two recordings")
+    if starts is None:
+        starts = find_vid_starts(videos)
+    if None in starts:
+        raise ValueError("Could not find the start of " + videos[starts.index(None)])
+    if completes is None:
+        completes = find_vid_completes(videos, starts)
+    regions = {"frame": None}
+    regions.update(rois or {})
+
+    curves = {name: [] for name in regions}
+    diff = None
+    for frame_a, frame_b in zip(*(_iter_video_frames(video, start) for video, start in zip(videos, starts))):
+        diff = cv2.absdiff(frame_a, frame_b, diff)
+        for name, roi in regions.items():
+            region = diff if roi is None else diff[roi[1]:roi[1] + roi[3], roi[0]:roi[0] + roi[2]]
+            curves[name].append(region.mean())
+    curves = {name: np.asarray(curve, dtype=np.float32) / 255 for name, curve in curves.items()}
+
+    def first_index(mask):
+        indices = np.flatnonzero(mask)
+        return int(indices[0]) if len(indices) else None
 
-def compare(level_file, branches=None, preview=False):
+    # TAS inputs, in the same frames as the recordings (the recorder pads the frames it missed)
+    levels = []
+    for tas_file in tas_files:
+        t = TasLevelParser(tas_file)
+        t.parse()
+        levels.append(t)
+    input_length = max(t.length for t in levels)
+    inputs = [np.frombuffer(t.sequence.tobytes(), dtype=np.uint8) for t in levels]
+    inputs = [np.pad(x, (0, input_length - len(x))) for x in inputs]
+    first_input_difference = first_index(inputs[0] != inputs[1])
+
+    divergence = {name: first_index(curve > threshold) for name, curve in curves.items()}
+    return {
+        "videos": list(videos),
+        "starts": [int(x) for x in starts],
+        "frames": len(curves["frame"]),
+        "threshold": threshold,
+        "first_divergent_frame": divergence,
+        "first_input_difference": first_input_difference,
+        "divergence_lag": None if divergence["frame"] is None or first_input_difference is None
+        else divergence["frame"] - first_input_difference,
+        "tas_lengths": [t.length for t in levels],  # input frames in the TAS files, not detected from the videos
+        # detected in the videos (None: not completed in the video, or no COMPLETE_TEMPLATE to detect it with)
+        "complete_frames": completes,
+        "diff": {name: [round(float(x), 5) for x in curve] for name, curve in curves.items()},
+    }
+
+@tracing.traced("record")
+def record_swf(swf_file, duration, out_path, display=None):
+    """
+    Record duration seconds of swf_file (from the start of its first level) into out_path, on the given VirtualDisplay
+    or on the current display if None. Returns the number of frames recorded
+    """
+    display_name = display.name if display is not None else None
+    proc_swf, window_id = launch_swf(swf_file, display_name)
+    rec_tmp_path = out_path + ".tmp.mkv"
+    try:
+        with Recorder(window_id, display_name) as recorder:
+            recorder.record(rec_tmp_path, duration + 2)
+        os.replace(rec_tmp_path, out_path)
+        return recorder.captured + recorder.duplicated
+    finally:
+        proc_swf.kill()
+        if os.path.isfile(rec_tmp_path):
+            os.remove(rec_tmp_path)
+
+def record_all(recordings, jobs=2):
+    """
+    Record (swf_file, duration, out_path) runs, up to jobs at a time, each in its own headless X display.
+    Without Xvfb, they are recorded one after the other on the current display. Returns their frame counts
+    """
+    if shutil.which("Xvfb") is None:
+        return [record_swf(*recording) for recording in recordings]
+
+    def record_headless(recording):
+        with VirtualDisplay() as display:
+            return record_swf(*recording, display=display)
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        return [future.result() for future in [pool.submit(record_headless, x) for x in recordings]]
+
+def _recording_cache():
+    return DiskCache(_REC_CACHE_PATH, _REC_CACHE_SIZE, _REC_CACHE_VERSION)
+
+def compare(level_file, branches=None, preview=False, jobs=2, layout="overlay"):
     if branches is None:
         # default argument
         branches = ["a", "b"]
@@ -54,88 +306,114 @@ def compare(level_file, branches=None, preview=False):
     rel_level_file = os.path.relpath(level_file, "tas")
     os.makedirs(os.path.dirname(os.path.join("rec", rel_level_file)), exist_ok=True)
 
-    tmp_level_file = level_file + ".tmp"
-    try:
-        # temporarily preserve original level_file
-        shutil.move(level_file, tmp_level_file)
-
-        # compute relative name (e.g: adventure/01)
-        rel_name = os.path.splitext(rel_level_file)[0]
-
-        # process branch files
-        branch_lengths = []
-        branch_hashes = []
-        for branch in branches:
-            branch_path = os.path.join("tas", rel_name + branch + ".txt")
-            t = TasLevelParser(branch_path)
-            t.parse()
-            branch_lengths.append(len(t.sequence))
-            branch_hashes.append(hash_file(branch_path))
-
-        rec_duration = min(branch_lengths) / 23  # in seconds (assume fps never dips below 23fps)
-
-        def rec_swf(swf_file, duration, out_path):
-            proc_swf = subprocess.Popen("flashplayer '" + swf_file + "'", shell=True)
-            time.sleep(0.5)  # wait for window to appear
-            window_id = click_swf()
-            # time.sleep(0.7)
-
-            rec_tmp_dir = "rec_tmp"
-            os.makedirs(rec_tmp_dir, exist_ok=True)
-            try:
-                proc_rec = subprocess.Popen("sh record.sh", shell=True)
-                # wait duration
-                time.sleep(duration + 2)
+    # compute relative name (e.g: adventure/01)
+    rel_name = os.path.splitext(rel_level_file)[0]
 
-                proc_rec.send_signal(signal.SIGINT)
-                proc_swf.kill()
+    base_swf_path = os.path.join("swf", "fbwg-base-dev-clip.swf")
+    base_swf_hash = hash_file(base_swf_path)
 
-                proc_rec.wait()
-            finally:
-                output_video = os.path.join(rec_tmp_dir, "out.mkv")
-                if not os.path.isfile(output_video):
-                    raise FileNotFoundError("Record script did not produce video")
-                shutil.move(output_video, out_path)
-                shutil.rmtree(rec_tmp_dir)
+    # process branch files
+    branch_lengths = []
+    branch_keys = []
+    for branch in branches:
+        branch_path = os.path.join("tas", rel_name + branch + ".txt")
+        t = TasLevelParser(branch_path)
+        t.parse()
+        branch_lengths.append(t.length)
+        # recordings only depend on the branch and the swf it is injected into
+        branch_keys.append(hashlib.sha256((rel_level_file + "-" + base_swf_hash + "-" + hash_file(branch_path))
+                                          .encode("utf8")).hexdigest())
+    length = min(branch_lengths)
 
+    cache = _recording_cache()
+    try:
+        with tempfile.TemporaryDirectory(prefix="fbwg-compare-") as tmp_dir:
+            # each branch is built from its own copy of the tas tree, so that branches can be recorded side by side
+            recordings = []
+            recorded_keys = []
+            for i, branch in enumerate(branches):
+                rec_key = branch_keys[i] + ".mkv"
+                meta = cache.meta(rec_key)
+                # a longer recording of the branch is trimmed down instead
+                if meta is not None and meta["frames"] - meta["start"] >= length and cache.get(rec_key) is not None:
+                    continue
 
-        branch_rec_paths = []
-        for i, branch in enumerate(branches):
-            rel_branch_path = rel_name + branch + ".txt"
-            rec_video = os.path.join("rec", rel_name + "-" + str(min(branch_lengths)) + "-" + branch_hashes[i] + ".mkv")
-            branch_rec_paths.append(rec_video)
-            if not os.path.isfile(rec_video):
-                shutil.copy(os.path.join("tas", rel_branch_path), level_file)
+                rel_branch_path = rel_name + branch + ".txt"
+                branch_dir = os.path.join(tmp_dir, branch)
+                branch_tas_path = os.path.join(branch_dir, "tas")
+                shutil.copytree("tas", branch_tas_path)
+                shutil.copy(os.path.join("tas", rel_branch_path), os.path.join(branch_tas_path, rel_level_file))
 
                 # mod
-                m = SwfModder(os.path.join("swf", "fbwg-base-dev-clip.swf"), os.path.join("swf", "fbwg-tas.swf"))
-                m.disassemble()
-                m.mod_all()
-                m.reassemble()
+                swf_path = os.path.abspath(os.path.join(branch_dir, "fbwg-tas.swf"))
+                SwfModder(base_swf_path, swf_path, tas_path=branch_tas_path).build()
+                # record the whole branch, so that it can be reused against any other
+                rec_duration = branch_lengths[i] / 23  # in seconds (assume fps never dips below 23fps)
+                # staged next to the cache entries (see DiskCache.entry_path), unique to this run
+                recordings.append((swf_path, rec_duration,
+                                   "{}.{}.tmp.mkv".format(cache.entry_path(rec_key), os.getpid())))
+                recorded_keys.append((rec_key, branch))
 
-                rec_swf(m._output_swf_path, rec_duration, rec_video)
+            try:
+                for (rec_key, branch), (_, _, rec_video), frames in zip(recorded_keys, recordings,
+                                                                         record_all(recordings, jobs)):
+                    start = find_vid_start(rec_video)
+                    if start is None:
+                        # never cache a recording that cannot be aligned with the others
+                        raise RuntimeError("Could not find the start of the level in the recording of branch " +
+                                           branch)
+                    cache.put(rec_key, rec_video, {"level": rel_name, "branch": branch, "frames": frames,
+                                                   "duration": frames / 25, "start": start})
+            finally:
+                for _, _, rec_video in recordings:
+                    if os.path.exists(rec_video):
+                        os.remove(rec_video)
 
         # combine videos
-        if len(branches) != 2:
-            raise ValueError
-
-        combination_hash = hashlib.sha256((rel_name + "-" + str(min(branch_lengths)) + "-" + "-".join(branch_hashes)).encode("utf8")).hexdigest()
-        existing_combination_hash = ""
-        try:
-            with open(os.path.join("rec", "combination.txt")) as f:
-                existing_combination_hash = f.read().strip()
-        except:
-            pass
-
-        if preview or (combination_hash != existing_combination_hash):
-            combine(*branch_rec_paths, preview)
-
-        with open(os.path.join("rec", "combination.txt"), 'w') as f:
-            f.write(combination_hash)
-    finally:
-        # restore level_file
-        shutil.move(tmp_level_file, level_file)
+        complete_template_hash = hash_file(COMPLETE_TEMPLATE) if os.path.isfile(COMPLETE_TEMPLATE) else ""
+        combination_key = hashlib.sha256(("-".join(branch_keys) + "-" + str(length) + "-" + layout + "-" +
+                                          str(preview) + "-" + str(_REPORT_VERSION) + "-" + complete_template_hash)
+                                         .encode("utf8")).hexdigest()
+        combination_path = cache.get(combination_key + ".mkv")
+        report_path = cache.get(combination_key + ".json")
+        if combination_path is None or report_path is None:
+            prepared = [prepare_branch(cache, key, length) for key in branch_keys]
+            tmp_path = cache.entry_path(combination_key + ".mkv") + ".tmp.mkv"
+            try:
+                combine(prepared, preview, layout, path_out=tmp_path)
+                cache.put(combination_key + ".mkv", tmp_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+            # the prepared videos are trimmed to the shortest branch, completion is looked for in the whole recordings
+            rec_keys = [key + ".mkv" for key in branch_keys]
+            completes = find_vid_completes([cache.get(key) for key in rec_keys],
+                                           [cache.meta(key)["start"] for key in rec_keys])
 
+            # every branch against the first one
+            tas_files = [os.path.join("tas", rel_name + x + ".txt") for x in branches]
+            reports = {}
+            for i in range(1, len(branches)):
+                report = analyse([prepared[0], prepared[i]], [tas_files[0], tas_files[i]], starts=[0, 0],
+                                 completes=[completes[0], completes[i]])
+                reports[branches[i]] = report
+                print("{} vs {}: first divergent frame: {}, first input difference: {}, level complete frames: {}, "
+                      "TAS lengths: {}".format(branches[0], branches[i], report["first_divergent_frame"]["frame"],
+                                               report["first_input_difference"], report["complete_frames"],
+                                               report["tas_lengths"]))
+            with cache.write(combination_key + ".json") as f:
+                json.dump(reports, f)
+            combination_path = cache.get(combination_key + ".mkv")
+            report_path = cache.get(combination_key + ".json")
+
+        for src, dst in ((combination_path, os.path.join("rec", "out.mkv")),
+                         (report_path, os.path.join("rec", rel_name + "-report.json"))):
+            if os.path.exists(dst):
+                os.remove(dst)
+            link_or_copy(src, dst)
+    finally:
+        cache.flush()
 
 if __name__ == '__main__':
     compare("tas/adventure/01.txt", ["a", "b"])
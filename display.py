@@ -0,0 +1,56 @@
+import os
+import subprocess
+
+
+class VirtualDisplay:
+    """
+    Headless X display (Xvfb), so that several flashplayers can run and be recorded side by side
+    """
+
+    def __init__(self, width=1280, height=1024, depth=24):
+        self.width = width
+        self.height = height
+        self.depth = depth
+        self.number = None
+        self._proc = None
+
+    @property
+    def name(self):
+        return ":" + str(self.number)
+
+    def env(self):
+        """
+        Environment for processes to run on this display
+        """
+        env = dict(os.environ)
+        env["DISPLAY"] = self.name
+        return env
+
+    def start(self):
+        # Xvfb picks a free display number itself and reports it once it accepts connections
+        read_fd, write_fd = os.pipe()
+        try:
+            self._proc = subprocess.Popen(["Xvfb", "-displayfd", str(write_fd), "-nolisten", "tcp", "-screen", "0",
+                                           "{}x{}x{}".format(self.width, self.height, self.depth)],
+                                          pass_fds=(write_fd,), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        finally:
+            os.close(write_fd)
+        with os.fdopen(read_fd) as f:
+            number = f.readline().strip()
+        if not number.isnumeric():
+            self.stop()
+            raise RuntimeError("Xvfb failed to start")
+        self.number = int(number)
+        return self
+
+    def stop(self):
+        if self._proc is not None:
+            self._proc.terminate()
+            self._proc.wait()
+            self._proc = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
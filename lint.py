@@ -0,0 +1,225 @@
+#!/bin/env python3
+"""
+Static analysis of the TAS in tas/, without building or launching anything: frame counts and estimated times of the
+levels in levels.txt order, and lint of the level files (syntax, unknown commands, l and r held on the same frame,
+levels without a TAS file). Exits with 1 if errors were found (or warnings, with --strict), so that it can gate builds
+"""
+import os
+import json
+import argparse
+import sys
+from mod import SwfModder, TasLevelParser
+
+TIME_STEP = 1 / 26  # level.m_timeStep, seconds of game time per frame
+ERROR = "error"
+WARNING = "warning"
+__LR_MASK = (1 << 1) | (1 << 2)  # r and l of a character (see TasLevelParser), shifted by 3 for watergirl
+__CHARACTER_NAMES = [x.rstrip(":") for x in TasLevelParser.CHARACTERS]
+
+def _issue(severity, path, line, message):
+    return {"severity": severity, "path": path, "line": line, "message": message}
+
+def lint_level_file(path):
+    """
+    Check the syntax of a level file, reporting every bad line (TasLevelParser.parse stops at the first one).
+    Returns a list of issues
+    """
+    issues = []
+    characters = []
+    with open(path, "r") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.split("#", 1)[0].strip()
+            if len(line) <= 0:
+                continue
+
+            if line in TasLevelParser.CHARACTERS:
+                if line in characters:
+                    issues.append(_issue(ERROR, path, line_no, "second '" + line + "' section"))
+                characters.append(line)
+                continue
+            if line.endswith(":"):
+                issues.append(_issue(ERROR, path, line_no, "unknown character '" + line + "'"))
+                continue
+            if not characters:
+                issues.append(_issue(ERROR, path, line_no, "inputs before the first character section"))
+
+            for part in line.split(","):
+                tokens = part.split()
+                if len(tokens) != 2:
+                    issues.append(_issue(ERROR, path, line_no, "expected '<command> <duration>', got '" +
+                                         part.strip() + "'"))
+                    continue
+                command, duration = tokens
+                if command not in TasLevelParser.COMMANDS:
+                    issues.append(_issue(ERROR, path, line_no, "unknown command '" + command + "'"))
+                if not duration.isdigit():
+                    issues.append(_issue(ERROR, path, line_no, "bad duration '" + duration + "'"))
+                elif int(duration) == 0:
+                    issues.append(_issue(WARNING, path, line_no, "zero duration '" + part.strip() + "'"))
+    return issues
+
+def find_conflicts(tas_level):
+    """
+    Frame ranges where a character holds l and r at once, as (character_num, start, end) sorted by start
+    """
+    conflicts = []
+    segments = list(tas_level.segments())
+    for character_num in range(len(TasLevelParser.CHARACTERS)):
+        mask_lr = __LR_MASK << (3 * character_num)
+        frame = 0
+        for mask, count in segments:
+            if mask & mask_lr == mask_lr:
+                if conflicts and conflicts[-1][0] == character_num and conflicts[-1][2] == frame:
+                    conflicts[-1] = (character_num, conflicts[-1][1], frame + count)
+                else:
+                    conflicts.append((character_num, frame, frame + count))
+            frame += count
+    return sorted(conflicts, key=lambda x: x[1])
+
+def _report(levels, issues):
+    total_frames = sum(level["frames"] or 0 for level in levels)
+    return {
+        "levels": levels,
+        "total_frames": total_frames,
+        "total_seconds": total_frames * TIME_STEP,
+        "complete": all(level["frames"] is not None for level in levels),
+        "errors": sum(issue["severity"] == ERROR for issue in issues),
+        "warnings": sum(issue["severity"] == WARNING for issue in issues),
+        "issues": issues,
+    }
+
+def analyse_level_file(path):
+    """
+    Lint a level file and count its frames (None if it does not parse). Returns (frames, issues)
+    """
+    issues = lint_level_file(path)
+    if any(issue["severity"] == ERROR for issue in issues):
+        return None, issues
+
+    t = TasLevelParser(path)
+    t.parse()
+    for character_num, start, end in find_conflicts(t):
+        issues.append(_issue(WARNING, path, None, "{} holds l and r together on frames {}-{} ({:.2f}s)".format(
+            __CHARACTER_NAMES[character_num], start, end - 1, start * TIME_STEP)))
+    return t.length, issues
+
+def _read_levels(tas_path, issues):
+    path = os.path.join(tas_path, "levels.txt")
+    levels = []
+    if not os.path.isfile(path):
+        issues.append(_issue(ERROR, path, None, "missing"))
+        return levels
+    with open(path, "r") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if len(line) <= 0:
+                continue
+            values = line.split(",")
+            if len(values) != 2 or not all(x.strip().isdigit() for x in values):
+                issues.append(_issue(ERROR, path, line_no, "expected '<type>,<number>', got '" + line + "'"))
+                continue
+            level_type, number = (int(x) for x in values)
+            if not 1 <= level_type <= len(SwfModder.LEVEL_TYPES):
+                issues.append(_issue(ERROR, path, line_no, "unknown level type " + str(level_type)))
+                continue
+            levels.append((SwfModder.LEVEL_TYPES[level_type - 1], number, line_no))
+    return levels
+
+def analyse_tree(tas_path="tas"):
+    """
+    Analyse a TAS tree as SwfModder would build it: the numbered level files of every level type directory, played in
+    levels.txt order. Returns a JSON-serializable report
+    """
+    issues = []
+    level_files = {}  # (type, number) -> path
+    for level_type in sorted(os.listdir(tas_path)):
+        type_path = os.path.join(tas_path, level_type)
+        if not os.path.isdir(type_path):
+            continue
+        if level_type not in SwfModder.LEVEL_TYPES:
+            issues.append(_issue(WARNING, type_path, None, "unknown level type directory"))
+        for name in sorted(os.listdir(type_path)):
+            if os.path.splitext(name)[0].isnumeric():
+                level_files[level_type, int(os.path.splitext(name)[0])] = os.path.join(type_path, name)
+
+    frames = {}
+    for key, path in sorted(level_files.items()):
+        frames[key], file_issues = analyse_level_file(path)
+        issues += file_issues
+
+    levels_path = os.path.join(tas_path, "levels.txt")
+    played = _read_levels(tas_path, issues)
+    levels = []
+    for level_type, number, line_no in played:
+        path = level_files.get((level_type, number))
+        if path is None:
+            issues.append(_issue(WARNING, levels_path, line_no, "{} level {} has no TAS file, it gets no inputs".format(
+                level_type, number)))
+        level_frames = frames.get((level_type, number))
+        levels.append({
+            "type": level_type,
+            "number": number,
+            "path": path,
+            "frames": level_frames,
+            "seconds": level_frames * TIME_STEP if level_frames is not None else None,
+        })
+
+    # the None slots of SwfModder's level arrays, if not reported above already
+    played_keys = {(level_type, number) for level_type, number, _ in played}
+    for level_type in sorted({level_type for level_type, _ in level_files}):
+        numbers = [number for t, number in level_files if t == level_type]
+        for number in range(1, max(numbers)):
+            if (level_type, number) not in level_files and (level_type, number) not in played_keys:
+                issues.append(_issue(WARNING, os.path.join(tas_path, level_type), None,
+                                     "no level {} file (gap before level {})".format(number, max(numbers))))
+    for key, path in sorted(level_files.items()):
+        if key not in played_keys:
+            issues.append(_issue(WARNING, path, None, "not in levels.txt, never played"))
+
+    return _report(levels, issues)
+
+def analyse_files(paths):
+    """
+    Analyse level files on their own (e.g. branches), in the same report format as analyse_tree
+    """
+    issues = []
+    levels = []
+    for path in paths:
+        level_frames, file_issues = analyse_level_file(path)
+        issues += file_issues
+        levels.append({"type": None, "number": None, "path": path, "frames": level_frames,
+                       "seconds": level_frames * TIME_STEP if level_frames is not None else None})
+    return _report(levels, issues)
+
+def _format_time(seconds):
+    return "{}:{:05.2f}".format(int(seconds // 60), seconds % 60)
+
+def print_report(report):
+    for level in report["levels"]:
+        name = level["path"] if level["type"] is None else "{} {:02d}".format(level["type"], level["number"])
+        if level["frames"] is None:
+            print("{:24} {:>8}".format(name, "-"))
+        else:
+            print("{:24} {:8d} frames {:>10}".format(name, level["frames"], _format_time(level["seconds"])))
+    print("{:24} {:8d} frames {:>10}{}".format("total", report["total_frames"], _format_time(report["total_seconds"]),
+                                               "" if report["complete"] else " (incomplete)"))
+    for issue in report["issues"]:
+        location = issue["path"] + (":" + str(issue["line"]) if issue["line"] is not None else "")
+        print("{}: {}: {}".format(location, issue["severity"], issue["message"]))
+    print("{} errors, {} warnings".format(report["errors"], report["warnings"]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("files", nargs="*", help="level files to analyse on their own, instead of the TAS tree")
+    parser.add_argument("--tas", default="tas", help="TAS tree to analyse (default: tas)")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--strict", action="store_true", help="fail on warnings too")
+    args = parser.parse_args()
+
+    report = analyse_files(args.files) if args.files else analyse_tree(args.tas)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    sys.exit(1 if report["errors"] or (args.strict and report["warnings"]) else 0)
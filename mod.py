@@ -1,11 +1,75 @@
 #!/bin/env python3
 import os
-import re
-import subprocess
+import argparse
+import bisect
 import shutil
-from util import run, run_async, click_swf
+import hashlib
+import json
+import time
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from util import run, run_async, launch_swf, hash_file, link_or_copy
+from cache import DiskCache
+from watch import FileWatcher
+from abcfile import SwfFile, AbcFile
+from patcher import Patch, PatchError, PatchMatcher
+import tracing
+
+def _parse_level_file(path, data):
+    """
+    Parse the contents of a TAS level file into TasLevelParser.dump() form (run in the worker processes of SwfModder)
+    """
+    t = TasLevelParser(path)
+    t.parse(data)
+    return t.dump()
+
+
+def _frame_asm(mask):
+    ret = 'findpropstrict QName(PackageNamespace(""), "Array")\n'
+    for i in range(FrameStore.KEY_COUNT):
+        ret += "pushbyte " + str((mask >> i) & 1) + "\n"
+    ret += 'constructprop QName(PackageNamespace(""), "Array"), ' + str(FrameStore.KEY_COUNT) + "\n"
+    return ret
+
+
+class FrameStore:
+    """
+    Compact frame sequence: one byte per frame, holding a 6-bit mask of the pressed keys
+    (bit i set <=> key i of up, right, left, up2, right2, left2 is pressed), filled in runs of identical frames
+    """
+    KEY_COUNT = 6
+
+    def __init__(self, masks=b""):
+        self._masks = bytearray(masks)
+
+    def __len__(self):
+        return len(self._masks)
+
+    def __getitem__(self, index):
+        return self._masks[index]
+
+    def __iter__(self):
+        return iter(self._masks)
+
+    def __reversed__(self):
+        return reversed(self._masks)
+
+    def __eq__(self, other):
+        return isinstance(other, FrameStore) and self._masks == other._masks
+
+    @staticmethod
+    def mask_to_frame(mask):
+        return [(mask >> i) & 1 for i in range(FrameStore.KEY_COUNT)]
+
+    def extend_run(self, mask, count):
+        self._masks.extend(bytes((mask,)) * count)
+
+    def tobytes(self):
+        return bytes(self._masks)
+
 
 class TasLevelParser:
+    VERSION = 2  # bump whenever the parse result or the generated asasm change (invalidates cached levels)
     __PARSE_MAP = [
         {
             "u": 0,
@@ -22,263 +86,891 @@ class TasLevelParser:
         "fireboy:",
         "watergirl:"
     ]
-    __NO_OP = [0, 0, 0, 0, 0, 0]
+    COMMANDS = [*__PARSE_MAP[0], "s"]  # s (sleep) holds nothing, it only extends the level
+    CHARACTERS = __CHARACTER_PARSE_MAP
+    __FRAME_ASM = [_frame_asm(mask) for mask in range(1 << FrameStore.KEY_COUNT)]
+    __CHUNK_FRAMES = 1024
 
     def __init__(self, path):
         self.path = path
-        self.sequence = []
-
-    def get_frame(self, index):
-        if index > len(self.sequence) - 1:
-            for _ in range(index - len(self.sequence) + 1):
-                self.sequence.append(self.__NO_OP.copy())
-            return self.get_frame(index)
-        else:
-            return self.sequence[index].copy()
-
-    def set_frame(self, index, key_index):
-        frame = self.get_frame(index)
-        frame[key_index] = 1
-        self.sequence[index] = frame
+        self.content_hash = None  # set when loaded through SwfModder's level cache
+        self.intervals = [[], []]  # (start, end, key_index) per character, ordered by start
+        self.length = 0
+        self._starts = [[], []]
+        self._sequence = None
+
+    @property
+    def sequence(self):
+        """
+        The frames as a FrameStore, materialized from the intervals on first access
+        """
+        if self._sequence is None:
+            self._sequence = FrameStore()
+            for mask, count in self.segments():
+                self._sequence.extend_run(mask, count)
+        return self._sequence
 
-    def parse(self):
-        with open(self.path, "r") as f:
-            cur_time = 0
+    def keys_at(self, index):
+        """
+        Mask of the keys held at frame index
+        """
+        mask = 0
+        for intervals, starts in zip(self.intervals, self._starts):
+            # lines never overlap, so only the intervals of the latest line starting at or before index can hold
+            i = bisect.bisect_right(starts, index) - 1
+            line_start = starts[i] if i >= 0 else None
+            while i >= 0 and starts[i] == line_start:
+                start, end, key_index = intervals[i]
+                if index < end:
+                    mask |= 1 << key_index
+                i -= 1
+        return mask
 
-            character_num = -1  # 0 for fireboy, 1 for watergirl
-            character_parse_list = self.__CHARACTER_PARSE_MAP.copy()
+    def get_frame(self, index):
+        return FrameStore.mask_to_frame(self.keys_at(index))
 
-            for line in f:
-                line = re.sub(r"#[^\n]*", "", line).strip()  # remove comments
-                if len(line) <= 0:
-                    continue  # empty line so skip
-
-                if line in character_parse_list:
-                    cur_time = 0
-                    character_num = self.__CHARACTER_PARSE_MAP.index(line)
-                    character_parse_list.remove(line)
-                else:
-                    line_max_duration = -1
-                    for part in line.split(","):
-                        command, duration = re.split(r"\s+", part.strip())
-                        duration = int(duration)
-
-                        if command != "s":
-                            for i in range(duration):
-                                self.set_frame(cur_time + i, self.__PARSE_MAP[character_num][command])
-                        else:
-                            # sleep command
-                            self.get_frame(cur_time + duration - 1)
+    def segments(self):
+        """
+        Stream the frames as run-length (mask, count) segments covering [0, length)
+        """
+        events = []
+        for intervals in self.intervals:
+            for start, end, key_index in intervals:
+                if end > start:
+                    events.append((start, key_index, 1))
+                    events.append((end, key_index, -1))
+        events.sort()
+
+        held = [0] * FrameStore.KEY_COUNT
+        cur_time = 0
+        mask = 0
+        for frame, key_index, delta in events:
+            if frame > cur_time:
+                yield mask, frame - cur_time
+                cur_time = frame
+            held[key_index] += delta
+            if held[key_index]:
+                mask |= 1 << key_index
+            else:
+                mask &= ~(1 << key_index)
+
+        if self.length > cur_time:
+            yield mask, self.length - cur_time
+
+    def dump(self):
+        """
+        The parse result as a JSON-serializable dict (see load)
+        """
+        return {"length": self.length, "intervals": self.intervals}
 
-                        if duration > line_max_duration:
-                            line_max_duration = duration
+    def load(self, parsed):
+        """
+        Restore a parse result produced by dump, instead of parsing the file
+        """
+        self.intervals = [[], []]
+        self.length = parsed["length"]
+        self._starts = [[], []]
+        self._sequence = None
+        for character_num, intervals in enumerate(parsed["intervals"]):
+            for start, end, key_index in intervals:
+                self._add_interval(character_num, start, end, key_index)
+
+    def _add_interval(self, character_num, start, end, key_index):
+        self.intervals[character_num].append((start, end, key_index))
+        self._starts[character_num].append(start)
+
+    def parse(self, data=None):
+        """
+        Parse the level file, or data (its contents as bytes) if given
+        """
+        self.intervals = [[], []]
+        self.length = 0
+        self._starts = [[], []]
+        self._sequence = None
+
+        if data is None:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        cur_time = 0
+
+        character_num = -1  # 0 for fireboy, 1 for watergirl
+        character_parse_list = self.__CHARACTER_PARSE_MAP.copy()
+
+        for line in data.decode("utf8").splitlines():
+            line = line.split("#", 1)[0].strip()  # remove comments
+            if len(line) <= 0:
+                continue  # empty line so skip
+
+            if line in character_parse_list:
+                cur_time = 0
+                character_num = self.__CHARACTER_PARSE_MAP.index(line)
+                character_parse_list.remove(line)
+            else:
+                line_max_duration = -1
+                for part in line.split(","):
+                    command, duration = part.split()
+                    duration = int(duration)
+
+                    if command != "s":
+                        self._add_interval(character_num, cur_time, cur_time + duration,
+                                           self.__PARSE_MAP[character_num][command])
+                    # sleep commands only extend the level
+                    self.length = max(self.length, cur_time + duration)
+
+                    if duration > line_max_duration:
+                        line_max_duration = duration
+
+                cur_time += line_max_duration
+
+    def iter_asm(self):
+        """
+        Generate the asasm building this level's input Array, as a stream of chunks
+        """
+        yield 'findpropstrict QName(PackageNamespace(""), "Array")\n'
+        for mask, count in reversed(list(self.segments())):
+            frame_asm = self.__FRAME_ASM[mask]
+            while count > 0:
+                chunk_frames = min(count, self.__CHUNK_FRAMES)
+                yield frame_asm * chunk_frames
+                count -= chunk_frames
 
-                    cur_time += line_max_duration
+        yield 'constructprop QName(PackageNamespace(""), "Array"), ' + str(self.length) + "\n"
 
     def to_asm(self):
-        ret = 'findpropstrict QName(PackageNamespace(""), "Array")\n'
-        for frame in reversed(self.sequence):
-            ret += 'findpropstrict QName(PackageNamespace(""), "Array")\n'
-            for val in frame:
-                ret += "pushbyte " + str(val) + "\n"
-            ret += 'constructprop QName(PackageNamespace(""), "Array"), ' + str(len(frame)) + "\n"
+        return "".join(self.iter_asm())
+
+    def to_packed(self):
+        """
+        Pack the frames into a single string constant: the frame masks in decimal, comma separated and in
+        reverse order (frames are popped off the end of the Array in level.Update)
+        """
+        return ",".join(",".join([str(mask)] * count) for mask, count in reversed(list(self.segments())))
 
-        ret += 'constructprop QName(PackageNamespace(""), "Array"), ' + str(len(self.sequence)) + "\n"
-        return ret
+    def iter_packed_asm(self):
+        """
+        Generate the asasm building this level's input Array out of its packed string constant
+        """
+        if self.length == 0:
+            yield "newarray 0\n"  # "".split(",") would be [""], a frame of no keys
+            return
+        yield 'pushstring "' + self.to_packed() + '"\n'
+        yield 'pushstring ","\n'
+        yield 'callproperty QName(Namespace("http://adobe.com/AS3/2006/builtin"), "split"), 1\n'
+
+    def max_stack(self, packed=False):
+        """
+        Stack slots needed by iter_packed_asm (packed) or iter_asm: the frames built so far plus the frame being built
+        """
+        if packed:
+            return 2
+        return self.length + 1 + FrameStore.KEY_COUNT if self.length > 0 else 1
 
 class SwfModder:
-    __PATH_TMP = "tmp"
+    __PATH_CACHE = "cache"
+    __LEVEL_CACHE_SIZE = 256 * 2 ** 20
+    __CACHE_CHUNK_SIZE = 1024 * 1024
+    __PARALLEL_PARSE_SIZE = 1024 * 1024  # bytes of level files to parse before a process pool pays off
     __PATH_TAS = "tas"
-    __LEVELS_MAP = ["adventure", "puzzle", "speed"]
+    LEVEL_TYPES = ["adventure", "puzzle", "speed"]  # StartGame level type 1, 2, 3
+    __KEY_PROPERTIES = ["u_pressed", "r_pressed", "l_pressed", "u_pressed2", "r_pressed2", "l_pressed2"]
+
+    INPUT_MODE_ARRAY = "array"  # every frame is an Array of 6 flags
+    INPUT_MODE_PACKED = "packed"  # every level is a string of frame masks, decoded in level.Update
+    INPUT_MODES = [INPUT_MODE_ARRAY, INPUT_MODE_PACKED]
+
+    BACKEND_RABCDASM = "rabcdasm"  # patch the asasm disassembled by the rabcdasm tools
+    BACKEND_ABC = "abc"  # patch the bytecode in-process (abcfile.py), no external tools
+    BACKENDS = [BACKEND_RABCDASM, BACKEND_ABC]
+
+    CAPTURE_NAME = "fbwg-capture"  # SharedObject holding the binary input log of fbwg-replay.swf
+    CAPTURE_LEVEL_MARKER = 0x80  # log byte starting a level (| level type, followed by the level number byte)
+    CAPTURE_FLUSH_INTERVAL = 256  # log bytes between flushes (a power of 2), each one rewrites the whole .sol file
+
+    def __init__(self, swf_path, output_swf_path, tas_path=None, input_mode=INPUT_MODE_ARRAY, lazy_inputs=False,
+                 cache_path=None, backend=BACKEND_RABCDASM, capture=False):
+        if input_mode not in self.INPUT_MODES:
+            raise ValueError("Unknown input mode: " + str(input_mode))
+        if backend not in self.BACKENDS:
+            raise ValueError("Unknown backend: " + str(backend))
 
-    def __init__(self, swf_path, output_swf_path):
         self._swf_path = swf_path
         self._output_swf_path = output_swf_path
+        self._tas_path = tas_path if tas_path is not None else self.__PATH_TAS
+        self._cache_path = cache_path if cache_path is not None else self.__PATH_CACHE
+        self._input_mode = input_mode
+        self._lazy_inputs = lazy_inputs
+        self._backend = backend
+        self._capture = capture
 
         self._swf_name = os.path.splitext(os.path.basename(self._swf_path))[0]
-        self._tmp_swf_path = os.path.join(self.__PATH_TMP, self._swf_name + ".swf")
-        self._abc_path = os.path.join(self.__PATH_TMP, self._swf_name + "-0")
+        self._tmp_path = None  # private temp dir of the current build, so that modders never clobber each other
+        self._tmp_swf_path = None
+        self._abc_path = None
 
         self._parsed_tas_levels = {}
-
+        self._level_cache = None
+        self._loaded_levels = {}  # path -> ((mtime, size), TasLevelParser), kept warm across builds
+        self._swf = None  # SwfFile and AbcFile being patched by the abc backend
+        self._abc = None
+        self._patches = {}  # class name -> [Patch], applied together by apply_patches
+        self._new_traits = {}  # class name -> [traits asasm]
+
+    @tracing.traced("disassemble")
     def disassemble(self):
-        os.makedirs(self.__PATH_TMP, exist_ok=True)  # make tmp dir
+        """
+        Disassemble the base swf into a private temp dir, reusing the pristine disassembly cached for the same swf
+        content. Cached files are hardlinked into the temp dir, so patched files must be replaced (as _mod_file does),
+        never written in place. The abc backend parses the swf's bytecode in memory instead
+        """
+        if self._backend == self.BACKEND_ABC:
+            self._swf = SwfFile(self._swf_path)
+            self._abc = AbcFile(self._swf.abc)
+            return
+
+        self._tmp_path = tempfile.mkdtemp(prefix="fbwg-" + self._swf_name + "-")
+        self._tmp_swf_path = os.path.join(self._tmp_path, self._swf_name + ".swf")
+        self._abc_path = os.path.join(self._tmp_path, self._swf_name + "-0")
         shutil.copy(self._swf_path, self._tmp_swf_path)  # copy base swf
+
+        cache_path = os.path.join(self._cache_path, "asasm", hash_file(self._swf_path), self._swf_name + "-0")
+        if os.path.isdir(cache_path):
+            shutil.copytree(cache_path, self._abc_path, copy_function=link_or_copy)
+            return
+
         run("abcexport", os.path.abspath(self._tmp_swf_path))  # abcexport
-        run("rabcdasm", os.path.abspath(os.path.join(self.__PATH_TMP, self._swf_name + "-0.abc")))
+        run("rabcdasm", os.path.abspath(os.path.join(self._tmp_path, self._swf_name + "-0.abc")))
+
+        if os.path.isfile(os.path.join(self._abc_path, self._swf_name + "-0.main.asasm")):
+            # populate the cache (renamed into place so that an interrupted copy is never picked up,
+            # another build of the same swf may get there first)
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_cache_path = tempfile.mkdtemp(dir=os.path.dirname(cache_path))
+            shutil.copytree(self._abc_path, os.path.join(tmp_cache_path, "asasm"))
+            try:
+                os.rename(os.path.join(tmp_cache_path, "asasm"), cache_path)
+            except OSError:
+                pass
+            shutil.rmtree(tmp_cache_path)
 
     def mod_all(self):
         self.mod_levels()
         self.mod_inputs()
+        if self._capture:
+            self.mod_capture()
+        self.apply_patches()
+        self._get_level_cache().flush()
 
-    def _mod_file(self, file_path, start_lines, end_lines, replacement):
+    def _mod_file(self, file_path, patches):
         """
-        Internal method used for modding/patching asasm files
+        Internal method used for modding/patching asasm files: applies patches (see patcher.Patch) in a single streaming
+        pass, returning the ones that could not be applied as (file, patch, reason); the file is left untouched if any
         """
-        start_match_index = 0
-        end_match_index = 0
-
+        matcher = PatchMatcher(patches)
         with open(file_path, "r") as f:
             with open(file_path + ".mod", "w") as g:
-                ignoring = False
                 for line in f:
-                    if start_match_index == len(start_lines):
-                        g.write(replacement)
-                        start_match_index += 1
-                        ignoring = True
-                    if end_match_index >= len(end_lines):
-                        ignoring = False
-
-                    if len(line.strip()) > 0:
-                        if not ignoring:
-                            if start_match_index < len(start_lines):
-                                start, end = start_lines[start_match_index]
-                                if line.lstrip().startswith(start) and line.rstrip().endswith(end):
-                                    start_match_index += 1
-                                else:
-                                    start_match_index = 0
-                        else:
-                            if end_match_index < len(end_lines):
-                                start, end = end_lines[end_match_index]
-                                if line.lstrip().startswith(start) and line.rstrip().endswith(end):
-                                    end_match_index += 1
-                                else:
-                                    end_match_index = 0
-
-                    if not ignoring:
+                    keep, patch = matcher.feed(line)
+                    if keep:
                         g.write(line)
+                    if patch is not None:
+                        if isinstance(patch.replacement, str):
+                            g.write(patch.replacement)
+                        else:
+                            g.writelines(patch.replacement)
+                    if matcher.done:
+                        shutil.copyfileobj(f, g, self.__CACHE_CHUNK_SIZE)  # nothing left to match, copy the rest
+                        break
+
+        missing = matcher.missing(os.path.basename(file_path))
+        if missing:
+            os.remove(file_path + ".mod")
+            return missing
+        shutil.move(file_path + ".mod", file_path)  # replace file
+        return []
 
-                if ignoring:
-                    # if still ignoring, could not find end lines
-                    raise RuntimeError("Could not find end lines")
+    def _mod_class(self, class_name, start_lines, end_lines, replacement):
+        """
+        Queue a patch of the code of a class (see patcher.Patch), applied by apply_patches
+        """
+        self._patches.setdefault(class_name, []).append(Patch(start_lines, end_lines, replacement))
 
-        shutil.move(file_path + ".mod", file_path)  # replace file
+    def _add_instance_traits(self, class_name, traits_asm):
+        """
+        Queue traits declared in traits_asm (a string or an iterable of string chunks) to be added to the instances
+        of a class by apply_patches
+        """
+        self._new_traits.setdefault(class_name, []).append(traits_asm)
 
+    @staticmethod
+    def _iter_method_trait_asm(name, param_types, return_type, max_stack, local_count, code_asm):
+        """
+        Generate the asasm of a new level instance method trait, whose code_asm (an iterable of asasm chunks) runs
+        after the method's own scope is pushed. return_type None leaves the method untyped
+        """
+        yield 'trait method QName(PackageInternalNs(""), "' + name + '")\n'
+        yield "method\n"
+        yield 'refid "level/instance/' + name + '"\n'
+        for param_type in param_types:
+            yield "param " + param_type + "\n"
+        if return_type is not None:
+            yield "returns " + return_type + "\n"
+        yield "body\n"
+        yield "maxstack " + str(max_stack) + "\n"
+        yield "localcount " + str(local_count) + "\n"
+        yield "initscopedepth 9\n"  # same scope depths as the game's own level methods
+        yield "maxscopedepth 10\n"
+        yield "code\n"
+        yield "getlocal0\n"
+        yield "pushscope\n"
+        yield from code_asm
+        yield "end ; code\n"
+        yield "end ; body\n"
+        yield "end ; method\n"
+        yield "end ; trait\n"
+
+    @tracing.traced("patch")
+    def apply_patches(self):
+        """
+        Apply the queued patches and traits, in one pass per class.
+        Raises a PatchError listing every patch whose anchors were not found
+        """
+        patches, self._patches = self._patches, {}
+        new_traits, self._new_traits = self._new_traits, {}
+        if self._backend != self.BACKEND_ABC:
+            for class_name, traits in new_traits.items():
+                # right after the instance initializer, in a single patch as patches cannot share anchors
+                patches.setdefault(class_name, []).append(Patch([
+                    ("end", "code"),
+                    ("end", "body"),
+                    ("end", "method"),
+                ], [], (chunk for traits_asm in traits
+                        for chunk in ([traits_asm] if isinstance(traits_asm, str) else traits_asm))))
+            new_traits = {}
+
+        missing = []
+        for class_name, class_patches in patches.items():
+            if self._backend == self.BACKEND_ABC:
+                missing += self._abc.apply_patches(class_name, class_patches)
+            else:
+                missing += self._mod_file(os.path.join(self._abc_path, class_name + ".class.asasm"), class_patches)
+        if missing:
+            raise PatchError(missing)
+
+        for class_name, traits in new_traits.items():
+            for traits_asm in traits:
+                self._abc.add_instance_traits(class_name, traits_asm)
+
+    @tracing.traced("parse")
     def _parse_tas_levels(self):
+        level_files = {}
+        for level_type in os.listdir(self._tas_path):
+            if os.path.isdir(os.path.join(self._tas_path, level_type)):
+                level_files[level_type] = {
+                    int(os.path.splitext(x)[0]): os.path.join(self._tas_path, level_type, x)
+                    for x in os.listdir(os.path.join(self._tas_path, level_type)) if os.path.splitext(x)[0].isnumeric()
+                }
+
+        loaded = self._load_tas_levels([path for files in level_files.values() for path in files.values()])
         levels = {}
-        for level_type in os.listdir(self.__PATH_TAS):
-            if os.path.isdir(os.path.join(self.__PATH_TAS, level_type)):
-                parsed_levels = []
+        for level_type, files in level_files.items():
+            parsed_levels = []
+            for level_index in sorted(files):
+                for _ in range(level_index - len(parsed_levels)):
+                    parsed_levels.append(None)
+                parsed_levels.append(loaded[files[level_index]])
+            levels[level_type] = parsed_levels
+        self._parsed_tas_levels = levels
 
-                for tas_file in sorted([x for x in os.listdir(os.path.join(self.__PATH_TAS, level_type))
-                                        if os.path.splitext(x)[0].isnumeric()],
-                                       key=lambda file: int(os.path.splitext(file)[0])):
-                    level_index = int(os.path.splitext(tas_file)[0])
-                    tas_file_path = os.path.join(self.__PATH_TAS, level_type, tas_file)
+    def _get_level_cache(self):
+        if self._level_cache is None:
+            self._level_cache = DiskCache(os.path.join(self._cache_path, "levels"), self.__LEVEL_CACHE_SIZE,
+                                          TasLevelParser.VERSION)
+        return self._level_cache
 
-                    for _ in range(level_index - len(parsed_levels)):
-                        parsed_levels.append(None)
+    def _load_tas_levels(self, tas_file_paths):
+        """
+        Parse TAS level files (path -> TasLevelParser), reusing the parse results cached for the same file contents.
+        Large batches of uncached files are parsed in a process pool.
+        Each file is read once: its hash, parse and memo key all come from the same read, so that a file saved in
+        between can never be cached under another content's hash
+        """
+        level_cache = self._get_level_cache()
+        loaded = {}
+        to_parse = []
+        for tas_file_path in tas_file_paths:
+            st = os.stat(tas_file_path)
+            memo = self._loaded_levels.get(tas_file_path)
+            if memo is not None and memo[0] == (st.st_mtime_ns, st.st_size):
+                loaded[tas_file_path] = memo[1]
+                continue
+
+            with open(tas_file_path, "rb") as f:
+                st = os.fstat(f.fileno())  # taken before reading: a later write changes it, and is read next time
+                data = f.read()
+            t = TasLevelParser(tas_file_path)
+            t.content_hash = hashlib.sha256(data).hexdigest()
+            cached_path = level_cache.get(t.content_hash + ".json")
+            if cached_path is not None:
+                with open(cached_path, "r") as f:
+                    t.load(json.load(f))
+            else:
+                to_parse.append((t, st, data))
+                continue
+            self._loaded_levels[tas_file_path] = ((st.st_mtime_ns, st.st_size), t)
+            loaded[tas_file_path] = t
+
+        if len(to_parse) > 1 and sum(len(data) for _, _, data in to_parse) >= self.__PARALLEL_PARSE_SIZE:
+            with ProcessPoolExecutor() as pool:
+                for (t, _, _), parsed in zip(to_parse, pool.map(_parse_level_file, *zip(*[
+                        (t.path, data) for t, _, data in to_parse]))):
+                    t.load(parsed)
+        else:
+            for t, _, data in to_parse:
+                t.parse(data)
+        for t, st, _ in to_parse:
+            with level_cache.write(t.content_hash + ".json") as f:
+                json.dump(t.dump(), f)
+            self._loaded_levels[t.path] = ((st.st_mtime_ns, st.st_size), t)
+            loaded[t.path] = t
+        return loaded
+
+    def _iter_level_asm(self, tas_level, packed):
+        """
+        Generate a level's input asasm, streamed from the cache if it was already generated for the same file content
+        """
+        level_cache = self._get_level_cache()
+        key = tas_level.content_hash + ("-packed" if packed else "-array") + ".asasm"
 
-                    t = TasLevelParser(tas_file_path)
-                    t.parse()
-                    parsed_levels.append(t)
+        cached_path = level_cache.get(key)
+        if cached_path is not None:
+            with open(cached_path, "r") as f:
+                yield from iter(lambda: f.read(self.__CACHE_CHUNK_SIZE), "")
+            return
 
-                levels[level_type] = parsed_levels
-        self._parsed_tas_levels = levels
+        with level_cache.write(key) as f:
+            for chunk in tracing.traced_iter("codegen", tas_level.iter_packed_asm() if packed else tas_level.iter_asm(),
+                                             level=tas_level.path):
+                f.write(chunk)
+                yield chunk
 
     def mod_inputs(self):
         """
         Inject the TAS inputs into asasm
         """
         self._parse_tas_levels()
-        ret = ""
-        for level_type, parsed_levels in self._parsed_tas_levels.items():
-            ret += "getlocal0\n"
-            ret += 'findpropstrict QName(PackageNamespace(""), "Array")\n'
+        self._mod_class("level", [
+            ("pushdouble", "0.0384615384615385"),
+            ("convert_d", ""),
+            ("setproperty", 'QName(PackageNamespace(""), "m_timeStep")'),
+        ], [
+            [
+                ("constructprop", 'QName(PackageNamespace(""), "Array"), 23'),
+                ("constructprop", 'QName(PackageNamespace(""), "Array"), 2'),
+                ("setproperty", 'QName(PackageInternalNs(""), "pzPuzzleInputs")')
+            ], [
+                ("constructprop", 'QName(PackageNamespace(""), "Array"), 0'),
+                ("constructprop", 'QName(PackageNamespace(""), "Array"), 2'),
+                ("setproperty", 'QName(PackageInternalNs(""), "pzPuzzleInputs")')
+            ]
+        ], self._iter_inputs_asm())
 
-            for tas_level in parsed_levels:
+        if self._input_mode == self.INPUT_MODE_PACKED:
+            self.mod_input_decoder()
+        if self._lazy_inputs:
+            self.mod_lazy_inputs()
+
+    def mod_lazy_inputs(self):
+        """
+        Add a pz<Type>InputsAt(number) method per level type to level, building only the inputs of the given level,
+        and have the level constructor call it instead of indexing the eagerly built pz<Type>Inputs
+        """
+        for level_type in self.LEVEL_TYPES:
+            self._mod_class("level", [
+                ("pushstring", '"' + level_type + '"'),
+                ("ifne", ""),
+                ("getlocal0", ""),
+                ("getlocal0", ""),
+            ], [
+                ("getproperty", 'QName(PackageInternalNs(""), "pz' + level_type.title() + 'Inputs")'),
+                ("getlocal2", ""),
+                ("getproperty", ""),
+            ], "getlocal2\n"
+               'callproperty QName(PackageInternalNs(""), "pz' + level_type.title() + 'InputsAt"), 1\n')
+
+        self._add_instance_traits("level", self._iter_lazy_inputs_asm())
+
+    def _iter_lazy_inputs_asm(self):
+        packed = self._input_mode == self.INPUT_MODE_PACKED
+        for level_type in self.LEVEL_TYPES:
+            parsed_levels = self._parsed_tas_levels.get(level_type, [])
+            max_stack = max([1] + [tas_level.max_stack(packed) for tas_level in parsed_levels if tas_level is not None])
+            yield from self._iter_method_trait_asm("pz" + level_type.title() + "InputsAt",
+                                                   ['QName(PackageNamespace(""), "int")'], None, max_stack, 2,
+                                                   self._iter_inputs_at_asm(parsed_levels, packed))
+
+    def _iter_inputs_at_asm(self, parsed_levels, packed):
+        if len(parsed_levels) > 0:
+            yield "getlocal1\n"
+            yield "lookupswitch L" + str(len(parsed_levels)) + ", [" + \
+                  ", ".join("L" + str(i) for i in range(len(parsed_levels))) + "]\n"
+            for i, tas_level in enumerate(parsed_levels):
+                yield "L" + str(i) + ":\n"
                 if tas_level is None:
-                    ret += "pushnull\n"
+                    yield "pushnull\n"
                 else:
-                    ret += tas_level.to_asm()
+                    yield from self._iter_level_asm(tas_level, packed)
+                yield "returnvalue\n"
+            yield "L" + str(len(parsed_levels)) + ":\n"
+        yield "pushnull\n"
+        yield "returnvalue\n"
 
-            ret += 'constructprop QName(PackageNamespace(""), "Array"), ' + str(len(parsed_levels)) + '\n'
-            ret += 'setproperty QName(PackageInternalNs(""), "pz' + level_type.title() + 'Inputs")\n'
+    def mod_input_decoder(self):
+        """
+        Make level.Update read each popped frame as a packed key mask rather than an Array of flags
+        """
+        self._mod_class("level", [
+            ("getproperty", 'QName(PackageInternalNs(""), "pzInputs")'),
+            ("callproperty", ", 0"),
+        ], [
+            ("setproperty", 'QName(PackageInternalNs(""), "l_pressed2")'),
+        ], self._iter_input_decoder_asm())
+
+    def _iter_input_decoder_asm(self):
+        # an exhausted input Array pops undefined, which converts to 0 (no keys pressed)
+        yield "convert_i\n"
+        yield "setlocal 17\n"
+        for i, key_property in enumerate(self.__KEY_PROPERTIES):
+            yield "getlocal0\n"
+            yield "getlocal 17\n"
+            yield "pushbyte " + str(i) + "\n"
+            yield "rshift\n"
+            yield "pushbyte 1\n"
+            yield "bitand\n"
+            yield "pushbyte 1\n"
+            yield "equals\n"
+            yield 'setproperty QName(PackageInternalNs(""), "' + key_property + '")\n'
+
+    def mod_capture(self):
+        """
+        Make fbwg-replay.swf log the played inputs to a binary log in the CAPTURE_NAME SharedObject, instead of
+        appending them to a string copied to the clipboard every frame: one key mask byte per frame (as in FrameStore),
+        and CAPTURE_LEVEL_MARKER | level type, level number whenever a level starts
+        """
+        self._mod_class("level", [
+            ("pushstring", '"gr"'),
+            ("coerce_a", ""),
+            ("setlocal", "8"),
+        ], [], "getlocal0\n"
+               "getlocal1\n"
+               "getlocal2\n"
+               'callpropvoid QName(PackageInternalNs(""), "pzCaptureLevel"), 2\n')
+        self._mod_class("level", [
+            ("setproperty", 'QName(PackageInternalNs(""), "l_pressed2")'),
+            ("L", ":"),
+        ], [
+            ('callpropvoid Multiname("setClipboard"', ", 1"),
+        ], self._iter_capture_frame_asm())
+        self._add_instance_traits("level", self._iter_capture_traits_asm())
+
+    def _iter_capture_frame_asm(self):
+        yield "getlocal0\n"
+        for i, key_property in enumerate(self.__KEY_PROPERTIES):
+            yield "getlocal0\n"
+            yield 'getproperty QName(PackageInternalNs(""), "' + key_property + '")\n'
+            yield "convert_i\n"
+            if i > 0:
+                yield "pushbyte " + str(i) + "\n"
+                yield "lshift\n"
+                yield "bitor\n"
+        yield 'callpropvoid QName(PackageInternalNs(""), "pzCaptureFrame"), 1\n'
+
+    def _iter_capture_traits_asm(self):
+        public = 'QName(PackageNamespace(""), "{}")'.format
+        methods = [
+            # the SharedObject, with its log created on first use
+            ("pzCaptureLog", [], public("Object"), 3, 2, [
+                'getlex QName(PackageNamespace("flash.net"), "SharedObject")',
+                'pushstring "' + self.CAPTURE_NAME + '"',
+                'callproperty ' + public("getLocal") + ', 1',
+                "coerce_a",
+                "setlocal1",
+                "getlocal1",
+                "getproperty " + public("data"),
+                "getproperty " + public("log"),
+                "iftrue PZ_LOG_READY",
+                "getlocal1",
+                "getproperty " + public("data"),
+                'findpropstrict QName(PackageNamespace("flash.utils"), "ByteArray")',
+                'constructprop QName(PackageNamespace("flash.utils"), "ByteArray"), 0',
+                "setproperty " + public("log"),
+                "PZ_LOG_READY:",
+                "getlocal1",
+                "returnvalue",
+            ]),
+            # level marker, flushed right away
+            ("pzCaptureLevel", [public("String"), public("int")], public("void"), 6, 4, [
+                "getlocal0",
+                'callproperty QName(PackageInternalNs(""), "pzCaptureLog"), 0',
+                "coerce_a",
+                "dup",
+                "setlocal3",
+                "getproperty " + public("data"),
+                "getproperty " + public("log"),
+                "dup",
+                *('pushstring "' + x + '"' for x in self.LEVEL_TYPES),
+                "newarray " + str(len(self.LEVEL_TYPES)),
+                "getlocal1",
+                'callproperty QName(Namespace("http://adobe.com/AS3/2006/builtin"), "indexOf"), 1',
+                "increment_i",
+                "pushshort " + str(self.CAPTURE_LEVEL_MARKER),
+                "bitor",
+                "callpropvoid " + public("writeByte") + ", 1",
+                "getlocal2",
+                "callpropvoid " + public("writeByte") + ", 1",
+                "getlocal3",
+                "callpropvoid " + public("flush") + ", 0",
+                "returnvoid",
+            ]),
+            # frame key mask, flushed every CAPTURE_FLUSH_INTERVAL bytes (the player flushes the rest when closed)
+            ("pzCaptureFrame", [public("int")], public("void"), 3, 3, [
+                "getlocal0",
+                'callproperty QName(PackageInternalNs(""), "pzCaptureLog"), 0',
+                "coerce_a",
+                "setlocal2",
+                "getlocal2",
+                "getproperty " + public("data"),
+                "getproperty " + public("log"),
+                "dup",
+                "getlocal1",
+                "callpropvoid " + public("writeByte") + ", 1",
+                "getproperty " + public("length"),
+                "pushshort " + str(self.CAPTURE_FLUSH_INTERVAL - 1),
+                "bitand",
+                "iftrue PZ_NO_FLUSH",
+                "getlocal2",
+                "callpropvoid " + public("flush") + ", 0",
+                "PZ_NO_FLUSH:",
+                "returnvoid",
+            ]),
+        ]
+        for name, param_types, return_type, max_stack, local_count, code in methods:
+            yield from self._iter_method_trait_asm(name, param_types, return_type, max_stack, local_count,
+                                                   (line + "\n" for line in code))
+
+    def _iter_inputs_asm(self):
+        if self._lazy_inputs:
+            return  # the inputs are built on demand by the pz<Type>InputsAt methods instead
 
-        try:
-            self._mod_file(os.path.join(self._abc_path, "level.class.asasm"), [
-                ("pushdouble", "0.0384615384615385"),
-                ("convert_d", ""),
-                ("setproperty", 'QName(PackageNamespace(""), "m_timeStep")'),
-            ], [
-                ("constructprop", 'QName(PackageNamespace(""), "Array"), 23'),
-                ("constructprop", 'QName(PackageNamespace(""), "Array"), 2'),
-                ("setproperty", 'QName(PackageInternalNs(""), "pzPuzzleInputs")')
+        for level_type, parsed_levels in self._parsed_tas_levels.items():
+            yield "getlocal0\n"
+            yield 'findpropstrict QName(PackageNamespace(""), "Array")\n'
 
-            ], ret)
-        except RuntimeError:
-            self._mod_file(os.path.join(self._abc_path, "level.class.asasm"), [
-                ("pushdouble", "0.0384615384615385"),
-                ("convert_d", ""),
-                ("setproperty", 'QName(PackageNamespace(""), "m_timeStep")'),
-            ], [
-               ("constructprop", 'QName(PackageNamespace(""), "Array"), 0'),
-               ("constructprop", 'QName(PackageNamespace(""), "Array"), 2'),
-               ("setproperty", 'QName(PackageInternalNs(""), "pzPuzzleInputs")')
+            for tas_level in parsed_levels:
+                if tas_level is None:
+                    yield "pushnull\n"
+                else:
+                    yield from self._iter_level_asm(tas_level, self._input_mode == self.INPUT_MODE_PACKED)
 
-           ], ret)
+            yield 'constructprop QName(PackageNamespace(""), "Array"), ' + str(len(parsed_levels)) + '\n'
+            yield 'setproperty QName(PackageInternalNs(""), "pz' + level_type.title() + 'Inputs")\n'
 
-    def _get_levels_asm(self):
+    def _read_levels(self):
         levels = []
-        with open(os.path.join("tas", "levels.txt"), "r") as f:
+        with open(os.path.join(self._tas_path, "levels.txt"), "r") as f:
             for line in f:
-                levels.append([int(x) for x in line.strip().split(",")])
+                if line.strip():
+                    levels.append([int(x) for x in line.strip().split(",")])
+        return levels
 
-        ret = 'findpropstrict QName(PackageNamespace(""), "Array")\n'
+    @staticmethod
+    def _levels_max_stack(levels):
+        """
+        Peak stack depth reached by _iter_levels_asm, relative to the depth it starts at: the outer Array's
+        constructor, the levels built so far and the constructor and values of the level being built
+        """
+        return max([1] + [i + 2 + len(level) for i, level in enumerate(reversed(levels))])
+
+    def _iter_levels_asm(self, levels):
+        yield 'findpropstrict QName(PackageNamespace(""), "Array")\n'
         for level in reversed(levels):
-            ret += 'findpropstrict QName(PackageNamespace(""), "Array")\n'
+            yield 'findpropstrict QName(PackageNamespace(""), "Array")\n'
             for val in level:
-                ret += "pushbyte " + str(val) + "\n"
-            ret += 'constructprop QName(PackageNamespace(""), "Array"), ' + str(len(level)) + "\n"
+                yield "pushbyte " + str(val) + "\n"
+            yield 'constructprop QName(PackageNamespace(""), "Array"), ' + str(len(level)) + "\n"
 
-        ret += 'constructprop QName(PackageNamespace(""), "Array"), ' + str(len(levels)) + "\n"
-        ret += 'setproperty QName(PackageInternalNs(""), "pzLevels")\n'
-        return ret
+        yield 'constructprop QName(PackageNamespace(""), "Array"), ' + str(len(levels)) + "\n"
+        yield 'setproperty QName(PackageInternalNs(""), "pzLevels")\n'
 
     def mod_levels(self):
         """
         Inject the TAS level visit order into asasm
         """
-        self._mod_file(os.path.join(self._abc_path, "Game.class.asasm"), [
+        levels = self._read_levels()
+        self._mod_class("Game", [
             ("getlocal0", ""),
             ("pushscope", ""),
-            ("debug", '1, "_loc1_", 0, 118'),
+            ("debug", ""),  # its line number differs between the base swfs
             ("getlocal0", "")
         ], [
             ('constructprop', 'QName(PackageNamespace(""), "Array"), 2'),
             ('constructprop', 'QName(PackageNamespace(""), "Array"), 2'),
             ('setproperty', 'QName(PackageInternalNs(""), "pzLevels")')
-        ], self._get_levels_asm())
+        ], self._iter_levels_asm(levels))
+        if self._backend != self.BACKEND_ABC:
+            # rabcasm keeps the declared maxstack, the abc backend grows it by the inserted code's peak itself
+            self._grow_iinit_max_stack("Game", self._levels_max_stack(levels))
 
+    def _grow_iinit_max_stack(self, class_name, peak):
+        """
+        Queue a patch raising the maxstack of a class' instance initializer (the first method body of its asasm) by
+        the peak stack depth of code inserted into it
+        """
+        start_lines, end_lines = [("body", "")], [("maxstack", "")]
+        max_stack = None
+        with open(os.path.join(self._abc_path, class_name + ".class.asasm"), "r") as f:
+            for line in f:
+                if line.strip() == "body":
+                    line = next(f, "").split()
+                    if len(line) == 2 and line[0] == "maxstack":
+                        max_stack = int(line[1])
+                    break
+        if max_stack is None:
+            raise PatchError([(class_name + ".class.asasm", Patch(start_lines, end_lines, ""),
+                               "iinit maxstack not found")])
+        self._mod_class(class_name, start_lines, end_lines, "maxstack " + str(max_stack + peak) + "\n")
+
+    @tracing.traced("reassemble")
     def reassemble(self):
-        run("rabcasm", os.path.abspath(os.path.join(self.__PATH_TMP, self._swf_name + "-0", self._swf_name + "-0.main.asasm")))
+        if self._backend == self.BACKEND_ABC:
+            self._swf.abc = self._abc.tobytes()
+            self._swf.save(self._output_swf_path)
+            self._swf = self._abc = None
+            return
+
+        run("rabcasm", os.path.abspath(os.path.join(self._abc_path, self._swf_name + "-0.main.asasm")))
         run("abcreplace", os.path.abspath(self._tmp_swf_path), "0", os.path.abspath(os.path.join(self._abc_path, self._swf_name + "-0.main.abc")))
         shutil.move(self._tmp_swf_path, self._output_swf_path)
-        shutil.rmtree(self.__PATH_TMP)
+        self.cleanup()
+
+    def cleanup(self):
+        """
+        Drop the state of an unfinished build (temp dir, parsed swf)
+        """
+        if self._tmp_path is not None:
+            shutil.rmtree(self._tmp_path, ignore_errors=True)
+            self._tmp_path = self._tmp_swf_path = self._abc_path = None
+        self._swf = self._abc = None
+        self._patches = {}
+        self._new_traits = {}
+
+    @tracing.traced("build")
+    def build(self):
+        try:
+            self.disassemble()
+            self.mod_all()
+            self.reassemble()
+        finally:
+            self.cleanup()
+
+    @classmethod
+    def build_all(cls, targets, tas_path=None, workers=None, **kwargs):
+        """
+        Build several swfs, given as (swf_path, output_swf_path) pairs, from the same TAS: the levels are parsed once
+        and shared, and the swfs are built concurrently (the rabcdasm tools run in parallel, each build in its own
+        temp dir). kwargs are passed on to every SwfModder. Returns the modders, for relaunching or rebuilding
+        """
+        modders = [cls(swf_path, output_swf_path, tas_path=tas_path, **kwargs) for swf_path, output_swf_path in targets]
+        if not modders:
+            return modders
+
+        modders[0]._parse_tas_levels()
+        for m in modders[1:]:
+            m._share_levels(modders[0])
+
+        with ThreadPoolExecutor(max_workers=workers or len(modders)) as pool:
+            for future in [pool.submit(m.build) for m in modders]:
+                future.result()
+        modders[0]._get_level_cache().flush()
+        return modders
+
+    def _share_levels(self, other):
+        """
+        Use the parsed levels and the level cache of another modder of the same TAS
+        """
+        self._loaded_levels = other._loaded_levels
+        self._level_cache = other._get_level_cache()
+
+    def watch(self, launch=False, debounce=0.2):
+        """
+        Rebuild whenever the TAS files change (and relaunch the swf if launch), until interrupted
+        """
+        watcher = FileWatcher(self._tas_path)
+        print("Watching {} ({})".format(self._tas_path, "inotify" if watcher.uses_inotify else "polling"))
+
+        proc = None
+        try:
+            while True:
+                changed = watcher.wait(debounce)
+                start = time.perf_counter()
+                print("Changed: " + ", ".join(sorted(os.path.relpath(x, self._tas_path) for x in changed)))
+                try:
+                    self.build()
+                except Exception as e:
+                    # most likely a half-written TAS file, keep watching
+                    print("Rebuild failed: {!r}".format(e))
+                    continue
+                print("Rebuilt in {:.3f}s (+{:.3f}s debounce)".format(time.perf_counter() - start, debounce))
+
+                if launch:
+                    if proc is not None:
+                        proc.kill()
+                    proc = self.launch_async()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+            if proc is not None:
+                proc.kill()
 
     def launch(self):
         if os.name == "posix":
-            import time
-            proc = subprocess.Popen("flashplayer '" + os.path.abspath(self._output_swf_path) + "'", shell=True)
-            time.sleep(0.5)
-            click_swf()
+            proc, _ = launch_swf(self._output_swf_path)
             proc.wait()
         else:
             return run("flashplayer", os.path.abspath(self._output_swf_path))
 
     def launch_async(self):
         if os.name == "posix":
-            import time
-            proc = subprocess.Popen("flashplayer '" + os.path.abspath(self._output_swf_path) + "'", shell=True)
-            time.sleep(0.5)
-            click_swf()
+            proc, _ = launch_swf(self._output_swf_path)
             return proc
         else:
             return run_async("flashplayer", os.path.abspath(self._output_swf_path))
 
 if __name__ == '__main__':
-    m = SwfModder(os.path.join("swf", "fbwg-base-dev.swf"), os.path.join("swf", "fbwg-tas.swf"))
-    m.disassemble()
-    m.mod_all()
-    m.reassemble()
-    m.launch()
+    parser = argparse.ArgumentParser(description="Inject the TAS in tas/ into fbwg-tas.swf and launch it")
+    parser.add_argument("--input-mode", choices=SwfModder.INPUT_MODES, default=SwfModder.INPUT_MODE_ARRAY,
+                        help="how the inputs are encoded in the swf")
+    parser.add_argument("--lazy-inputs", action="store_true",
+                        help="only build the inputs of a level once the game starts it")
+    parser.add_argument("--backend", choices=SwfModder.BACKENDS, default=SwfModder.BACKEND_RABCDASM,
+                        help="patch the asasm from the rabcdasm tools or the bytecode in-process")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and rebuild whenever a file under tas/ changes")
+    parser.add_argument("--no-launch", action="store_true",
+                        help="do not launch the swf after building")
+    parser.add_argument("--variant", nargs=2, action="append", metavar=("SWF", "OUTPUT_SWF"),
+                        help="build SWF into OUTPUT_SWF instead (repeat to build several concurrently, "
+                             "the first one is launched/watched)")
+    args = parser.parse_args()
+
+    if args.variant:
+        m = SwfModder.build_all(args.variant, input_mode=args.input_mode, lazy_inputs=args.lazy_inputs,
+                                backend=args.backend)[0]
+    else:
+        m = SwfModder(os.path.join("swf", "fbwg-base-dev.swf"), os.path.join("swf", "fbwg-tas.swf"),
+                      input_mode=args.input_mode, lazy_inputs=args.lazy_inputs, backend=args.backend)
+        m.build()
+    if args.watch:
+        m.watch(launch=not args.no_launch)
+    elif not args.no_launch:
+        m.launch()
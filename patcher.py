@@ -0,0 +1,119 @@
+class Patch:
+    """
+    Anchored patch of asasm lines: replacement is inserted after the first run of lines matching start_lines, in place
+    of everything up to and including the next run of lines matching end_lines (nothing if end_lines is empty).
+    A line matches an anchor (start, end) when, stripped, it starts with start and ends with end.
+    end_lines can also be a list of alternatives, the first one to match ends the patch.
+    replacement is a string or an iterable of string chunks
+    """
+
+    def __init__(self, start_lines, end_lines, replacement):
+        if not start_lines:
+            raise ValueError("A patch needs start lines")
+        self.start_lines = start_lines
+        if end_lines and isinstance(end_lines[0], list):
+            self.end_alternatives = end_lines
+        else:
+            self.end_alternatives = [end_lines]
+        self.replacement = replacement
+
+    def describe(self):
+        return " / ".join((start + " " + end).strip() for start, end in self.start_lines)
+
+
+class PatchError(RuntimeError):
+    """
+    Raised with every patch whose anchors could not be found, as (target, patch, reason)
+    """
+
+    def __init__(self, missing):
+        self.missing = missing
+        super().__init__("Could not apply {} patch(es):\n".format(len(missing)) + "\n".join(
+            "  {}: {} ({})".format(target, patch.describe(), reason) for target, patch, reason in missing))
+
+
+class PatchMatcher:
+    """
+    Applies a set of patches to a stream of lines in a single pass. Each patch applies once, at its first match, and
+    patches do not overlap: the lines replaced by one patch are not matched against the others
+    """
+
+    def __init__(self, patches):
+        self.pending = list(patches)
+        self._start_indices = [0] * len(self.pending)
+        self._region = None  # the patch whose lines are being replaced, and its match index per end alternative
+        self._region_indices = None
+        self._unterminated = []
+        # a line none of the anchors start with resets every partial match at once
+        self._anchor_starts = tuple({start for patch in self.pending
+                                     for start, _ in patch.start_lines + [x for y in patch.end_alternatives for x in y]})
+
+    @property
+    def done(self):
+        return not self.pending and self._region is None
+
+    @staticmethod
+    def _matches(line, anchor):
+        start, end = anchor
+        return line.lstrip().startswith(start) and line.rstrip().endswith(end)
+
+    def feed(self, line):
+        """
+        Match the next line, returning (whether the line is kept, the patch whose replacement goes after it or None)
+        """
+        if not line.strip():
+            return self._region is None, None
+
+        if self._region is not None:
+            if not line.lstrip().startswith(self._anchor_starts):
+                self._region_indices = [0] * len(self._region_indices)
+                return False, None
+            for i, end_lines in enumerate(self._region.end_alternatives):
+                if self._matches(line, end_lines[self._region_indices[i]]):
+                    self._region_indices[i] += 1
+                    if self._region_indices[i] == len(end_lines):
+                        self._region = None
+                        break
+                else:
+                    self._region_indices[i] = 0
+            return False, None
+
+        if not line.lstrip().startswith(self._anchor_starts):
+            if any(self._start_indices):
+                self._start_indices = [0] * len(self._start_indices)
+            return True, None
+
+        for i, patch in enumerate(self.pending):
+            if self._matches(line, patch.start_lines[self._start_indices[i]]):
+                self._start_indices[i] += 1
+                if self._start_indices[i] == len(patch.start_lines):
+                    self._start(i)
+                    return True, patch
+            else:
+                self._start_indices[i] = 0
+        return True, None
+
+    def _start(self, i):
+        patch = self.pending.pop(i)
+        self._start_indices = [0] * len(self.pending)
+        if all(end_lines for end_lines in patch.end_alternatives):
+            self._region = patch
+            self._region_indices = [0] * len(patch.end_alternatives)
+
+    def reset(self):
+        """
+        Drop partial matches, at a boundary no patch can span (e.g. between methods). A patch still looking for its
+        end lines is unterminated
+        """
+        if self._region is not None:
+            self._unterminated.append(self._region)
+            self._region = None
+        self._start_indices = [0] * len(self.pending)
+
+    def missing(self, target):
+        """
+        The patches that could not be applied, as (target, patch, reason)
+        """
+        self.reset()
+        return [(target, patch, "end lines not found") for patch in self._unterminated] + \
+               [(target, patch, "start lines not found") for patch in self.pending]
@@ -0,0 +1,606 @@
+#!/bin/env python3
+"""
+Records a flashplayer window in a frame-synchronised fashion.
+fbwg-base-dev-clip.swf must be used for this to work -- that swf file has been modded
+so that the clipboard is updated with the current frame number for every frame that is run.
+
+The key benefit of recording in this way is that it tries to stabilise the time-differences in
+adjacent frames of the resulting videos, which is introduced due to the game running at a variable fps.
+(NB: the fps seems to fluctuate particularly greatly for the initial second or so of each level)
+
+This allows for better direct comparison between recordings of different runs as it
+reduces the likelihood that the recordings will fall out of sync with each other.
+
+When dealing with time improvements in the order of fractions of seconds, the stability
+of the game is insufficient for the direct comparison of unsynchronised screen recordings.
+
+Technical details:
+a single X connection is kept for the whole recording. Clipboard ownership changes (XFixes) signal new frames,
+whose number is then read from the clipboard, and the window is grabbed into a reused shared memory image (XShm).
+Frames are streamed to ffmpeg as raw video, the frames missed in between are padded with the previous one.
+wait_for_window() uses the same bindings to wait for the flashplayer window to be mapped (util.launch_swf), and
+close_window() to close it gracefully (util.close_swf).
+"""
+import os
+import time
+import select
+import signal
+import ctypes
+import ctypes.util
+import argparse
+import threading
+import subprocess
+from ctypes import c_int, c_uint, c_long, c_ulong, c_char_p, c_void_p, c_size_t, c_ubyte, POINTER
+
+
+class _XImage(ctypes.Structure):
+    _fields_ = [("width", c_int), ("height", c_int), ("xoffset", c_int), ("format", c_int), ("data", c_void_p),
+                ("byte_order", c_int), ("bitmap_unit", c_int), ("bitmap_bit_order", c_int), ("bitmap_pad", c_int),
+                ("depth", c_int), ("bytes_per_line", c_int), ("bits_per_pixel", c_int),
+                ("red_mask", c_ulong), ("green_mask", c_ulong), ("blue_mask", c_ulong), ("obdata", c_void_p),
+                ("create_image", c_void_p), ("destroy_image", c_void_p), ("get_pixel", c_void_p),
+                ("put_pixel", c_void_p), ("sub_image", c_void_p), ("add_pixel", c_void_p)]
+
+
+class _XWindowAttributes(ctypes.Structure):
+    _fields_ = [("x", c_int), ("y", c_int), ("width", c_int), ("height", c_int), ("border_width", c_int),
+                ("depth", c_int), ("visual", c_void_p), ("root", c_ulong), ("class_", c_int), ("bit_gravity", c_int),
+                ("win_gravity", c_int), ("backing_store", c_int), ("backing_planes", c_ulong),
+                ("backing_pixel", c_ulong), ("save_under", c_int), ("colormap", c_ulong), ("map_installed", c_int),
+                ("map_state", c_int), ("all_event_masks", c_long), ("your_event_mask", c_long),
+                ("do_not_propagate_mask", c_long), ("override_redirect", c_int), ("screen", c_void_p)]
+
+
+class _XSelectionEvent(ctypes.Structure):
+    _fields_ = [("type", c_int), ("serial", c_ulong), ("send_event", c_int), ("display", c_void_p),
+                ("requestor", c_ulong), ("selection", c_ulong), ("target", c_ulong), ("property", c_ulong),
+                ("time", c_ulong)]
+
+
+class _XMapEvent(ctypes.Structure):
+    _fields_ = [("type", c_int), ("serial", c_ulong), ("send_event", c_int), ("display", c_void_p),
+                ("event", c_ulong), ("window", c_ulong), ("override_redirect", c_int)]
+
+
+class _XClientMessageEvent(ctypes.Structure):
+    _fields_ = [("type", c_int), ("serial", c_ulong), ("send_event", c_int), ("display", c_void_p),
+                ("window", c_ulong), ("message_type", c_ulong), ("format", c_int), ("data", c_long * 5)]
+
+
+class _XEvent(ctypes.Union):
+    _fields_ = [("type", c_int), ("selection", _XSelectionEvent), ("map", _XMapEvent),
+                ("client", _XClientMessageEvent), ("pad", c_long * 24)]
+
+
+class _XErrorEvent(ctypes.Structure):
+    _fields_ = [("type", c_int), ("display", c_void_p), ("resourceid", c_ulong), ("serial", c_ulong),
+                ("error_code", c_ubyte), ("request_code", c_ubyte), ("minor_code", c_ubyte)]
+
+
+class _XShmSegmentInfo(ctypes.Structure):
+    _fields_ = [("shmseg", c_ulong), ("shmid", c_int), ("shmaddr", c_void_p), ("readOnly", c_int)]
+
+
+_X_ERROR_HANDLER = ctypes.CFUNCTYPE(c_int, c_void_p, POINTER(_XErrorEvent))
+_X_DESTROY_IMAGE = ctypes.CFUNCTYPE(c_int, POINTER(_XImage))
+
+_libs = None
+_libs_lock = threading.Lock()
+_x_errors = {}  # display -> error code of the last failed request
+
+
+@_X_ERROR_HANDLER
+def _on_x_error(display, event):
+    # the default handler exits the process, errors are checked after the requests that can fail instead
+    _x_errors[display] = event.contents.error_code
+    return 0
+
+
+def _load_library(name):
+    path = ctypes.util.find_library(name)
+    if path is None:
+        return None
+    return ctypes.CDLL(path, use_errno=True)
+
+
+def _load_libraries():
+    """
+    Load and declare the Xlib (and optional XShm/XFixes) functions the recorder needs, once
+    """
+    global _libs
+    with _libs_lock:
+        if _libs is not None:
+            return _libs
+
+        x11 = _load_library("X11")
+        if x11 is None:
+            raise OSError("libX11 not found")
+        libc = _load_library("c")
+        xext = _load_library("Xext")
+        xfixes = _load_library("Xfixes")
+
+        def declare(lib, name, restype, *argtypes):
+            f = getattr(lib, name)
+            f.restype = restype
+            f.argtypes = argtypes
+
+        dpy = c_void_p
+        declare(x11, "XInitThreads", c_int)
+        declare(x11, "XOpenDisplay", dpy, c_char_p)
+        declare(x11, "XCloseDisplay", c_int, dpy)
+        declare(x11, "XSetErrorHandler", c_void_p, _X_ERROR_HANDLER)
+        declare(x11, "XDefaultRootWindow", c_ulong, dpy)
+        declare(x11, "XConnectionNumber", c_int, dpy)
+        declare(x11, "XGetWindowAttributes", c_int, dpy, c_ulong, POINTER(_XWindowAttributes))
+        declare(x11, "XSelectInput", c_int, dpy, c_ulong, c_long)
+        declare(x11, "XQueryTree", c_int, dpy, c_ulong, POINTER(c_ulong), POINTER(c_ulong), POINTER(c_void_p),
+                POINTER(c_uint))
+        declare(x11, "XInternAtom", c_ulong, dpy, c_char_p, c_int)
+        declare(x11, "XCreateSimpleWindow", c_ulong, dpy, c_ulong, c_int, c_int, c_uint, c_uint, c_uint, c_ulong,
+                c_ulong)
+        declare(x11, "XDestroyWindow", c_int, dpy, c_ulong)
+        declare(x11, "XConvertSelection", c_int, dpy, c_ulong, c_ulong, c_ulong, c_ulong, c_ulong)
+        declare(x11, "XGetWindowProperty", c_int, dpy, c_ulong, c_ulong, c_long, c_long, c_int, c_ulong,
+                POINTER(c_ulong), POINTER(c_int), POINTER(c_ulong), POINTER(c_ulong), POINTER(c_void_p))
+        declare(x11, "XFree", c_int, c_void_p)
+        declare(x11, "XPending", c_int, dpy)
+        declare(x11, "XNextEvent", c_int, dpy, POINTER(_XEvent))
+        declare(x11, "XSendEvent", c_int, dpy, c_ulong, c_int, c_long, POINTER(_XEvent))
+        declare(x11, "XFlush", c_int, dpy)
+        declare(x11, "XSync", c_int, dpy, c_int)
+        declare(x11, "XGetImage", POINTER(_XImage), dpy, c_ulong, c_int, c_int, c_uint, c_uint, c_ulong, c_int)
+        declare(x11, "XGetSubImage", POINTER(_XImage), dpy, c_ulong, c_int, c_int, c_uint, c_uint, c_ulong, c_int,
+                POINTER(_XImage), c_int, c_int)
+        if xext is not None and libc is not None:
+            declare(xext, "XShmQueryExtension", c_int, dpy)
+            declare(xext, "XShmCreateImage", POINTER(_XImage), dpy, c_void_p, c_uint, c_int, c_void_p,
+                    POINTER(_XShmSegmentInfo), c_uint, c_uint)
+            declare(xext, "XShmAttach", c_int, dpy, POINTER(_XShmSegmentInfo))
+            declare(xext, "XShmDetach", c_int, dpy, POINTER(_XShmSegmentInfo))
+            declare(xext, "XShmGetImage", c_int, dpy, c_ulong, POINTER(_XImage), c_int, c_int, c_ulong)
+            declare(libc, "shmget", c_int, c_int, c_size_t, c_int)
+            declare(libc, "shmat", c_void_p, c_int, c_void_p, c_int)
+            declare(libc, "shmdt", c_int, c_void_p)
+            declare(libc, "shmctl", c_int, c_int, c_int, c_void_p)
+        else:
+            xext = None
+        if xfixes is not None:
+            declare(xfixes, "XFixesQueryExtension", c_int, dpy, POINTER(c_int), POINTER(c_int))
+            declare(xfixes, "XFixesSelectSelectionInput", None, dpy, c_ulong, c_ulong, c_ulong)
+
+        # every recorder has its own connection, but they may run in parallel threads
+        x11.XInitThreads()
+        x11.XSetErrorHandler(_on_x_error)
+        _libs = x11, xext, xfixes, libc
+        return _libs
+
+
+_MAP_NOTIFY = 19
+_CLIENT_MESSAGE = 33
+_IS_VIEWABLE = 2
+_SUBSTRUCTURE_NOTIFY_MASK = 1 << 19
+_ANY_PROPERTY_TYPE = 0
+_XA_CARDINAL = 6
+_XA_WM_NAME = 39
+
+
+def _window_name(x11, dpy, window, net_wm_name):
+    for name_property in (net_wm_name, _XA_WM_NAME):
+        actual_type, actual_format = c_ulong(), c_int()
+        count, remaining, data = c_ulong(), c_ulong(), c_void_p()
+        if x11.XGetWindowProperty(dpy, window, name_property, 0, 256, 0, _ANY_PROPERTY_TYPE,
+                                  ctypes.byref(actual_type), ctypes.byref(actual_format), ctypes.byref(count),
+                                  ctypes.byref(remaining), ctypes.byref(data)) != 0:
+            continue
+        try:
+            if data and actual_format.value == 8:
+                return ctypes.string_at(data, count.value).decode("utf8", "replace")
+        finally:
+            if data:
+                x11.XFree(data)
+    return None
+
+
+def _window_pid(x11, dpy, window, net_wm_pid):
+    """
+    The _NET_WM_PID of window, or None if its client does not set it
+    """
+    actual_type, actual_format = c_ulong(), c_int()
+    count, remaining, data = c_ulong(), c_ulong(), c_void_p()
+    if x11.XGetWindowProperty(dpy, window, net_wm_pid, 0, 1, 0, _XA_CARDINAL, ctypes.byref(actual_type),
+                              ctypes.byref(actual_format), ctypes.byref(count), ctypes.byref(remaining),
+                              ctypes.byref(data)) != 0:
+        return None
+    try:
+        if data and actual_format.value == 32 and count.value == 1:
+            return ctypes.cast(data, POINTER(c_ulong))[0]  # format 32 properties are returned as longs
+    finally:
+        if data:
+            x11.XFree(data)
+    return None
+
+
+def _find_named_window(x11, dpy, window, name, atoms, pid=None, depth=2):
+    """
+    The first viewable window among window and its descendants (up to depth levels down) whose title contains name,
+    and which belongs to process pid if given (windows without a _NET_WM_PID are not told apart).
+    Under a window manager, client windows are children of the frame windows that get mapped on the root window
+    """
+    net_wm_name, net_wm_pid = atoms
+    attributes = _XWindowAttributes()
+    if not x11.XGetWindowAttributes(dpy, window, ctypes.byref(attributes)) or attributes.map_state != _IS_VIEWABLE:
+        return None
+    title = _window_name(x11, dpy, window, net_wm_name)
+    if title is not None and name in title:
+        window_pid = _window_pid(x11, dpy, window, net_wm_pid) if pid is not None else None
+        if window_pid is None or window_pid == pid:
+            return window, attributes.width, attributes.height
+    if depth == 0:
+        return None
+
+    root, parent, children, count = c_ulong(), c_ulong(), c_void_p(), c_uint()
+    if not x11.XQueryTree(dpy, window, ctypes.byref(root), ctypes.byref(parent), ctypes.byref(children),
+                          ctypes.byref(count)):
+        return None
+    try:
+        for child in (c_ulong * count.value).from_address(children.value) if children else []:
+            found = _find_named_window(x11, dpy, child, name, atoms, pid, depth - 1)
+            if found is not None:
+                return found
+    finally:
+        if children:
+            x11.XFree(children)
+    return None
+
+
+def wait_for_window(name="Adobe Flash Player", display=None, timeout=10, proc=None):
+    """
+    Wait until a window whose title contains name is mapped (woken up by the root window's MapNotify events rather
+    than polling), and return it as (window, width, height). If proc (the window's process) is given, windows of
+    other processes (e.g. a previous flashplayer that is still closing) are ignored.
+    Raises a TimeoutError after timeout seconds, or a RuntimeError if proc exits first
+    """
+    x11 = _load_libraries()[0]
+    dpy = x11.XOpenDisplay(display.encode("utf8") if display is not None else None)
+    if not dpy:
+        raise RuntimeError("Could not open display " + str(display or os.environ.get("DISPLAY")))
+    try:
+        root = x11.XDefaultRootWindow(dpy)
+        atoms = x11.XInternAtom(dpy, b"_NET_WM_NAME", 0), x11.XInternAtom(dpy, b"_NET_WM_PID", 0)
+        pid = proc.pid if proc is not None else None
+        x11.XSelectInput(dpy, root, _SUBSTRUCTURE_NOTIFY_MASK)
+        x11.XSync(dpy, 0)
+
+        deadline = time.monotonic() + timeout
+        fd = x11.XConnectionNumber(dpy)
+        event = _XEvent()
+        found = _find_named_window(x11, dpy, root, name, atoms, pid, 3)  # mapped before we started listening
+        mapped = []  # windows mapped since, rechecked until one of them gets the title
+        while found is None:
+            if proc is not None and proc.poll() is not None:
+                raise RuntimeError("The process exited (code {}) before its window appeared".format(proc.returncode))
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("No '{}' window appeared within {}s".format(name, timeout))
+            if not x11.XPending(dpy):
+                select.select([fd], [], [], min(remaining, 0.1))
+            while x11.XPending(dpy):
+                x11.XNextEvent(dpy, ctypes.byref(event))
+                if event.type == _MAP_NOTIFY and event.map.window not in mapped:
+                    mapped.append(event.map.window)
+            for window in mapped:
+                found = _find_named_window(x11, dpy, window, name, atoms, pid)
+                if found is not None:
+                    break
+            # windows destroyed while being looked at fail the requests, they are simply skipped
+            x11.XSync(dpy, 0)
+            _x_errors.pop(dpy, None)
+        return found
+    finally:
+        x11.XCloseDisplay(dpy)
+        _x_errors.pop(dpy, None)
+
+
+def close_window(pid, name="Adobe Flash Player", display=None):
+    """
+    Ask the window of process pid whose title contains name to close (WM_DELETE_WINDOW, as the window manager's close
+    button does), so that the process can exit cleanly. Returns whether such a window was found
+    """
+    x11 = _load_libraries()[0]
+    dpy = x11.XOpenDisplay(display.encode("utf8") if display is not None else None)
+    if not dpy:
+        raise RuntimeError("Could not open display " + str(display or os.environ.get("DISPLAY")))
+    try:
+        atoms = x11.XInternAtom(dpy, b"_NET_WM_NAME", 0), x11.XInternAtom(dpy, b"_NET_WM_PID", 0)
+        found = _find_named_window(x11, dpy, x11.XDefaultRootWindow(dpy), name, atoms, pid, 3)
+        if found is None:
+            return False
+        event = _XEvent()
+        event.client.type = _CLIENT_MESSAGE
+        event.client.window = found[0]
+        event.client.message_type = x11.XInternAtom(dpy, b"WM_PROTOCOLS", 0)
+        event.client.format = 32
+        event.client.data[0] = x11.XInternAtom(dpy, b"WM_DELETE_WINDOW", 0)
+        x11.XSendEvent(dpy, found[0], 0, 0, ctypes.byref(event))
+        x11.XSync(dpy, 0)
+        return _x_errors.pop(dpy, None) is None
+    finally:
+        x11.XCloseDisplay(dpy)
+        _x_errors.pop(dpy, None)
+
+
+class Recorder:
+    """
+    Frame-synchronised recorder of a window, streaming to ffmpeg. The frame numbers are read from the clipboard
+    """
+    __ZPIXMAP = 2
+    __ALL_PLANES = (1 << (8 * ctypes.sizeof(c_ulong))) - 1
+    __SELECTION_NOTIFY = 31
+    __XFIXES_SET_SELECTION_OWNER_NOTIFY_MASK = 1
+    __IPC_PRIVATE = 0
+    __IPC_CREAT = 0o1000
+    __IPC_RMID = 0
+    __FPS = 25
+    __POLL_INTERVAL = 0.005  # clipboard polling, when change notifications are not available
+    __STOP_CHECK_INTERVAL = 0.1
+
+    def __init__(self, window, display=None):
+        self._x11, self._xext, self._xfixes, self._libc = _load_libraries()
+        self.window = int(window)
+        self.captured = 0
+        self.duplicated = 0
+
+        self._dpy = self._x11.XOpenDisplay(display.encode("utf8") if display is not None else None)
+        if not self._dpy:
+            raise RuntimeError("Could not open display " + str(display or os.environ.get("DISPLAY")))
+        self._image = None
+        self._frame = None
+        self._shm_info = None
+        self._requestor = None
+        self._stop = threading.Event()
+        try:
+            self._init_clipboard()
+            self._init_image()
+        except Exception:
+            self.close()
+            raise
+
+    def _check(self, what):
+        self._x11.XSync(self._dpy, 0)
+        error = _x_errors.pop(self._dpy, None)
+        if error is not None:
+            raise RuntimeError("{} failed (X error {})".format(what, error))
+
+    def _init_clipboard(self):
+        x11 = self._x11
+        root = x11.XDefaultRootWindow(self._dpy)
+        self._clipboard = x11.XInternAtom(self._dpy, b"CLIPBOARD", 0)
+        self._utf8_string = x11.XInternAtom(self._dpy, b"UTF8_STRING", 0)
+        self._property = x11.XInternAtom(self._dpy, b"FBWG_FRAME", 0)
+        # selection conversions need a window to be delivered to
+        self._requestor = x11.XCreateSimpleWindow(self._dpy, root, 0, 0, 1, 1, 0, 0, 0)
+
+        self._xfixes_event = None
+        if self._xfixes is not None:
+            event_base, error_base = c_int(), c_int()
+            if self._xfixes.XFixesQueryExtension(self._dpy, ctypes.byref(event_base), ctypes.byref(error_base)):
+                self._xfixes.XFixesSelectSelectionInput(self._dpy, root, self._clipboard,
+                                                        self.__XFIXES_SET_SELECTION_OWNER_NOTIFY_MASK)
+                self._xfixes_event = event_base.value  # XFixesSelectionNotify
+        self._check("Selecting clipboard notifications")
+
+    def _init_image(self):
+        x11 = self._x11
+        attributes = _XWindowAttributes()
+        if not x11.XGetWindowAttributes(self._dpy, self.window, ctypes.byref(attributes)):
+            raise RuntimeError("Could not get the attributes of window " + str(self.window))
+        self.width, self.height = attributes.width, attributes.height
+
+        if self._xext is not None and self._xext.XShmQueryExtension(self._dpy):
+            try:
+                self._init_shm_image(attributes)
+            except RuntimeError:
+                self._free_image()
+        if self._image is None:
+            # no shared memory (e.g. remote display): grab into the same client side image every time instead
+            self._image = x11.XGetImage(self._dpy, self.window, 0, 0, self.width, self.height, self.__ALL_PLANES,
+                                        self.__ZPIXMAP)
+            self._check("Grabbing window " + str(self.window))
+            if not self._image:
+                raise RuntimeError("Could not grab window " + str(self.window))
+
+        image = self._image.contents
+        if image.bits_per_pixel not in (24, 32):
+            raise RuntimeError("Unsupported window depth: {} bits per pixel".format(image.bits_per_pixel))
+        self._bytes_per_pixel = image.bits_per_pixel // 8
+        self._frame = memoryview((ctypes.c_char * (image.bytes_per_line * self.height)).from_address(image.data))
+
+    def _init_shm_image(self, attributes):
+        xext, libc = self._xext, self._libc
+        self._shm_info = _XShmSegmentInfo()
+        self._shm_info.shmid = -1
+        self._image = xext.XShmCreateImage(self._dpy, attributes.visual, attributes.depth, self.__ZPIXMAP, None,
+                                           ctypes.byref(self._shm_info), self.width, self.height)
+        if not self._image:
+            raise RuntimeError("XShmCreateImage failed")
+
+        size = self._image.contents.bytes_per_line * self.height
+        self._shm_info.shmid = libc.shmget(self.__IPC_PRIVATE, size, self.__IPC_CREAT | 0o600)
+        if self._shm_info.shmid < 0:
+            raise RuntimeError("shmget failed")
+        address = libc.shmat(self._shm_info.shmid, None, 0)
+        if address is None or address == ctypes.c_void_p(-1).value:
+            raise RuntimeError("shmat failed")
+        self._shm_info.shmaddr = address
+        self._image.contents.data = address
+        if not xext.XShmAttach(self._dpy, ctypes.byref(self._shm_info)):
+            raise RuntimeError("XShmAttach failed")
+        try:
+            self._check("XShmAttach")
+        finally:
+            # the segment goes away once both sides detached, even if we do not get to clean up
+            libc.shmctl(self._shm_info.shmid, self.__IPC_RMID, None)
+        self._grab()
+
+    def _grab(self):
+        if self._shm_info is not None:
+            ok = self._xext.XShmGetImage(self._dpy, self.window, self._image, 0, 0, self.__ALL_PLANES)
+        else:
+            ok = self._x11.XGetSubImage(self._dpy, self.window, 0, 0, self.width, self.height, self.__ALL_PLANES,
+                                        self.__ZPIXMAP, self._image, 0, 0)
+        if not ok or self._dpy in _x_errors:
+            self._check("Grabbing window " + str(self.window))
+            raise RuntimeError("Could not grab window " + str(self.window))
+
+    def _request_frame_number(self):
+        self._x11.XConvertSelection(self._dpy, self._clipboard, self._utf8_string, self._property, self._requestor, 0)
+        self._x11.XFlush(self._dpy)
+
+    def _read_frame_number(self, event):
+        if event.selection.property == 0:
+            return None  # no clipboard owner, or it refused the conversion
+        actual_type, actual_format = c_ulong(), c_int()
+        count, remaining, data = c_ulong(), c_ulong(), c_void_p()
+        if self._x11.XGetWindowProperty(self._dpy, self._requestor, self._property, 0, 16, 1, 0,
+                                        ctypes.byref(actual_type), ctypes.byref(actual_format), ctypes.byref(count),
+                                        ctypes.byref(remaining), ctypes.byref(data)) != 0:
+            return None
+        try:
+            if not data or actual_format.value != 8:
+                return None
+            text = ctypes.string_at(data, count.value).strip()
+        finally:
+            if data:
+                self._x11.XFree(data)
+        return int(text) if text.isdigit() else None
+
+    def _ffmpeg_command(self, out_path):
+        image = self._image.contents
+        stride_width = image.bytes_per_line // self._bytes_per_pixel
+        command = ["ffmpeg", "-y", "-loglevel", "error", "-f", "rawvideo",
+                   "-pix_fmt", "bgr0" if self._bytes_per_pixel == 4 else "bgr24",
+                   "-s", "{}x{}".format(stride_width, self.height), "-framerate", str(self.__FPS), "-i", "-"]
+        if stride_width != self.width:
+            command += ["-vf", "crop={}:{}:0:0".format(self.width, self.height)]
+        return command + [out_path]
+
+    def _write_frame(self, frame_no, pipe, last_frame_no):
+        """
+        Grab frame frame_no and write it, after padding the frames missed since last_frame_no with the previous one
+        (still in the image). Frames before the first one are padded with it
+        """
+        if last_frame_no is not None:
+            for _ in range(frame_no - last_frame_no - 1):
+                pipe.write(self._frame)
+                self.duplicated += 1
+        self._grab()
+        copies = frame_no + 1 if last_frame_no is None else 1
+        for _ in range(copies):
+            pipe.write(self._frame)
+        self.duplicated += copies - 1
+        self.captured += 1
+
+    def record(self, out_path, duration=None):
+        """
+        Record to out_path until duration seconds have passed (if not None) or stop() is called
+        """
+        deadline = None if duration is None else time.monotonic() + duration
+        fd = self._x11.XConnectionNumber(self._dpy)
+        event = _XEvent()
+        last_frame_no = None
+        requested = False  # a conversion is in flight
+        changed = True  # the clipboard changed since the last conversion was requested
+
+        self._stop.clear()
+        proc_ffmpeg = subprocess.Popen(self._ffmpeg_command(out_path), stdin=subprocess.PIPE)
+        try:
+            while not self._stop.is_set():
+                if changed and not requested:
+                    self._request_frame_number()
+                    requested, changed = True, False
+
+                if not self._x11.XPending(self._dpy):
+                    timeout = self.__STOP_CHECK_INTERVAL if self._xfixes_event is not None else self.__POLL_INTERVAL
+                    if deadline is not None:
+                        timeout = min(timeout, deadline - time.monotonic())
+                        if timeout <= 0:
+                            break
+                    readable, _, _ = select.select([fd], [], [], timeout)
+                    if not readable:
+                        # also re-read the clipboard now and then, in case a change went unnoticed
+                        changed = True
+                        continue
+
+                while self._x11.XPending(self._dpy):
+                    self._x11.XNextEvent(self._dpy, ctypes.byref(event))
+                    if event.type == self._xfixes_event:
+                        changed = True
+                    elif event.type == self.__SELECTION_NOTIFY:
+                        requested = False
+                        changed = changed or self._xfixes_event is None
+                        frame_no = self._read_frame_number(event)
+                        # the same frame number can be read again, frames are only ever recorded once
+                        if frame_no is not None and (last_frame_no is None or frame_no > last_frame_no):
+                            self._write_frame(frame_no, proc_ffmpeg.stdin, last_frame_no)
+                            last_frame_no = frame_no
+        finally:
+            proc_ffmpeg.stdin.close()
+            proc_ffmpeg.wait()
+        if proc_ffmpeg.returncode != 0:
+            raise RuntimeError("ffmpeg failed with exit code " + str(proc_ffmpeg.returncode))
+        if last_frame_no is None:
+            raise RuntimeError("No frame was recorded")
+
+    def stop(self):
+        """
+        Make record() return (from another thread or a signal handler)
+        """
+        self._stop.set()
+
+    def _free_image(self):
+        if self._shm_info is not None:
+            if self._shm_info.shmaddr:
+                self._xext.XShmDetach(self._dpy, ctypes.byref(self._shm_info))
+                self._x11.XSync(self._dpy, 0)
+                _x_errors.pop(self._dpy, None)
+                self._libc.shmdt(self._shm_info.shmaddr)
+            elif self._shm_info.shmid >= 0:
+                self._libc.shmctl(self._shm_info.shmid, self.__IPC_RMID, None)
+            self._shm_info = None
+            if self._image:
+                self._image.contents.data = None
+        if self._image:
+            _X_DESTROY_IMAGE(self._image.contents.destroy_image)(self._image)
+        self._image = None
+
+    def close(self):
+        if self._dpy:
+            self._frame = None
+            self._free_image()
+            if self._requestor:
+                self._x11.XDestroyWindow(self._dpy, self._requestor)
+            self._x11.XCloseDisplay(self._dpy)
+            _x_errors.pop(self._dpy, None)
+            self._dpy = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Record a flashplayer window running fbwg-base-dev-clip.swf")
+    parser.add_argument("window", type=int, help="id of the window to record (e.g. from xdotool search)")
+    parser.add_argument("output", help="output video, e.g. rec/out.mkv")
+    parser.add_argument("--display", default=None, help="X display (default: $DISPLAY)")
+    parser.add_argument("--duration", type=float, default=None,
+                        help="seconds to record for (default: until interrupted)")
+    args = parser.parse_args()
+
+    with Recorder(args.window, args.display) as recorder:
+        signal.signal(signal.SIGINT, lambda *_: recorder.stop())
+        print("Recording")
+        recorder.record(args.output, args.duration)
+        print("Recorded {} frames, duplicated {} frames".format(recorder.captured, recorder.duplicated))
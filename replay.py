@@ -1,68 +1,195 @@
 import os
-from util import run
-import pyperclip as clip
-from mod import SwfModder
+import re
+import glob
+import mmap
+import numpy as np
+from util import run, close_swf
+from mod import SwfModder, FrameStore
 
 path_rec = os.path.join("tas", "replay.txt")
-path_out = os.path.join("tas", "adventure", "01.txt")
+path_tas = "tas"
+path_shared_objects = os.path.join(os.path.expanduser("~"), ".macromedia", "Flash_Player", "#SharedObjects")
 
 TRIM_END = True
 __FORMAT_MAP = ["u", "r", "l"]
-def format_frames(frames):
-    def _format_frame(frame, hold):
-        out_inputs = []
-        for i, frame_input in enumerate(frame):
-            if frame_input:
-                out_inputs.append(__FORMAT_MAP[i] + " " + str(hold))
-
-        if len(out_inputs) > 0:
-            return ", ".join(out_inputs) + "\n"
-        else:
-            return "s " + str(hold) + "\n"
-
-    ret = ""
-    last_frame = frames[0]
-    hold_count = 0
-    for frame in frames:
-        hold_count += 1
-        if frame != last_frame:
-            ret += _format_frame(last_frame, hold_count)
-
-            last_frame = frame
-            hold_count = 0
-    # flush remaining
-    if not(TRIM_END and all([x is False for x in last_frame])):
-        ret += _format_frame(last_frame, hold_count)
-    return ret
-
-def format_raw_replay():
-    with open(path_rec, "r") as frec:
-        f_frames = []
-        w_frames = []
-        for rec_line in frec:
-            frame = [(x == "true") for x in rec_line.rstrip().split(",")]
-            f_frames.append(frame[:3])
-            w_frames.append(frame[3:])
-
+# line format of every mask of one character's keys, formatted with the hold duration
+__LINE_FORMATS = [", ".join(key + " {0}" for i, key in enumerate(__FORMAT_MAP) if mask & (1 << i)) or "s {0}"
+                  for mask in range(1 << len(__FORMAT_MAP))]
+__LEVEL_MARKER = re.compile(rb"^\s*(\d+)\s*,\s*(\d+)\s*$", re.MULTILINE)
+
+def format_frames(masks, character_num):
+    """
+    Run-length encode one character's inputs out of an array of frame masks, as a stream of TAS lines
+    (character_num: 0 for fireboy, 1 for watergirl)
+    """
+    masks = np.asarray(masks, dtype=np.uint8)
+    if len(masks) == 0:
+        return
+    keys = (masks >> (character_num * len(__FORMAT_MAP))) & ((1 << len(__FORMAT_MAP)) - 1)
+
+    starts = np.concatenate(([0], np.flatnonzero(keys[1:] != keys[:-1]) + 1))
+    holds = np.diff(np.append(starts, len(keys)))
+    run_keys = keys[starts]
+    if TRIM_END and run_keys[-1] == 0:
+        run_keys, holds = run_keys[:-1], holds[:-1]
+
+    for mask, hold in zip(run_keys.tolist(), holds.tolist()):
+        yield __LINE_FORMATS[mask].format(hold) + "\n"
+
+def iter_tas_level(masks):
+    """
+    Generate the TAS level file text of an array of frame masks
+    """
+    yield "fireboy: \n"
+    yield from format_frames(masks, 0)
+    yield "\nwatergirl: \n"
+    yield from format_frames(masks, 1)
+
+def parse_frames(data):
+    """
+    Frame masks of recorded lines of FrameStore.KEY_COUNT comma separated true/false flags (bytes), as a uint8 array
+    """
+    chars = np.frombuffer(data, dtype=np.uint8)
+    if len(chars) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    # every flag is the first character after a separator
+    starts = np.concatenate(([0], np.flatnonzero((chars[:-1] == ord(",")) | (chars[:-1] == ord("\n"))) + 1))
+    first = chars[starts]
+    flags = first[(first == ord("t")) | (first == ord("f"))] == ord("t")
+    if len(flags) % FrameStore.KEY_COUNT:
+        raise ValueError("Recorded flags are not a multiple of {}".format(FrameStore.KEY_COUNT))
+    weights = (1 << np.arange(FrameStore.KEY_COUNT)).astype(np.uint8)
+    return (flags.reshape(-1, FrameStore.KEY_COUNT) * weights).sum(axis=1, dtype=np.uint8)
+
+def split_levels(data):
+    """
+    Split a recording into ((level type, level number), frame masks) parts. Recordings can hold several levels, each
+    preceded by a "type,number" line (as in levels.txt); frames before the first one belong to the first level of
+    levels.txt
+    """
+    with open(os.path.join(path_tas, "levels.txt"), "r") as f:
+        level = tuple(int(x) for x in f.readline().strip().split(","))
+
+    parts = []
+    pos = 0
+    for marker in __LEVEL_MARKER.finditer(data):
+        parts.append((level, parse_frames(data[pos:marker.start()])))
+        level = (int(marker.group(1)), int(marker.group(2)))
+        pos = marker.end()
+    parts.append((level, parse_frames(data[pos:])))
+    return [(level, masks) for level, masks in parts if len(masks) or len(parts) == 1]
+
+def level_path(level):
+    level_type, number = level
+    if not 1 <= level_type <= len(SwfModder.LEVEL_TYPES):
+        raise ValueError("Unknown level type {} (level {})".format(level_type, number))
+    return os.path.join(path_tas, SwfModder.LEVEL_TYPES[level_type - 1], "{:02d}.txt".format(number))
+
+def write_levels(parts):
+    """
+    Write ((level type, level number), frame masks) parts to their TAS level files, returning their paths.
+    A level recorded more than once keeps its last recording
+    """
+    paths = []
+    for level, masks in parts:
+        path_out = level_path(level)
+        os.makedirs(os.path.dirname(path_out), exist_ok=True)
         with open(path_out, "w") as fout:
-            fout.write("fireboy: \n")
-            fout.write(format_frames(f_frames))
+            fout.writelines(iter_tas_level(masks))
+        if path_out not in paths:
+            paths.append(path_out)
+    return paths
 
-            fout.write("\nwatergirl: \n")
-            fout.write(format_frames(w_frames))
+def format_raw_replay():
+    """
+    Convert the recorded replay text into TAS level files, returning their paths
+    """
+    with open(path_rec, "rb") as frec:
+        data = frec.read()
+    return write_levels(split_levels(data))
+
+def find_captures():
+    """
+    The .sol files of the input capture SharedObject (see SwfModder(capture=True)), newest first
+    """
+    paths = glob.glob(os.path.join(glob.escape(path_shared_objects), "**", SwfModder.CAPTURE_NAME + ".sol"),
+                      recursive=True)
+    return sorted(paths, key=os.path.getmtime, reverse=True)
+
+def clear_captures():
+    for path in find_captures():
+        os.remove(path)
+
+def _read_u29(buf, pos):
+    value = 0
+    for i in range(4):
+        byte = buf[pos + i]
+        if i == 3:
+            return (value << 8) | byte, pos + 4
+        value = (value << 7) | (byte & 0x7f)
+        if not byte & 0x80:
+            return value, pos + i + 1
+
+def _capture_log_span(buf):
+    """
+    (offset, length) of the input log ByteArray in the AMF3 encoded .sol file buf
+    """
+    # the "log" member name (AMF3 string of length 3: 3 << 1 | 1) followed by the ByteArray marker
+    pos = buf.find(b"\x07log\x0c")
+    if pos < 0:
+        raise ValueError("No input log in the capture")
+    length, pos = _read_u29(buf, pos + 5)
+    if not length & 1:
+        raise ValueError("Unexpected ByteArray reference in the capture")
+    return pos, length >> 1
+
+def read_capture(path=None):
+    """
+    Split the binary input log captured by a SwfModder(capture=True) swf (the newest capture if path is None) into
+    ((level type, level number), frame masks) parts. The .sol file is memory-mapped, not read
+    """
+    if path is None:
+        paths = find_captures()
+        if not paths:
+            raise FileNotFoundError("No input capture found in " + path_shared_objects)
+        path = paths[0]
+
+    parts = []
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        offset, length = _capture_log_span(m)
+        log = np.frombuffer(m, dtype=np.uint8, count=length, offset=offset)
+        try:
+            markers = np.flatnonzero(log >= SwfModder.CAPTURE_LEVEL_MARKER).tolist()
+            for marker, end in zip(markers, markers[1:] + [len(log)]):
+                if marker + 1 >= end:
+                    continue  # cut off in the middle of a marker
+                level = (int(log[marker]) & ~SwfModder.CAPTURE_LEVEL_MARKER, int(log[marker + 1]))
+                parts.append((level, log[marker + 2:end].copy()))
+        finally:
+            del log  # the mapping cannot be closed while viewed
+    return parts
+
+def format_capture(path=None):
+    """
+    Convert the binary input capture into TAS level files, returning their paths
+    """
+    return write_levels(read_capture(path))
 
 def record_replay(m, wait=False):
+    clear_captures()
     proc = m.launch_async()
 
     if wait:
         input("Press enter when done recording...")
-        print(clip.paste())
-        proc.kill()
+        close_swf(proc)  # not killed, the player saves the end of the capture log when it closes
+        print("Captured " + ", ".join("{}: {} frames".format(level, len(masks)) for level, masks in read_capture()))
 
 def auto_workflow():
-    m = SwfModder(os.path.join("swf", "fbwg-replay.swf"), os.path.join("swf", "fbwg-tas.swf"))
+    m = SwfModder(os.path.join("swf", "fbwg-replay.swf"), os.path.join("swf", "fbwg-tas.swf"), capture=True)
+    clear_captures()
     while True:
-        format_raw_replay()
+        if find_captures():
+            format_capture()
         m.disassemble()
         m.mod_all()
         m.reassemble()
@@ -81,14 +208,15 @@ def auto_workflow():
         input("Press enter to go again...")
 
 def workflow_record():
-    m = SwfModder(os.path.join("swf", "fbwg-replay.swf"), os.path.join("swf", "fbwg-tas.swf"))
+    m = SwfModder(os.path.join("swf", "fbwg-replay.swf"), os.path.join("swf", "fbwg-tas.swf"), capture=True)
     m.disassemble()
     m.mod_all()
     m.reassemble()
 
+    clear_captures()
     m.launch()
 
-    format_raw_replay()
+    format_capture()
     m.disassemble()
     m.mod_all()
     m.reassemble()
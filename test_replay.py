@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+import replay
+from mod import SwfModder, FrameStore, TasLevelParser
+
+
+def recording(levels):
+    """
+    Replay text of (marker or None, frame masks) parts, as recorded by fbwg-replay.swf
+    """
+    text = ""
+    for marker, masks in levels:
+        if marker is not None:
+            text += "{},{}\n".format(*marker)
+        for mask in masks:
+            text += ",".join("true" if mask & (1 << i) else "false" for i in range(FrameStore.KEY_COUNT)) + "\n"
+    return text.encode("utf8")
+
+
+def parse_level(tmp_path, masks):
+    path = tmp_path / "level.txt"
+    path.write_text("".join(replay.iter_tas_level(masks)))
+    t = TasLevelParser(str(path))
+    t.parse()
+    return np.frombuffer(t.sequence.tobytes(), dtype=np.uint8)
+
+
+@pytest.fixture
+def tas_tree(tmp_path, monkeypatch):
+    (tmp_path / "levels.txt").write_text("1,1\n1,2\n")
+    monkeypatch.setattr(replay, "path_tas", str(tmp_path))
+    return tmp_path
+
+
+def random_masks(seed, count):
+    rand = np.random.default_rng(seed)
+    # runs of held keys, as played
+    masks = np.repeat(rand.integers(0, 1 << FrameStore.KEY_COUNT, count // 8, dtype=np.uint8), 8)
+    masks[-1] = (1 << FrameStore.KEY_COUNT) - 1
+    return masks
+
+
+def test_parse_frames():
+    masks = random_masks(0, 400)
+    assert np.array_equal(replay.parse_frames(recording([(None, masks)])), masks)
+    assert np.array_equal(replay.parse_frames(recording([(None, masks)]).replace(b"\n", b"\r\n")), masks)
+    assert len(replay.parse_frames(b"")) == 0
+
+
+def test_parse_frames_incomplete():
+    with pytest.raises(ValueError):
+        replay.parse_frames(b"true,false,true\n")
+
+
+def test_format_frames_round_trip(tmp_path):
+    masks = random_masks(1, 4000)
+    assert np.array_equal(parse_level(tmp_path, masks), masks)
+
+
+def test_format_frames_trims_released_keys(tmp_path):
+    masks = np.concatenate((random_masks(2, 80), np.zeros(10, dtype=np.uint8)))
+    assert np.array_equal(parse_level(tmp_path, masks), masks[:80])
+
+
+def test_format_frames_single_frames(tmp_path):
+    # every frame different, including runs of a single frame at both ends
+    masks = np.arange(1, 1 << FrameStore.KEY_COUNT, dtype=np.uint8)
+    assert list(replay.format_frames(masks[:1], 0)) == ["u 1\n"]
+    assert np.array_equal(parse_level(tmp_path, masks), masks)
+
+
+def test_empty_level(tmp_path):
+    assert list(replay.format_frames(np.zeros(0, dtype=np.uint8), 0)) == []
+    assert len(parse_level(tmp_path, np.zeros(0, dtype=np.uint8))) == 0
+
+
+def test_split_levels(tas_tree, tmp_path):
+    first, second, third = random_masks(3, 160), random_masks(4, 240), random_masks(5, 80)
+    data = recording([(None, first), ((1, 2), second), ((2, 1), np.zeros(0, dtype=np.uint8)), ((3, 4), third)])
+    parts = replay.split_levels(data)
+
+    # frames before the first marker belong to the first level of levels.txt, empty levels are dropped
+    assert [level for level, _ in parts] == [(1, 1), (1, 2), (3, 4)]
+    for (_, masks), expected in zip(parts, [first, second, third]):
+        assert np.array_equal(masks, expected)
+
+    for path, (_, masks) in zip(replay.write_levels(parts), parts):
+        t = TasLevelParser(path)
+        t.parse()
+        assert np.array_equal(np.frombuffer(t.sequence.tobytes(), dtype=np.uint8), masks)
+
+
+def test_split_levels_single_empty_level(tas_tree):
+    parts = replay.split_levels(b"")
+    assert [level for level, _ in parts] == [(1, 1)]
+    assert len(parts[0][1]) == 0
+
+
+def test_level_path(tas_tree):
+    assert replay.level_path((2, 7)) == str(tas_tree / "puzzle" / "07.txt")
+    # unknown level types are captured as 0
+    for level_type in (0, len(SwfModder.LEVEL_TYPES) + 1):
+        with pytest.raises(ValueError):
+            replay.level_path((level_type, 1))
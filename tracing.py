@@ -0,0 +1,244 @@
+"""
+Opt-in tracing of the build/record pipeline stages (parse, disassemble, patch, reassemble, launch, record, render...).
+Every span records its wall time, the time spent in subprocesses under it (wall, and CPU of the children waited for)
+and the peak Python memory allocated during it (plus the process' peak RSS so far).
+
+Enabled by setting FBWG_TRACE to an output path, or with enable(). The trace is written at exit, as Chrome trace
+event JSON (chrome://tracing, Perfetto, speedscope), or as folded stacks for flamegraph.pl if the path ends in .folded.
+When disabled, span() costs a function call.
+"""
+import os
+import json
+import time
+import atexit
+import functools
+import threading
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Windows
+
+_NULL_SPAN = nullcontext()
+_tracer = None
+
+
+def _children_cpu():
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _max_rss_kib():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class _Span:
+    __slots__ = ["name", "path", "children_wall", "subprocess_wall", "peak"]
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.children_wall = 0.0
+        self.subprocess_wall = 0.0
+        self.peak = 0
+
+
+class Tracer:
+    """
+    Collects spans from any thread (each thread has its own span stack). tracemalloc peaks are process wide, so the
+    memory of spans running concurrently in several threads is shared between them
+    """
+
+    def __init__(self, memory=True):
+        self.events = []
+        self.memory = memory
+        self._local = threading.local()
+        self._origin = time.perf_counter()
+        self._started_tracemalloc = False
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    @contextmanager
+    def span(self, name, category="stage", **args):
+        stack = self._stack()
+        parent = stack[-1] if stack else None
+        if self.memory:
+            if parent is not None:
+                parent.peak = max(parent.peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+
+        span = _Span(name, (parent.path if parent is not None else ()) + (name,))
+        stack.append(span)
+        start = time.perf_counter()
+        start_cpu = _children_cpu()
+        try:
+            yield span
+        finally:
+            wall = time.perf_counter() - start
+            child_cpu = _children_cpu() - start_cpu
+            stack.pop()
+
+            if category == "subprocess":
+                span.subprocess_wall = wall
+            if parent is not None:
+                parent.children_wall += wall
+                parent.subprocess_wall += span.subprocess_wall
+            peak = None
+            if self.memory:
+                peak = max(span.peak, tracemalloc.get_traced_memory()[1])
+                if parent is not None:
+                    parent.peak = max(parent.peak, peak)
+
+            self._record(name, category, start, wall, wall - span.children_wall, span.path,
+                         dict(args, subprocess_wall=span.subprocess_wall, subprocess_cpu=child_cpu, peak_alloc=peak,
+                              max_rss_kib=_max_rss_kib()))
+
+    def iterate(self, name, iterable, category="stage", **args):
+        """
+        Trace the time spent producing the items of iterable (e.g. a generator consumed lazily by a patch), as one
+        span under the span active once it is exhausted
+        """
+        start = None
+        wall = 0.0
+        iterator = iter(iterable)
+        while True:
+            t = time.perf_counter()
+            if start is None:
+                start = t
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                wall += time.perf_counter() - t
+            yield item
+
+        stack = self._stack()
+        parent = stack[-1] if stack else None
+        if parent is not None:
+            parent.children_wall += wall
+        self._record(name, category, start, wall, wall, (parent.path if parent is not None else ()) + (name,),
+                     dict(args, subprocess_wall=0.0, subprocess_cpu=0.0, peak_alloc=None, max_rss_kib=None))
+
+    def _record(self, name, category, start, wall, self_wall, path, args):
+        self.events.append({
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": (start - self._origin) * 1e6,
+            "dur": wall * 1e6,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args,
+            "path": path,
+            "self": self_wall,
+        })
+
+    def summary(self):
+        """
+        Totals per span name: {name: {"count", "wall", "subprocess_wall", "peak_alloc"}}
+        """
+        totals = {}
+        for event in self.events:
+            total = totals.setdefault(event["name"], {"count": 0, "wall": 0.0, "subprocess_wall": 0.0,
+                                                      "peak_alloc": 0})
+            total["count"] += 1
+            total["wall"] += event["dur"] / 1e6
+            total["subprocess_wall"] += event["args"]["subprocess_wall"]
+            total["peak_alloc"] = max(total["peak_alloc"], event["args"]["peak_alloc"] or 0)
+        return totals
+
+    def save(self, path):
+        if path.endswith(".folded"):
+            # self time in microseconds per stack, for flamegraph.pl / speedscope
+            folded = {}
+            for event in self.events:
+                key = ";".join(event["path"])
+                folded[key] = folded.get(key, 0) + event["self"] * 1e6
+            with open(path, "w") as f:
+                f.writelines("{} {}\n".format(key, int(value)) for key, value in folded.items())
+        else:
+            with open(path, "w") as f:
+                json.dump({"traceEvents": [{k: v for k, v in event.items() if k not in ("path", "self")}
+                                           for event in self.events], "displayTimeUnit": "ms"}, f)
+
+    def close(self):
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+
+def enable(path=None, memory=True):
+    """
+    Start tracing (replacing any current tracer), writing the trace to path at exit if given
+    """
+    global _tracer
+    disable()
+    _tracer = Tracer(memory)
+    if path is not None:
+        atexit.register(_tracer.save, path)
+    return _tracer
+
+
+def disable():
+    global _tracer
+    if _tracer is not None:
+        _tracer.close()
+        _tracer = None
+
+
+def tracer():
+    """
+    The current Tracer, or None when tracing is disabled
+    """
+    return _tracer
+
+
+def span(name, category="stage", **args):
+    """
+    Context manager tracing the enclosed block as a span (nothing when tracing is disabled)
+    """
+    if _tracer is None:
+        return _NULL_SPAN
+    return _tracer.span(name, category, **args)
+
+
+def traced_iter(name, iterable, category="stage", **args):
+    """
+    Trace the time spent producing the items of iterable (iterable itself when tracing is disabled)
+    """
+    if _tracer is None:
+        return iterable
+    return _tracer.iterate(name, iterable, category, **args)
+
+
+def traced(name, category="stage"):
+    """
+    Decorator tracing every call of a function as a span
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return f(*args, **kwargs)
+            with _tracer.span(name, category):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+if os.environ.get("FBWG_TRACE"):
+    enable(os.environ["FBWG_TRACE"])
@@ -1,35 +1,112 @@
 import os
+import shutil
+import hashlib
 import subprocess
+import tracing
+from recorder import wait_for_window, close_window
 
 __PATH_TOOLS = "tools"
 
 def is_windows():
     return os.name == 'nt'
 
-def click_swf():
+def hash_file(filename):
+    h = hashlib.sha256()
+    b = bytearray(128*1024)
+    mv = memoryview(b)
+    with open(filename, 'rb', buffering=0) as f:
+        for n in iter(lambda: f.readinto(mv), 0):
+            h.update(mv[:n])
+    return h.hexdigest()
+
+def link_or_copy(src, dst):
+    """
+    Hardlink src to dst, falling back to a copy (e.g. across filesystems)
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+@tracing.traced("click")
+def click_swf(display=None, window=None, size=None):
+    """
+    Click through the start menus of a flashplayer window, by default the first 'Adobe Flash Player' window found on
+    the current display. size is the window's (width, height), looked up if None
+    """
     if not os.name == "posix":
         raise RuntimeError("click_swf is only available on Linux atm")
 
-    output = subprocess.run("xdotool getwindowgeometry --shell "
-                            "`xdotool search --name 'Adobe Flash Player'`", shell=True,
-                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    window_data = dict([item.split("=") for item in output.stdout.decode("utf8").splitlines()])
-    window = window_data["WINDOW"]
-    width = int(window_data.get("WIDTH", 929))
-    height = int(window_data.get("HEIGHT", 1010))
-
-    # first play button
-    subprocess.run("xdotool mousemove --window {} {} {}".format(window, width * 0.5, height * 0.8), shell=True)
-    subprocess.run("xdotool click 1".format(window), shell=True)
-    # second play button
-    subprocess.run("xdotool mousemove --window {} {} {}".format(window, width * 0.5, height * 0.55), shell=True)
-    subprocess.run("xdotool click 1".format(window), shell=True)
-    # move cursor out of the way
-    subprocess.run("xdotool mousemove --window {} {} {}".format(window, width, height), shell=True)
+    env = None
+    if display is not None:
+        env = dict(os.environ)
+        env["DISPLAY"] = display
+    if window is None:
+        window = subprocess.run(["xdotool", "search", "--name", "Adobe Flash Player"], env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout.decode("utf8").split()[0]
+
+    if size is None:
+        output = subprocess.run(["xdotool", "getwindowgeometry", "--shell", str(window)], env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        window_data = dict([item.split("=") for item in output.stdout.decode("utf8").splitlines()])
+        window = window_data["WINDOW"]
+        size = int(window_data.get("WIDTH", 929)), int(window_data.get("HEIGHT", 1010))
+    width, height = size
+
+    # a single xdotool run chaining all the commands
+    subprocess.run(["xdotool", *map(str, [
+        # first play button
+        "mousemove", "--window", window, width * 0.5, height * 0.8, "click", 1,
+        # second play button
+        "mousemove", "--window", window, width * 0.5, height * 0.55, "click", 1,
+        # move cursor out of the way
+        "mousemove", "--window", window, width, height,
+    ])], env=env)
     return window
 
+@tracing.traced("launch")
+def launch_swf(swf_file, display=None, timeout=10):
+    """
+    Start flashplayer on swf_file (on the given X display, by default the current one), wait for its window to be
+    mapped (at most timeout seconds) and click through the start menus. Returns (proc, window)
+    """
+    env = None
+    if display is not None:
+        env = dict(os.environ)
+        env["DISPLAY"] = display
+    proc = subprocess.Popen(["flashplayer", os.path.abspath(swf_file)], env=env)
+    try:
+        window, width, height = wait_for_window(display=display, timeout=timeout, proc=proc)
+        click_swf(display, window, (width, height))
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    return proc, window
+
+def close_swf(proc, display=None, timeout=5):
+    """
+    Close a flashplayer started by launch_swf by closing its window, as a user would, so that it gets to save its
+    SharedObjects. It is killed if it has no window or is still running after timeout seconds
+    """
+    if os.name == "posix" and proc.poll() is None:
+        try:
+            closing = close_window(proc.pid, display=display)
+        except (OSError, RuntimeError):
+            closing = False
+        if closing:
+            try:
+                proc.wait(timeout)
+                return
+            except subprocess.TimeoutExpired:
+                pass
+    proc.kill()
+    proc.wait()
+
 def run(tool_name, *args):
-    return subprocess.run([os.path.join(__PATH_TOOLS, tool_name) if is_windows() else tool_name, *args])
+    with tracing.span(tool_name, "subprocess"):
+        return subprocess.run([os.path.join(__PATH_TOOLS, tool_name) if is_windows() else tool_name, *args])
 
 def run_async(tool_name, *args):
-    return subprocess.Popen([os.path.join(__PATH_TOOLS, tool_name) if is_windows() else tool_name, *args])
\ No newline at end of file
+    with tracing.span(tool_name + " (spawn)", "subprocess"):
+        return subprocess.Popen([os.path.join(__PATH_TOOLS, tool_name) if is_windows() else tool_name, *args])
\ No newline at end of file
@@ -0,0 +1,144 @@
+import os
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+
+
+class FileWatcher:
+    """
+    Watches a directory tree for file changes, through inotify when available (Linux) and by polling otherwise
+    """
+    __IN_MODIFY = 0x2
+    __IN_CLOSE_WRITE = 0x8
+    __IN_MOVED_FROM = 0x40
+    __IN_MOVED_TO = 0x80
+    __IN_CREATE = 0x100
+    __IN_DELETE = 0x200
+    __IN_ISDIR = 0x40000000
+    __IN_NONBLOCK = 0o4000
+    __IN_CLOEXEC = 0o2000000
+    __EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, path, poll_interval=0.25, suffixes=(".txt",)):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.suffixes = suffixes
+
+        self._fd = None
+        self._watches = {}  # inotify watch descriptor -> directory
+        self._snapshot = {}
+        try:
+            self._init_inotify()
+        except OSError:
+            self._fd = None
+            self._snapshot = self._scan()
+
+    @property
+    def uses_inotify(self):
+        return self._fd is not None
+
+    def _init_inotify(self):
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError("libc not found")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+
+        fd = self._libc.inotify_init1(self.__IN_NONBLOCK | self.__IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._fd = fd
+        for root, _, _ in os.walk(self.path):
+            self._add_watch(root)
+
+    def _add_watch(self, directory):
+        mask = self.__IN_MODIFY | self.__IN_CLOSE_WRITE | self.__IN_MOVED_FROM | self.__IN_MOVED_TO | \
+               self.__IN_CREATE | self.__IN_DELETE
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed for " + directory)
+        self._watches[wd] = directory
+
+    def _is_relevant(self, path):
+        return path.endswith(self.suffixes)
+
+    def _read_events(self):
+        changed = set()
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_len = self.__EVENT_HEADER.unpack_from(data, offset)
+            offset += self.__EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + name_len].rstrip(b"\0"))
+            offset += name_len
+
+            directory = self._watches.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, name)
+            if mask & self.__IN_ISDIR:
+                if mask & (self.__IN_CREATE | self.__IN_MOVED_TO):
+                    # watch new level type directories too, and pick up files already written into them
+                    for root, _, files in os.walk(path):
+                        self._add_watch(root)
+                        changed.update(os.path.join(root, x) for x in files if self._is_relevant(x))
+            elif self._is_relevant(path):
+                changed.add(path)
+        return changed
+
+    def _scan(self):
+        snapshot = {}
+        for root, _, files in os.walk(self.path):
+            for file in files:
+                if self._is_relevant(file):
+                    file_path = os.path.join(root, file)
+                    try:
+                        st = os.stat(file_path)
+                    except OSError:
+                        continue
+                    snapshot[file_path] = (st.st_mtime_ns, st.st_size)
+        return snapshot
+
+    def poll(self, timeout=None):
+        """
+        Wait up to timeout seconds (forever if None) for changes, returning the set of changed paths
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if self._fd is not None:
+                readable, _, _ = select.select([self._fd], [], [], remaining)
+                changed = self._read_events() if readable else set()
+            else:
+                time.sleep(self.poll_interval if remaining is None else min(self.poll_interval, remaining))
+                snapshot = self._scan()
+                changed = {path for path in snapshot.keys() | self._snapshot.keys()
+                           if snapshot.get(path) != self._snapshot.get(path)}
+                self._snapshot = snapshot
+
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+
+    def wait(self, debounce=0.2):
+        """
+        Block until files change, then keep collecting changes until none arrive for debounce seconds
+        (editors tend to save in bursts of writes/renames)
+        """
+        changed = self.poll()
+        while True:
+            more = self.poll(debounce)
+            if not more:
+                return changed
+            changed |= more
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None